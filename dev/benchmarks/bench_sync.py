@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+r"""
+Offline benchmarks of git-sync end-to-end latency.
+
+Everything runs on one machine inside a sandbox directory:
+
+* ``bin/ssh`` is :mod:`fake_ssh`, which runs remote commands locally with
+  ``HOME`` set to ``hosts/<host>`` and counts the bytes sent over each
+  "connection".
+* ``bin/git`` wraps the real git and logs each invocation, so the number of
+  git processes started locally and on the hosts can be counted.
+* ``hosts/origin/repos/bench.git`` is a bare central remote reached over the
+  fake ssh, ``home/code/bench`` is the local clone and
+  ``hosts/node<i>/code/bench`` are non-bare clones on the hosts.
+
+The generated repo size is configurable (number of files, history depth and
+binary blobs). Each scenario runs the ``git-sync`` CLI in a fresh process and
+records the wall time, per-phase timings (from ``--profile-json``), process
+counts and bytes transferred. Results are written as json to the results
+directory, and the summary is compared against the previous result with the
+same configuration so regressions between releases are visible.
+
+CommandLine:
+    python dev/benchmarks/bench_sync.py
+    python dev/benchmarks/bench_sync.py --files 2000 --depth 200 --binary-kb 1024 --hosts 4 --latency 0.03
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import ubelt as ub
+
+BENCH_DPATH = ub.Path(__file__).parent
+REPO_DPATH = BENCH_DPATH.parent.parent
+
+SCENARIOS = ['push', 'noop', 'bundle', 'no-commit', 'discover']
+
+GIT_SHIM = ub.codeblock(
+    '''
+    #!/bin/sh
+    printf '{{"prog": "git", "side": "%s", "cmd": "%s"}}\\n' "${{GIT_SYNC_BENCH_SIDE:-local}}" "$1" >> "$GIT_SYNC_BENCH_LOG"
+    exec {real_git} "$@"
+    ''')
+
+
+def build_sandbox(dpath, num_hosts):
+    """
+    Create the bin directory with the ssh and git shims and the host homes.
+    """
+    real_git = shutil.which('git')
+    if real_git is None:
+        raise Exception('git is required')
+    bin_dpath = (dpath / 'bin').ensuredir()
+    ssh_fpath = bin_dpath / 'ssh'
+    shutil.copy(BENCH_DPATH / 'fake_ssh.py', ssh_fpath)
+    git_fpath = bin_dpath / 'git'
+    git_fpath.write_text(GIT_SHIM.format(real_git=real_git) + '\n')
+    for fpath in [ssh_fpath, git_fpath]:
+        fpath.chmod(0o755)
+    hosts = [f'node{i}' for i in range(num_hosts)]
+    for name in ['origin'] + hosts:
+        (dpath / 'hosts' / name).ensuredir()
+    (dpath / 'home/code').ensuredir()
+    return hosts
+
+
+def sandbox_env(dpath, latency):
+    env = os.environ.copy()
+    env.update({
+        'HOME': os.fspath(dpath / 'home'),
+        'PATH': os.fspath(dpath / 'bin') + os.pathsep + env.get('PATH', ''),
+        'XDG_CONFIG_HOME': os.fspath(dpath / 'config'),
+        'GIT_SYNC_CACHE_DPATH': os.fspath(dpath / 'cache'),
+        'GIT_SYNC_BENCH_HOSTS': os.fspath(dpath / 'hosts'),
+        'GIT_SYNC_BENCH_LOG': os.fspath(dpath / 'calls.jsonl'),
+        'GIT_SYNC_BENCH_LATENCY': str(latency),
+        'GIT_CONFIG_NOSYSTEM': '1',
+        'GIT_AUTHOR_NAME': 'bench', 'GIT_AUTHOR_EMAIL': 'bench@example.com',
+        'GIT_COMMITTER_NAME': 'bench', 'GIT_COMMITTER_EMAIL': 'bench@example.com',
+    })
+    env.pop('GIT_SSH_COMMAND', None)
+    env.pop('GIT_SSH', None)
+    return env
+
+
+def fast_import_stream(num_files, depth, binary_kb, num_binary, seed=0):
+    """
+    Generate a ``git fast-import`` stream with ``depth`` commits. The first
+    commit adds every file and each later commit modifies a few of them.
+    """
+    rng = random.Random(seed)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta']
+
+    def text_blob():
+        lines = [' '.join(rng.choice(words) for _ in range(8))
+                 for _ in range(rng.randint(5, 40))]
+        return ('\n'.join(lines) + '\n').encode()
+
+    def data(blob):
+        return b'data %d\n' % len(blob) + blob + b'\n'
+
+    paths = [f'src/pkg{i % 20}/file{i}.txt' for i in range(num_files)]
+    stamp = 1600000000
+    for idx in range(depth):
+        msg = f'commit {idx}'.encode()
+        chunks = [b'commit refs/heads/main\n',
+                  b'committer bench <bench@example.com> %d +0000\n' % (stamp + idx),
+                  data(msg)]
+        if idx == 0:
+            changed = paths
+            for bidx in range(num_binary):
+                blob = rng.randbytes(binary_kb * 1024) if hasattr(rng, 'randbytes') else os.urandom(binary_kb * 1024)
+                chunks.append(b'M 644 inline data/blob%d.bin\n' % bidx + data(blob))
+        else:
+            changed = rng.sample(paths, min(len(paths), 5))
+        for path in changed:
+            chunks.append(b'M 644 inline ' + path.encode() + b'\n' + data(text_blob()))
+        yield b''.join(chunks)
+
+
+def generate_repos(dpath, hosts, env, num_files, depth, binary_kb,
+                   num_binary):
+    """
+    Create the bare central repo, the local clone and the host clones.
+    """
+    origin = dpath / 'hosts/origin/repos/bench.git'
+    subprocess.run(['git', 'init', '-q', '--bare', '-b', 'main', origin],
+                   check=True, env=env)
+    stream = b''.join(fast_import_stream(num_files, depth, binary_kb,
+                                         num_binary))
+    subprocess.run(['git', 'fast-import', '--quiet'], input=stream,
+                   cwd=origin, check=True, env=env)
+    url = f'ssh://origin{origin}'
+    clones = [dpath / 'home/code/bench']
+    clones += [dpath / 'hosts' / host / 'code/bench' for host in hosts]
+    for clone in clones:
+        subprocess.run(['git', 'clone', '-q', origin, clone], check=True,
+                       env=env)
+        subprocess.run(['git', 'remote', 'set-url', 'origin', url],
+                       cwd=clone, check=True, env=env)
+    return clones[0]
+
+
+def read_calls(fpath, offset):
+    """
+    Returns:
+        Tuple[Dict, int]: counts since ``offset`` and the new offset
+    """
+    counts = {'git_local': 0, 'git_remote': 0, 'ssh_sessions': 0,
+              'ssh_control': 0, 'bytes_up': 0, 'bytes_down': 0}
+    if not fpath.exists():
+        return counts, offset
+    with open(fpath, 'rb') as file:
+        file.seek(offset)
+        text = file.read()
+        offset = file.tell()
+    for line in text.decode().splitlines():
+        entry = json.loads(line)
+        if entry['prog'] == 'git':
+            key = 'git_local' if entry['side'] == 'local' else 'git_remote'
+            counts[key] += 1
+        elif entry.get('control'):
+            counts['ssh_control'] += 1
+        else:
+            counts['ssh_sessions'] += 1
+            counts['bytes_up'] += entry.get('in', 0)
+            counts['bytes_down'] += entry.get('out', 0)
+    return counts, offset
+
+
+def scenario_args(name, hosts):
+    host_arg = ','.join(hosts)
+    if name == 'push':
+        return [host_arg, 'origin']
+    if name == 'noop':
+        return [host_arg, 'origin']
+    if name == 'bundle':
+        return [host_arg, '--transport', 'bundle']
+    if name == 'no-commit':
+        return [host_arg, '--no-commit']
+    if name == 'discover':
+        return [hosts[0], '--discover', '--dry']
+    raise KeyError(name)
+
+
+def touch_worktree(repo, rng):
+    fpath = repo / 'src/pkg0/file0.txt'
+    with open(fpath, 'a') as file:
+        file.write('change {}\n'.format(rng.random()))
+
+
+def reset_hosts(dpath, hosts, env):
+    # Undo uncommitted changes left by the no-commit scenario
+    for host in hosts:
+        repo = dpath / 'hosts' / host / 'code/bench'
+        subprocess.run(['git', 'reset', '-q', '--hard'], cwd=repo, env=env)
+
+
+def run_scenario(name, dpath, repo, hosts, env, repeat, rng):
+    calls_fpath = ub.Path(env['GIT_SYNC_BENCH_LOG'])
+    profile_fpath = dpath / 'profile.json'
+    samples = []
+    for _ in range(repeat):
+        if name in {'push', 'bundle', 'no-commit'}:
+            touch_worktree(repo, rng)
+        if name == 'discover':
+            # Always measure a cold discovery
+            ub.Path(env['GIT_SYNC_CACHE_DPATH']).delete()
+        _, offset = read_calls(calls_fpath, 0)
+        command = [sys.executable, '-m', 'git_sync']
+        command += scenario_args(name, hosts)
+        command += ['--profile-json', os.fspath(profile_fpath)]
+        run_env = dict(env, PWD=os.fspath(repo))
+        start = time.perf_counter()
+        proc = subprocess.run(command, cwd=repo, env=run_env,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        wall = time.perf_counter() - start
+        counts, _ = read_calls(calls_fpath, offset)
+        phases = {}
+        if profile_fpath.exists():
+            for record in json.loads(profile_fpath.read_text())['phases']:
+                phases[record['phase']] = phases.get(record['phase'], 0) + record['elapsed']
+            profile_fpath.delete()
+        if proc.returncode != 0:
+            print(proc.stdout.decode(errors='replace'))
+        samples.append({'wall': wall, 'ret': proc.returncode,
+                        'phases': phases, **counts})
+    if name == 'no-commit':
+        reset_hosts(dpath, hosts, env)
+        subprocess.run(['git', 'checkout', '-q', '.'], cwd=repo, env=env)
+    return samples
+
+
+def summarize(samples):
+    summary = {'wall': statistics.median(s['wall'] for s in samples),
+               'failures': sum(s['ret'] != 0 for s in samples)}
+    for key in ['git_local', 'git_remote', 'ssh_sessions', 'bytes_up',
+                'bytes_down']:
+        summary[key] = statistics.median(s[key] for s in samples)
+    phase_names = ub.unique(p for s in samples for p in s['phases'])
+    summary['phases'] = {
+        p: statistics.median(s['phases'].get(p, 0) for s in samples)
+        for p in phase_names}
+    return summary
+
+
+def print_summary(results, previous=None):
+    header = '{:<10} {:>9} {:>9} {:>6} {:>6} {:>5} {:>10} {:>10}'.format(
+        'scenario', 'wall', 'prev', 'git-l', 'git-r', 'ssh', 'up', 'down')
+    print(header)
+    for name, info in results.items():
+        summ = info['summary']
+        prev = '-'
+        if previous and name in previous:
+            old = previous[name]['summary']['wall']
+            prev = '{:+.0%}'.format((summ['wall'] - old) / old) if old else '-'
+        print('{:<10} {:>8.3f}s {:>9} {:>6g} {:>6g} {:>5g} {:>10g} {:>10g}'.format(
+            name, summ['wall'], prev, summ['git_local'], summ['git_remote'],
+            summ['ssh_sessions'], summ['bytes_up'], summ['bytes_down']))
+        if summ['failures']:
+            print(f'  {summ["failures"]} failed runs')
+
+
+def find_previous(results_dpath, config):
+    candidates = sorted(results_dpath.glob('*.json'))
+    for fpath in reversed(candidates):
+        try:
+            data = json.loads(fpath.read_text())
+        except ValueError:
+            continue
+        if data.get('config') == config:
+            return fpath, data
+    return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=500)
+    parser.add_argument('--depth', type=int, default=50,
+                        help='number of commits in the generated history')
+    parser.add_argument('--binary-kb', type=int, default=256,
+                        help='size of each generated binary blob')
+    parser.add_argument('--binary-files', type=int, default=2)
+    parser.add_argument('--hosts', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated seconds per ssh round trip')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--results-dpath', default=BENCH_DPATH / 'results')
+    parser.add_argument('--keep', action='store_true',
+                        help='do not delete the sandbox')
+    args = parser.parse_args()
+
+    config = {
+        'files': args.files, 'depth': args.depth,
+        'binary_kb': args.binary_kb, 'binary_files': args.binary_files,
+        'hosts': args.hosts, 'latency': args.latency, 'repeat': args.repeat,
+    }
+    dpath = ub.Path(tempfile.mkdtemp(prefix='git-sync-bench-'))
+    rng = random.Random(0)
+    try:
+        hosts = build_sandbox(dpath, args.hosts)
+        env = sandbox_env(dpath, args.latency)
+        repo = generate_repos(dpath, hosts, env, args.files, args.depth,
+                              args.binary_kb, args.binary_files)
+        results = {}
+        for name in args.scenarios.split(','):
+            samples = run_scenario(name, dpath, repo, hosts, env,
+                                   args.repeat, rng)
+            results[name] = {'summary': summarize(samples),
+                             'samples': samples}
+    finally:
+        if args.keep:
+            print(f'sandbox: {dpath}')
+        else:
+            dpath.delete()
+
+    import git_sync
+    sha = ub.cmd('git rev-parse --short HEAD', cwd=REPO_DPATH)['out'].strip()
+    data = {
+        'version': git_sync.__version__,
+        'commit': sha,
+        'timestamp': ub.timestamp(),
+        'machine': {'platform': platform.platform(),
+                    'python': platform.python_version(),
+                    'git': ub.cmd('git --version')['out'].strip()},
+        'config': config,
+        'results': results,
+    }
+    results_dpath = ub.Path(args.results_dpath).ensuredir()
+    prev_fpath, previous = find_previous(results_dpath, config)
+    print_summary(results, previous['results'] if previous else None)
+    if prev_fpath is not None:
+        print(f'compared to {prev_fpath.name} ({previous["version"]} {previous["commit"]})')
+    fpath = results_dpath / '{}_{}_{}.json'.format(
+        data['timestamp'], data['version'], sha or 'unknown')
+    fpath.write_text(json.dumps(data, indent=1))
+    print(f'wrote {fpath}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+A stand-in for ``ssh`` used by the benchmarks.
+
+Instead of connecting anywhere, the remote command is run locally with ``sh``
+(dash on many hosts, like the login shell of a real one), with ``HOME`` (and
+the working directory) set to ``$GIT_SYNC_BENCH_HOSTS/<host>``. A host without
+a directory there is treated as unreachable (exit 255, like ssh). Control
+master invocations (``-M``, ``-O``, ``-G``) succeed without doing anything.
+
+Like on a real host, the remote command runs in its own session, so killing
+the client does not stop it, and its output only reaches the caller through
+the client.
+
+Every invocation appends a json line to ``$GIT_SYNC_BENCH_LOG`` with the host
+and the number of bytes that went over the "connection" in each direction.
+``$GIT_SYNC_BENCH_LATENCY`` seconds are slept per session to model a round
+trip. If ``$GIT_SYNC_BENCH_HOSTS/<host>.drop`` contains a number N, the next
+N sessions to the host fail with a reset connection (exit 255).
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# ssh options that consume the next argument
+WITH_ARG = set('BbcDEeFIiJLlmOopQRSWw')
+
+
+def parse_args(args):
+    options = []
+    host = None
+    idx = 0
+    while idx < len(args):
+        arg = args[idx]
+        if host is None and arg.startswith('-') and len(arg) > 1:
+            flag = arg[1]
+            if flag in WITH_ARG and len(arg) == 2:
+                options.append((flag, args[idx + 1]))
+                idx += 2
+            else:
+                for char in arg[1:]:
+                    options.append((char, None))
+                idx += 1
+            continue
+        host = arg
+        idx += 1
+        break
+    if host is not None and '@' in host:
+        host = host.split('@', 1)[1]
+    return options, host, ' '.join(args[idx:])
+
+
+def pump(src, dst, counter, key):
+    total = 0
+    try:
+        while True:
+            data = os.read(src.fileno(), 1 << 16)
+            if not data:
+                break
+            total += len(data)
+            dst.write(data)
+            dst.flush()
+    except (BrokenPipeError, OSError):
+        pass
+    finally:
+        counter[key] = total
+        try:
+            dst.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+
+def drop_session(home):
+    """
+    Check if the session should fail like a dropped connection
+    """
+    fpath = home.rstrip(os.sep) + '.drop'
+    try:
+        with open(fpath) as file:
+            count = int(file.read().strip() or 0)
+    except (OSError, ValueError):
+        return False
+    if count <= 0:
+        return False
+    with open(fpath, 'w') as file:
+        file.write(str(count - 1))
+    return True
+
+
+def log(entry):
+    fpath = os.environ.get('GIT_SYNC_BENCH_LOG')
+    if fpath:
+        with open(fpath, 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+
+
+def main():
+    options, host, command = parse_args(sys.argv[1:])
+    flags = {flag for flag, _ in options}
+    latency = float(os.environ.get('GIT_SYNC_BENCH_LATENCY', '0') or 0)
+    entry = {'prog': 'ssh', 'host': host, 'in': 0, 'out': 0}
+    if flags & {'O', 'G'} or 'N' in flags:
+        if 'M' in flags:
+            # Starting a master costs a handshake
+            time.sleep(latency)
+        entry['control'] = True
+        log(entry)
+        return 0
+
+    hosts_dpath = os.environ['GIT_SYNC_BENCH_HOSTS']
+    home = os.path.join(hosts_dpath, host or '')
+    if not host or not os.path.isdir(home):
+        sys.stderr.write(f'ssh: Could not resolve hostname {host}\n')
+        log(entry)
+        return 255
+
+    time.sleep(latency)
+    if drop_session(home):
+        sys.stderr.write('Connection reset by 127.0.0.1 port 22\r\n')
+        entry['dropped'] = True
+        log(entry)
+        return 255
+    env = dict(os.environ, HOME=home, PWD=home, GIT_SYNC_BENCH_SIDE=host)
+    proc = subprocess.Popen(['sh', '-c', command], cwd=home, env=env,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, start_new_session=True)
+    counter = {}
+    threads = [
+        threading.Thread(target=pump, args=(sys.stdin.buffer, proc.stdin, counter, 'in')),
+        threading.Thread(target=pump, args=(proc.stdout, sys.stdout.buffer, counter, 'out')),
+        threading.Thread(target=pump, args=(proc.stderr, sys.stderr.buffer, counter, 'err')),
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    ret = proc.wait()
+    threads[1].join()
+    threads[2].join()
+    # stdin may stay open forever (e.g. an inherited terminal)
+    threads[0].join(timeout=0.1)
+    entry.update(counter)
+    entry['ret'] = ret
+    log(entry)
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
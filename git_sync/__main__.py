@@ -2,11 +2,26 @@
 # -*- coding: utf-8 -*-
 
 
-def main():
+def main(argv=None):
     import argparse
-    parser = argparse.ArgumentParser(description='Sync a git repo with a remote server via ssh')
+    import sys
+    if argv is None:
+        argv = sys.argv[1:]
+    # A host with the name of a subcommand can be synced after "--"
+    subcommands = {'install-hook': install_hook_main, 'stats': stats_main}
+    if argv[:1] and argv[0] in subcommands:
+        return subcommands[argv[0]](argv[1:])
+    parser = argparse.ArgumentParser(
+        description='Sync a git repo with a remote server via ssh',
+        epilog=(
+            'Subcommands: "git-sync install-hook HOST" and "git-sync stats". '
+            'To sync a host with one of these names, pass it after "--", '
+            'e.g. "git-sync -- stats".'))
 
-    parser.add_argument('host', nargs=1, help='Server to sync to via ssh (e.g. user@servername.edu)')
+    parser.add_argument('host', nargs=1, help=(
+        'Server to sync to via ssh (e.g. user@servername.edu). '
+        'Multiple servers can be given as a comma separated list and '
+        'host groups can be referenced as @groupname'))
     parser.add_argument('remote', nargs='?', help='The git remote to use (e.g. origin)')
     parser.add_argument('-A', dest='forward_ssh_agent', action='store_true',
                         help='Enable forwarding of the ssh authentication agent connection')
@@ -18,26 +33,229 @@ def main():
                         help='Force push and hard reset the remote.')
     parser.add_argument('--discover', default=False, action='store_true',
                         help='Run the remote discovery if specified.')
+    parser.add_argument(*('-j', '--workers'), type=int, default=None,
+                        help='Maximum number of hosts to sync concurrently')
+    parser.add_argument('--transport', default='push', choices=['push', 'bundle'],
+                        help=(
+                            'push: push to the git remote and pull on the host. '
+                            'bundle: stream only the missing commits to the '
+                            'host over ssh, bypassing the git remote.'))
+    parser.add_argument('--no-commit', dest='commit', action='store_false',
+                        help=(
+                            'Do not commit. Send a diff of the working tree '
+                            'against the commit checked out on the host and '
+                            'apply it there.'))
+    parser.add_argument('--untracked', dest='include_untracked',
+                        action='store_true',
+                        help='With --no-commit, also send untracked files')
+    parser.add_argument('--submodules', default=False, action='store_true',
+                        help=(
+                            'Also commit, push and update submodules that '
+                            'have changes'))
+    parser.add_argument('--always-sync', dest='fast_path', action='store_false',
+                        help=(
+                            'Run the full sync even if the hosts are already '
+                            'at the current commit'))
+    parser.add_argument('--relay', type=int, default=None, metavar='DEGREE',
+                        help=(
+                            'Relay the commits through the hosts: every '
+                            'synced host pushes them on to at most DEGREE '
+                            'more hosts, preferring its own subnet'))
+    parser.add_argument('--post-sync', default=None, metavar='CMD',
+                        help=(
+                            'Run CMD in the repo on every host that was '
+                            'updated and stream its output'))
+    parser.add_argument('--timeout', default=None, metavar='SPEC',
+                        help=(
+                            'Give up a phase after this many seconds, e.g. '
+                            '"300" for every phase or "push=60,sync=300". '
+                            'The phases are commit, push, connect and sync'))
+    parser.add_argument('--retries', type=int, default=2,
+                        help=(
+                            'How often a push or remote step that failed '
+                            'because of a network problem is retried, with '
+                            'exponential backoff'))
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help=(
+                            'Do not skip the phases that an earlier failed '
+                            'sync of the same commit completed'))
+    direction = parser.add_mutually_exclusive_group()
+    direction.add_argument('--pull-back', dest='direction',
+                           action='store_const', const='pull',
+                           help=(
+                               'Sync in reverse: commit the changes on the '
+                               'host and bring them into the local repo'))
+    direction.add_argument('--both', dest='direction', action='store_const',
+                           const='both',
+                           help=(
+                               'Sync in whichever direction has new changes. '
+                               'If both sides changed, --on-diverge decides'))
+    parser.add_argument('--on-diverge', default=None,
+                        choices=['refuse', 'rebase', 'merge'],
+                        help=(
+                            'What to do when the local and host changes '
+                            'diverged. Defaults to rebase with --pull-back '
+                            'and refuse with --both'))
+    parser.add_argument('--watch', default=False, action='store_true',
+                        help='Watch the working tree and sync after every change')
+    parser.add_argument('--quiet-period', type=float, default=1.0,
+                        help=(
+                            'With --watch, seconds without changes before a '
+                            'sync starts'))
+    parser.add_argument('--workspace', default=None, metavar='PATH',
+                        help=(
+                            'Sync every repo in a workspace: a manifest file '
+                            'or a directory containing repos'))
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='Print how long each phase of the sync took')
+    parser.add_argument('--profile-json', default=None, metavar='FPATH',
+                        help='Write the phase timings as json (implies --profile)')
+    parser.add_argument('--metrics-textfile', default=None, metavar='FPATH',
+                        help=(
+                            'Add the metrics of this run to a Prometheus '
+                            'textfile (e.g. for the node-exporter textfile '
+                            'collector)'))
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        metavar='PORT',
+                        help=(
+                            'Serve Prometheus / OpenMetrics metrics on '
+                            'localhost:PORT/metrics while git-sync runs'))
 
     parser.set_defaults(
         dry=False,
         remote=None,
+        direction='push',
         message='wip [skip ci]',
     )
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     ns = args.__dict__.copy()
     ns['host'] = ns['host'][0]
     import ubelt as ub
     ns = ub.udict(ns)
     discover = ns.pop('discover')
+    watch = ns.pop('watch')
+    quiet_period = ns.pop('quiet_period')
+    workspace = ns.pop('workspace')
+    workspace_keys = {'host', 'message', 'forward_ssh_agent', 'dry', 'force',
+                      'workers', 'remote'}
+    if workspace and not discover:
+        # The workspace sync has its own pipeline without these options
+        flags = {action.dest: action.option_strings[0]
+                 for action in parser._actions if action.option_strings}
+        reporting_keys = {'profile', 'profile_json', 'metrics_textfile',
+                          'metrics_port'}
+        unsupported = [flags[key] for key, value in ns.items()
+                       if key not in workspace_keys | reporting_keys and
+                       value != parser.get_default(key)]
+        if watch:
+            unsupported.append('--watch')
+        if unsupported:
+            parser.error('--workspace cannot be combined with {}'.format(
+                ', '.join(unsupported)))
+    profile_fpath = ns.pop('profile_json')
+    profile = None
+    if ns.pop('profile') or profile_fpath:
+        from git_sync.profiling import Profile
+        profile = Profile().__enter__()
+    metrics_fpath = ns.pop('metrics_textfile')
+    metrics_port = ns.pop('metrics_port')
+    metrics = None
+    if metrics_fpath or metrics_port is not None:
+        from git_sync.metrics import Metrics
+        metrics = Metrics().__enter__()
+        if metrics_port is not None:
+            metrics.serve(metrics_port)
 
-    if discover:
-        from git_sync import discover_remote
-        discover_kw = ns & {'host', 'dry'}
-        discover_remote.dvc_discover_ssh_remote(**discover_kw)
+    try:
+        if discover:
+            from git_sync import discover_remote
+            discover_kw = ns & {'host', 'dry'}
+            discover_remote.dvc_discover_ssh_remote(**discover_kw)
+        elif workspace:
+            from git_sync.workspace import workspace_sync
+            workspace_kw = ns & workspace_keys
+            results = workspace_sync(workspace=workspace, **workspace_kw)
+            if any(r['status'] in {'failed', 'skipped'} for r in results):
+                raise SystemExit(1)
+        elif watch:
+            from git_sync.watch import watch_git_sync
+            watch_git_sync(quiet_period=quiet_period, **ns)
+        else:
+            from git_sync.core import git_sync
+            results = git_sync(**ns)
+            if any(r['status'] in {'failed', 'skipped'} for r in results):
+                raise SystemExit(1)
+    finally:
+        if metrics is not None:
+            metrics.__exit__(None, None, None)
+            if metrics_fpath:
+                metrics.write_textfile(metrics_fpath)
+        if profile is not None:
+            profile.__exit__(None, None, None)
+            print(profile.table())
+            if profile_fpath:
+                profile.dump(profile_fpath)
+
+
+def install_hook_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='git-sync install-hook',
+        description=(
+            'Install hooks in the repo on a host so a push into it is the '
+            'whole sync'))
+    parser.add_argument('host', help='Server with the repo (e.g. user@servername.edu)')
+    parser.add_argument('--post-sync', default=None,
+                        help='Command to run on the host after each sync')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Replace existing hooks that were not installed by git-sync')
+    parser.add_argument('-A', dest='forward_ssh_agent', action='store_true',
+                        help='Enable forwarding of the ssh authentication agent connection')
+    parser.add_argument(*('-n', '--dry'), dest='dry', action='store_true',
+                        help='Perform a dry run')
+    args = parser.parse_args(argv)
+    from git_sync.remote_hook import install_hook
+    ret = install_hook(**args.__dict__)
+    if ret != 0:
+        raise SystemExit(ret)
+
+
+def stats_main(argv):
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(
+        prog='git-sync stats',
+        description=(
+            'Report sync latency percentiles, failure rates and trends from '
+            'the sync history'))
+    parser.add_argument('--host', default=None, help='Only report this host')
+    parser.add_argument('--repo', default=None,
+                        help='Only report syncs of this local repo')
+    parser.add_argument('--days', type=float, default=None,
+                        help='Only use syncs from the last DAYS days')
+    parser.add_argument('--bucket', default='day',
+                        choices=['hour', 'day', 'week'],
+                        help='Time bucket of the trend')
+    parser.add_argument('--json', dest='as_json', action='store_true',
+                        help='Print the statistics as json')
+    args = parser.parse_args(argv)
+    from git_sync import history
+    since = None
+    if args.days is not None:
+        since = time.time() - args.days * 86400
+    repo = args.repo
+    if repo is not None:
+        from git_sync import gitmeta
+        repo = gitmeta.repo_root(repo)
+    bucket = {'hour': 3600, 'day': 86400, 'week': 7 * 86400}[args.bucket]
+    stats = history.compute_stats(since=since, host=args.host, repo=repo,
+                                  bucket=bucket)
+    if args.as_json:
+        import json
+        print(json.dumps(stats.to_json(), indent=2))
     else:
-        from git_sync.core import git_sync
-        git_sync(**ns)
+        print(stats.report())
+
 
 if __name__ == '__main__':
     r"""
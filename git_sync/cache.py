@@ -0,0 +1,344 @@
+"""
+Small persistent json stores kept in the git_sync cache directory.
+
+These remember facts about remote hosts between invocations so they do not
+need to be rediscovered over the network every time.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+import ubelt as ub
+
+try:
+    import fcntl
+except ImportError:  # nocover
+    # Windows: updates are only serialized within one process
+    fcntl = None
+
+
+#: Default time-to-live of a discovery cache entry in seconds (one week)
+DISCOVERY_TTL = 7 * 24 * 60 * 60
+
+
+def cache_dpath():
+    """
+    Returns:
+        ub.Path: the directory where git_sync keeps its persistent state. This
+        can be overwritten with the ``GIT_SYNC_CACHE_DPATH`` environment
+        variable.
+    """
+    dpath = os.environ.get('GIT_SYNC_CACHE_DPATH', None)
+    if dpath:
+        return ub.Path(dpath).ensuredir()
+    return ub.Path.appdir('git_sync', type='cache').ensuredir()
+
+
+class JsonStore:
+    """
+    A dictionary persisted as a json file.
+
+    Writes are atomic (write to a temporary file and rename), so concurrent
+    readers never see a partially written file. Updates are serialized by a
+    lock, which is also held across processes (with ``fcntl.flock`` on a
+    ``.<name>.lock`` file next to the store) so concurrent runs do not lose
+    each other's updates.
+
+    Args:
+        fpath (str | PathLike): path to the json file
+
+    Example:
+        >>> from git_sync.cache import JsonStore
+        >>> import ubelt as ub
+        >>> dpath = ub.Path.appdir('git_sync/tests/cache').ensuredir()
+        >>> store = JsonStore(dpath / 'store.json')
+        >>> store.clear()
+        >>> store.set('a', {'b': 1})
+        >>> assert JsonStore(store.fpath).get('a') == {'b': 1}
+        >>> store.pop('a')
+        >>> assert store.get('a') is None
+
+    Example:
+        >>> # xdoctest: +REQUIRES(POSIX)
+        >>> # Separate instances (like separate processes) do not lose updates
+        >>> from git_sync.cache import JsonStore
+        >>> import ubelt as ub
+        >>> import threading
+        >>> dpath = ub.Path.appdir('git_sync/tests/cache').ensuredir()
+        >>> JsonStore(dpath / 'shared.json').clear()
+        >>> def worker(idx):
+        >>>     store = JsonStore(dpath / 'shared.json')
+        >>>     for jdx in range(20):
+        >>>         store.set(f'{idx}-{jdx}', jdx)
+        >>> threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        >>> for thread in threads:
+        >>>     thread.start()
+        >>> for thread in threads:
+        >>>     thread.join()
+        >>> assert len(JsonStore(dpath / 'shared.json').load()) == 80
+    """
+
+    def __init__(self, fpath):
+        self.fpath = ub.Path(fpath)
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # Held around every load-modify-save. The file lock is only taken by
+        # the outermost holder, a second flock from the same process would
+        # wait for the first.
+        with self._lock:
+            self._depth += 1
+            try:
+                if self._depth > 1 or fcntl is None:
+                    yield
+                    return
+                self.fpath.parent.ensuredir()
+                lock_fpath = self.fpath.parent / '.{}.lock'.format(
+                    self.fpath.name)
+                with open(lock_fpath, 'a') as file:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            finally:
+                self._depth -= 1
+
+    def load(self):
+        try:
+            text = self.fpath.read_text()
+        except FileNotFoundError:
+            return {}
+        try:
+            data = json.loads(text)
+        except ValueError:
+            # A corrupted cache is treated as an empty one
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return data
+
+    def save(self, data):
+        self.fpath.parent.ensuredir()
+        tmp_fpath = self.fpath.parent / '.{}.{}.{}.tmp'.format(
+            self.fpath.name, os.getpid(), threading.get_ident())
+        tmp_fpath.write_text(json.dumps(data, indent=1, sort_keys=True))
+        os.replace(tmp_fpath, self.fpath)
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def set(self, key, value):
+        with self._locked():
+            data = self.load()
+            data[key] = value
+            self.save(data)
+
+    def pop(self, key):
+        with self._locked():
+            data = self.load()
+            value = data.pop(key, None)
+            self.save(data)
+        return value
+
+    def clear(self):
+        with self._locked():
+            self.save({})
+
+
+class DiscoveryCache(JsonStore):
+    """
+    Maps (host, local repo root, root commit) to the location of the
+    corresponding repo on the host.
+
+    Args:
+        fpath (str | PathLike | None): defaults to ``discovery.json`` in
+            :func:`cache_dpath`.
+        ttl (float): seconds after which an entry is ignored
+
+    Example:
+        >>> from git_sync.cache import DiscoveryCache
+        >>> import ubelt as ub
+        >>> dpath = ub.Path.appdir('git_sync/tests/cache').ensuredir()
+        >>> cache = DiscoveryCache(dpath / 'discovery.json')
+        >>> cache.clear()
+        >>> key = ('host', '/home/u/code/repo', 'abc123')
+        >>> assert cache.lookup(*key) is None
+        >>> cache.record(*key, remote_root='/data/u/code/repo')
+        >>> cache.lookup(*key)['remote_root']
+        '/data/u/code/repo'
+        >>> cache.invalidate(*key)
+        >>> assert cache.lookup(*key) is None
+        >>> cache.ttl = -1
+        >>> cache.record(*key, remote_root='/data/u/code/repo')
+        >>> assert cache.lookup(*key) is None
+    """
+
+    def __init__(self, fpath=None, ttl=DISCOVERY_TTL):
+        if fpath is None:
+            fpath = cache_dpath() / 'discovery.json'
+        super().__init__(fpath)
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(host, repo_root, root_commit):
+        return '{}|{}|{}'.format(host, repo_root, root_commit)
+
+    def lookup(self, host, repo_root, root_commit):
+        """
+        Returns:
+            Dict | None: the cached entry, or None if missing or expired
+        """
+        entry = self.get(self._key(host, repo_root, root_commit))
+        if entry is None:
+            return None
+        if time.time() - entry.get('timestamp', 0) > self.ttl:
+            return None
+        return entry
+
+    def record(self, host, repo_root, root_commit, remote_root, gitdir=None):
+        entry = {
+            'host': host,
+            'repo_root': os.fspath(repo_root),
+            'root_commit': root_commit,
+            'remote_root': remote_root,
+            'gitdir': gitdir,
+            'timestamp': time.time(),
+        }
+        self.set(self._key(host, repo_root, root_commit), entry)
+        return entry
+
+    def invalidate(self, host, repo_root, root_commit):
+        self.pop(self._key(host, repo_root, root_commit))
+
+
+class SyncState(JsonStore):
+    """
+    Remembers the local commit that was last synced to each host, keyed by
+    (host, local repo root, branch).
+
+    Args:
+        fpath (str | PathLike | None): defaults to ``sync_state.json`` in
+            :func:`cache_dpath`.
+
+    Example:
+        >>> from git_sync.cache import SyncState
+        >>> import ubelt as ub
+        >>> dpath = ub.Path.appdir('git_sync/tests/cache').ensuredir()
+        >>> state = SyncState(dpath / 'sync_state.json')
+        >>> state.clear()
+        >>> key = ('host', '/home/u/code/repo', 'main')
+        >>> assert state.last_head(*key) is None
+        >>> state.record(*key, head='abc123')
+        >>> state.last_head(*key)
+        'abc123'
+        >>> state.invalidate(*key)
+        >>> assert state.last_head(*key) is None
+    """
+
+    def __init__(self, fpath=None):
+        if fpath is None:
+            fpath = cache_dpath() / 'sync_state.json'
+        super().__init__(fpath)
+
+    @staticmethod
+    def _key(host, repo_root, branch):
+        return '{}|{}|{}'.format(host, repo_root, branch)
+
+    def last_head(self, host, repo_root, branch):
+        """
+        Returns:
+            str | None: the commit last synced to the host
+        """
+        entry = self.get(self._key(host, repo_root, branch))
+        if entry is None:
+            return None
+        return entry.get('head')
+
+    def record(self, host, repo_root, branch, head):
+        entry = {'head': head, 'timestamp': time.time()}
+        self.set(self._key(host, repo_root, branch), entry)
+        return entry
+
+    def invalidate(self, host, repo_root, branch):
+        self.pop(self._key(host, repo_root, branch))
+
+
+class SyncJournal(JsonStore):
+    """
+    Records which phases of the sync of a branch have completed, keyed by
+    (local repo root, branch): the local commit and push, and every host that
+    was updated. A sync that fails part way leaves its entry behind, so the
+    next run for the same commit can skip the work that was already done. An
+    entry is removed once every host was synced.
+
+    Args:
+        fpath (str | PathLike | None): defaults to ``journal.json`` in
+            :func:`cache_dpath`.
+
+    Example:
+        >>> from git_sync.cache import SyncJournal
+        >>> import ubelt as ub
+        >>> dpath = ub.Path.appdir('git_sync/tests/cache').ensuredir()
+        >>> journal = SyncJournal(dpath / 'journal.json')
+        >>> journal.clear()
+        >>> key = ('/home/u/code/repo', 'main')
+        >>> _ = journal.begin(*key, head='abc123', params={'remote': 'origin'})
+        >>> journal.mark(*key, phase='commit')
+        >>> journal.mark(*key, host='node1')
+        >>> entry = journal.lookup(*key)
+        >>> entry['phases'], entry['hosts']
+        (['commit'], ['node1'])
+        >>> journal.finish(*key)
+        >>> assert journal.lookup(*key) is None
+    """
+
+    def __init__(self, fpath=None):
+        if fpath is None:
+            fpath = cache_dpath() / 'journal.json'
+        super().__init__(fpath)
+
+    @staticmethod
+    def _key(repo_root, branch):
+        return '{}|{}'.format(repo_root, branch)
+
+    def lookup(self, repo_root, branch):
+        """
+        Returns:
+            Dict | None: the entry with the keys "head" (the commit being
+            synced), "params" (the options of the sync), "phases" (completed
+            local phases) and "hosts" (hosts that were synced)
+        """
+        return self.get(self._key(repo_root, branch))
+
+    def begin(self, repo_root, branch, head, params=None):
+        """
+        Start a new entry for syncing ``head``, replacing any older one.
+        """
+        entry = {'head': head, 'params': params or {}, 'phases': [],
+                 'hosts': [], 'timestamp': time.time()}
+        self.set(self._key(repo_root, branch), entry)
+        return entry
+
+    def mark(self, repo_root, branch, phase=None, host=None):
+        """
+        Record that a local phase or the sync of a host completed.
+        """
+        key = self._key(repo_root, branch)
+        with self._locked():
+            data = self.load()
+            entry = data.get(key)
+            if entry is None:
+                return
+            if phase is not None and phase not in entry['phases']:
+                entry['phases'].append(phase)
+            if host is not None and host not in entry['hosts']:
+                entry['hosts'].append(host)
+            entry['timestamp'] = time.time()
+            self.save(data)
+
+    def finish(self, repo_root, branch):
+        self.pop(self._key(repo_root, branch))
@@ -7,94 +7,313 @@ similar location relative to the home directory and set that as the remote.
 from os.path import expanduser
 from os.path import relpath
 from git_sync.utils import _getcwd
+from git_sync import ssh_control
+from git_sync.gitmeta import git_default_push_remote_name  # NOQA
+from git_sync.cache import DiscoveryCache, JsonStore, cache_dpath
 import ubelt as ub
 
 
-def git_default_push_remote_name():
-    local_remotes = ub.cmd('git remote -v')['out'].strip()
-    lines = [line for line in local_remotes.split('\n') if line]
+#####
+def candidate_remote_cwds(cwd=None, home=None):
+    """
+    Build a list of places where the remote repo is likely to be located.
+
+    In addition to the path relative to the home directory and the absolute
+    path, any symlinked ancestor of ``cwd`` below ``home`` is resolved and
+    the resulting location is also tried relative to home and absolutely.
+
+    Args:
+        cwd (str | PathLike | None): defaults to the current directory
+        home (str | PathLike | None): defaults to the user home directory
+
+    Returns:
+        List[str]: unique candidates, most likely first
+
+    Example:
+        >>> from git_sync.discover_remote import candidate_remote_cwds
+        >>> import ubelt as ub
+        >>> dpath = ub.Path.appdir('git_sync/tests/candidates').delete().ensuredir()
+        >>> home = dpath / 'home'
+        >>> (dpath / 'data/code/repo').ensuredir()
+        >>> (home / 'data').ensuredir()
+        >>> (home / 'code').symlink_to(dpath / 'data/code')
+        >>> cwd = home / 'code/repo'
+        >>> cands = candidate_remote_cwds(cwd, home)
+        >>> assert cands[0] == 'code/repo'
+        >>> assert str(cwd) in cands
+        >>> assert str(dpath / 'data/code/repo') in cands
+    """
+    import os
+    if cwd is None:
+        cwd = _getcwd()
+    if home is None:
+        home = expanduser('~')
+    cwd = ub.Path(cwd)
+    home = ub.Path(home)
+
     candidates = []
-    for line in lines:
-        parts = line.split('\t')
-        remote_name, remote_url_type = parts
-        if remote_url_type.endswith('(push)'):
-            candidates.append(remote_name)
-    if len(candidates) == 1:
-        remote_name = candidates[0]
-    return remote_name
+    try:
+        candidates.append(relpath(cwd, home))
+    except ValueError:
+        # On windows the paths may be on different drives
+        pass
+    candidates.append(os.fspath(cwd))
 
+    # Look at symlinks relative to home and try those but resolved.
+    resolved_home = home.resolve()
+    for parent in [cwd] + list(cwd.parents):
+        if parent == home or home not in parent.parents:
+            break
+        if parent.is_symlink():
+            resolved = parent.resolve() / relpath(cwd, parent)
+            resolved = ub.Path(os.path.normpath(resolved))
+            for root in [home, resolved_home]:
+                if root in resolved.parents:
+                    candidates.append(relpath(resolved, root))
+            candidates.append(os.fspath(resolved))
 
-#####
-def _devcheck():
+    candidates.append(os.fspath(cwd.resolve()))
+    candidates = [c for c in ub.unique(candidates) if c != '.']
+    return candidates
+
+
+def build_probe_script(candidates):
+    r"""
+    Build a POSIX shell script that tests every candidate directory and
+    prints one line per candidate.
+
+    Each line is ``GIT_SYNC_PROBE<TAB>index<TAB>status<TAB>toplevel<TAB>gitdir``
+    where status is "ok" (the root of a git repo), "subdir" (inside a git
+    repo, but not at its root), "nogit" (the directory exists but is not in a
+    repo) or "missing". Relative candidates are resolved against the remote
+    home directory.
+
+    Example:
+        >>> from git_sync.discover_remote import build_probe_script
+        >>> script = build_probe_script(['code/my repo', '/abs/code/repo'])
+        >>> assert "'code/my repo'" in script
+        >>> assert script.count('GIT_SYNC_PROBE') == 3
+    """
+    import shlex
+    quoted = ' '.join(shlex.quote(str(c)) for c in candidates)
+    script = ub.codeblock(
+        rf'''
+        i=0
+        for c in {quoted}; do
+            if cd "$HOME" 2>/dev/null && cd "$c" 2>/dev/null; then
+                top=$(git rev-parse --show-toplevel 2>/dev/null)
+                if [ -n "$top" ]; then
+                    gitdir=$(cd "$(git rev-parse --git-dir)" && pwd)
+                    status=subdir
+                    if [ "$(pwd -P)" = "$(cd "$top" && pwd -P)" ]; then
+                        status=ok
+                    fi
+                    printf 'GIT_SYNC_PROBE\t%s\t%s\t%s\t%s\n' "$i" "$status" "$top" "$gitdir"
+                else
+                    printf 'GIT_SYNC_PROBE\t%s\tnogit\t\t\n' "$i"
+                fi
+            else
+                printf 'GIT_SYNC_PROBE\t%s\tmissing\t\t\n' "$i"
+            fi
+            i=$((i + 1))
+        done
+        ''')
+    return script
+
+
+def parse_probe_output(text, candidates):
+    r"""
+    Parse the output of :func:`build_probe_script`.
+
+    Returns:
+        List[Dict]: one item per candidate with the keys "candidate",
+        "status", "toplevel" and "gitdir".
+
+    Example:
+        >>> from git_sync.discover_remote import parse_probe_output
+        >>> text = chr(10).join([
+        >>>     'Welcome to the cluster!',
+        >>>     'GIT_SYNC_PROBE\t0\tmissing\t\t',
+        >>>     'GIT_SYNC_PROBE\t1\tok\t/home/u/repo\t/home/u/repo/.git',
+        >>> ])
+        >>> results = parse_probe_output(text, ['repo', '/home/u/repo'])
+        >>> [r['status'] for r in results]
+        ['missing', 'ok']
+        >>> results[1]['gitdir']
+        '/home/u/repo/.git'
+    """
+    results = [
+        {'candidate': str(c), 'status': 'unknown', 'toplevel': None,
+         'gitdir': None}
+        for c in candidates
+    ]
+    for line in text.splitlines():
+        parts = line.rstrip('\r').split('\t')
+        if len(parts) != 5 or parts[0] != 'GIT_SYNC_PROBE':
+            continue
+        _, index, status, toplevel, gitdir = parts
+        result = results[int(index)]
+        result['status'] = status
+        result['toplevel'] = toplevel or None
+        result['gitdir'] = gitdir or None
+    return results
+
+
+def probe_remote_candidates(host, candidates, ssh_flags='', verbose=1):
+    """
+    Test every candidate directory on the remote in a single ssh session.
+
+    Args:
+        host (str): ssh destination
+        candidates (List[str]): directories to test
+        ssh_flags (str): extra ssh flags
+        verbose (int): verbosity
+
+    Returns:
+        List[Dict]: see :func:`parse_probe_output`
     """
-    TODO: need to resolve the  receive.denyCurrentBranch problem less manually
+    script = build_probe_script(candidates)
+    command = ssh_control.build_remote_argv(host, script, ssh_flags)
+    info = ub.cmd(command, verbose=verbose)
+    if info['ret'] != 0:
+        raise Exception('Unable to probe the remote {}: {}'.format(
+            host, info['err'].strip()))
+    return parse_probe_output(info['out'], candidates)
+
+
+def local_repo_identity(cwd=None):
+    """
+    Identify the local repo by its root directory and its root commit.
+
+    Returns:
+        Tuple[str, str | None]: the repo root and the (first) root commit,
+        which is None if the repo has no commits yet.
+
+    Example:
+        >>> from git_sync.discover_remote import local_repo_identity
+        >>> import ubelt as ub
+        >>> dpath = ub.Path.appdir('git_sync/tests/identity').delete().ensuredir()
+        >>> _ = ub.cmd('git init', cwd=dpath)
+        >>> repo_root, root_commit = local_repo_identity(dpath)
+        >>> assert ub.Path(repo_root).resolve() == dpath.resolve()
+        >>> assert root_commit is None
+        >>> # A different repo at the same path gets its own identity
+        >>> _ = ub.cmd('git -c user.name=a -c user.email=a commit -q --allow-empty -m a', cwd=dpath)
+        >>> first = local_repo_identity(dpath)[1]
+        >>> dpath.delete().ensuredir()
+        >>> _ = ub.cmd('git init', cwd=dpath)
+        >>> _ = ub.cmd('git -c user.name=b -c user.email=b commit -q --allow-empty -m b', cwd=dpath)
+        >>> second = local_repo_identity(dpath)[1]
+        >>> assert second is not None and second != first
+    """
+    from git_sync import gitmeta
+    repo_root = gitmeta.repo_root(cwd)
+    # Finding the root commit requires walking history, so it is memoized.
+    # The root commit only changes if the entire history is rewritten, or if
+    # another repo now lives at the same path, which the check catches.
+    memo = JsonStore(cache_dpath() / 'root_commits.json')
+    root_commit = memo.get(repo_root, None)
+    if root_commit is not None:
+        info = ub.cmd(['git', 'cat-file', '-e', f'{root_commit}^{{commit}}'],
+                      cwd=cwd)
+        if info['ret'] != 0:
+            root_commit = None
+    if root_commit is None:
+        info = ub.cmd('git rev-list --max-parents=0 HEAD', cwd=cwd)
+        roots = sorted(info['out'].split()) if info['ret'] == 0 else []
+        root_commit = roots[0] if roots else None
+        if root_commit is not None:
+            memo.set(repo_root, root_commit)
+    return repo_root, root_commit
+
 
-    remote: error: refusing to update checked out branch: refs/heads/updates
-    remote: error: By default, updating the current branch in a non-bare repository
-    remote: is denied, because it will make the index and work tree inconsistent
-    remote: with what you pushed, and will require 'git reset --hard' to match
-    remote: the work tree to HEAD.
+def discover_remote_root(host, repo_root, root_commit, ssh_flags='',
+                         home=None, probe=True, cache=None, local_root=None):
+    """
+    Find the root of the repo on ``host`` that corresponds to the local repo.
 
-    On the remote:
+    The discovery cache is checked first. On a miss the host is probed (in
+    one round trip) and the answer is cached.
 
-        git config --local receive.denyCurrentBranch warn
+    Args:
+        host (str): ssh destination
+        repo_root (str): root of the local repo
+        root_commit (str | None): root commit of the local repo
+        ssh_flags (str): extra ssh flags
+        home (str | None): local home directory
+        probe (bool): if False, only consult the cache
+        cache (DiscoveryCache | None): defaults to the global cache
+        local_root (str | None): the repo root as seen from the working
+            directory without dereferencing symlinks. Used to build the
+            candidate locations. Defaults to ``repo_root``.
 
+    Returns:
+        Dict | None: cache entry with a "remote_root" key or None if the repo
+        could not be found.
     """
+    if cache is None:
+        cache = DiscoveryCache()
+    entry = cache.lookup(host, repo_root, root_commit)
+    if entry is not None or not probe:
+        return entry
+    if local_root is None:
+        local_root = repo_root
+    candidates = candidate_remote_cwds(local_root, home)
+    results = probe_remote_candidates(host, candidates, ssh_flags, verbose=0)
+    for result in results:
+        if result['status'] == 'ok':
+            return cache.record(host, repo_root, root_commit,
+                                remote_root=result['toplevel'],
+                                gitdir=result['gitdir'])
+    return None
 
 
 def dvc_discover_ssh_remote(host, forward_ssh_agent=False,
-                            dry=False):
-    cwd = _getcwd()
-    cwd = ub.Path(cwd)
-    relcwd = relpath(cwd, expanduser('~'))
-
-    # Build a list of places where the remote is likely to be located.
-    candidate_remote_cwds = []
-    candidate_remote_cwds.append(relcwd)
-
-    # TODO: look at symlinks relative to home and try those but resolved?
-
-    candidate_remote_cwds.append(cwd)
-    candidate_remote_cwds.append(cwd.resolve())
-
-    remote_cache_dir = None
-
-    for remote_cwd in candidate_remote_cwds:
-        # Build one command to execute on the remote
-        remote_parts = [
-            'cd {remote_cwd}',
-        ]
-        remote_parts.append('cd .git && pwd')
-        ssh_flags = []
-        if forward_ssh_agent:
-            ssh_flags += ['-A']
-        ssh_flags = ' '.join(ssh_flags)
-
-        remote_part = ' && '.join(remote_parts)
-        command_template = 'ssh {ssh_flags} {host} "' + remote_part + '"'
-        kw = dict(
-            host=host,
-            remote_cwd=remote_cwd,
-            ssh_flags=ssh_flags
-        )
-        command = command_template.format(**kw)
-        print(command)
-        info = ub.cmd(command, verbose=3)
-        if info['ret'] == 0:
-            remote_cache_dir = info['out'].strip().split('\n')[-1]
-            print(f'remote_cache_dir={remote_cache_dir}')
-            # remote_cache_dir = ub.Path(remote_cwd) / '.git'
-            break
-        else:
-            print('Warning: Unable to find candidate DVC repo on the remote')
+                            dry=False, multiplex=True):
+    """
+    Find the repo corresponding to the current directory on ``host`` and add
+    it as a git remote named after the host.
+
+    All candidate locations are probed in one ssh round trip.
 
-    if remote_cache_dir is None:
+    Returns:
+        Dict: the probe result for the chosen candidate
+    """
+    from git_sync import profiling
+    candidates = candidate_remote_cwds()
+
+    ssh_flags = ssh_control.build_ssh_flags(
+        forward_ssh_agent, multiplex=multiplex)
+    with profiling.phase('connect', host):
+        ssh_control.ensure_connection(
+            host, forward_ssh_agent=forward_ssh_agent, multiplex=multiplex)
+
+    with profiling.phase('probe', host):
+        results = probe_remote_candidates(host, candidates, ssh_flags)
+    found = None
+    for result in results:
+        print('{status:>7}: {candidate}'.format(**result))
+        if found is None and result['status'] in {'ok', 'subdir'}:
+            found = result
+
+    if found is None:
         raise Exception('No candidates were found')
 
+    with profiling.phase('metadata'):
+        repo_root, root_commit = local_repo_identity()
+    DiscoveryCache().record(host, repo_root, root_commit,
+                            remote_root=found['toplevel'],
+                            gitdir=found['gitdir'])
+
+    remote_cache_dir = found['gitdir']
+    print(f'remote_cache_dir={remote_cache_dir}')
+
     local_command = f'git remote add {host} ssh://{host}:{remote_cache_dir}'
     if not dry:
         # /media/joncrall/raid/home/joncrall/data/dvc-repos/smart_watch_dvc/.dvc/cache
-        ub.cmd(local_command, verbose=3)
+        with profiling.phase('remote-add') as record:
+            record['ret'] = ub.cmd(local_command, verbose=3)['ret']
     else:
         print('Dry mode, would have run:')
         print(local_command)
+    return found
@@ -0,0 +1,385 @@
+"""
+asyncio based execution of the commands that make up a sync.
+
+:func:`run_command` runs one process, streaming its output line by line
+(optionally with a prefix such as the host name) while also capturing it. If
+the awaiting task is cancelled or the command runs longer than its timeout,
+the process (and the process feeding its stdin, if any) is killed together
+with its children.
+:func:`run_sync` runs a coroutine to completion from synchronous code.
+:func:`is_transient` and :func:`backoff_delay` decide if and when a failed
+command is run again.
+"""
+import asyncio
+import os
+import random
+import shlex
+import signal
+import sys
+from asyncio import subprocess as aio_subprocess
+
+#: Exit code of a command that was killed because it timed out, like
+#: timeout(1)
+TIMEOUT_RET = 124
+
+#: Errors of ssh (also when run by git) caused by a network problem that may
+#: be gone when the command is run again
+TRANSIENT_ERRORS = [
+    'Connection reset by', 'Connection closed by', 'Broken pipe',
+    'Connection timed out', 'Operation timed out', 'Network is unreachable',
+    'No route to host', 'kex_exchange_identification',
+    'ssh_exchange_identification', 'Temporary failure in name resolution',
+]
+
+#: Starts of the lines that ssh prints itself, as opposed to the output of
+#: the command on the host. Only these lines are checked for network errors.
+SSH_DIAGNOSTIC_PREFIXES = (
+    'ssh:', 'ssh_exchange_identification:', 'kex_exchange_identification:',
+    'client_loop:', 'packet_write_wait:', 'packet_write_poll:',
+    'mux_client_', 'muxclient:', 'ControlSocket', 'Control socket',
+    'Connection reset by', 'Connection closed by', 'Connection to ',
+    'Connection timed out during', 'Timeout, server ', 'Read from remote host',
+    'Write failed:',
+)
+
+#: Errors of ssh that will happen again
+PERMANENT_SSH_ERRORS = [
+    'Could not resolve hostname', 'Permission denied',
+    'Host key verification failed', 'Connection refused',
+]
+
+#: Seconds before the first retry of a failed command and the upper bound of
+#: the delay between retries
+RETRY_BASE = 1.0
+RETRY_CAP = 30.0
+
+
+def _normalize_argv(command):
+    """
+    Example:
+        >>> from git_sync.executor import _normalize_argv
+        >>> _normalize_argv('git commit -am "a message"')
+        ['git', 'commit', '-am', 'a message']
+        >>> _normalize_argv(['ssh', 'host', 'ls'])
+        ['ssh', 'host', 'ls']
+    """
+    if isinstance(command, str):
+        return shlex.split(command)
+    return [os.fspath(part) for part in command]
+
+
+def _command_text(command):
+    if isinstance(command, str):
+        return command
+    return ' '.join(shlex.quote(os.fspath(p)) for p in command)
+
+
+async def _pump(stream, chunks, prefix, file, echo, capture=None):
+    """
+    Read a stream until EOF, keeping what was read and echoing complete
+    lines.
+
+    If ``capture`` is given, only about the last ``capture`` bytes are kept
+    in ``chunks``, and lines longer than that are echoed in pieces, so memory
+    use does not depend on how much the process writes.
+    """
+    partial = b''
+    kept = 0
+    while True:
+        data = await stream.read(1 << 16)
+        if not data:
+            break
+        chunks.append(data)
+        if capture is not None:
+            kept += len(data)
+            while kept - len(chunks[0]) >= capture:
+                kept -= len(chunks.pop(0))
+        if echo:
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()
+            if capture is not None and len(partial) > capture:
+                lines.append(partial)
+                partial = b''
+            for line in lines:
+                text = line.decode('utf8', errors='replace')
+                print(prefix + text, file=file, flush=True)
+    if echo and partial:
+        text = partial.decode('utf8', errors='replace')
+        print(prefix + text, file=file, flush=True)
+
+
+async def _feed(writer, source, counter):
+    """
+    Write ``source`` (bytes, a file path or a stream reader) into a process
+    stdin.
+    """
+    try:
+        if isinstance(source, bytes):
+            writer.write(source)
+            counter[0] += len(source)
+            await writer.drain()
+        elif isinstance(source, os.PathLike):
+            with open(source, 'rb') as file:
+                for data in iter(lambda: file.read(1 << 16), b''):
+                    writer.write(data)
+                    counter[0] += len(data)
+                    await writer.drain()
+        else:
+            while True:
+                data = await source.read(1 << 16)
+                if not data:
+                    break
+                writer.write(data)
+                counter[0] += len(data)
+                await writer.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+
+def _kill(proc):
+    if proc is None:
+        return
+    if hasattr(os, 'killpg'):
+        # The process leads its own process group, so its children (e.g. the
+        # ssh started by git, which is what stalls on the network) go too
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    elif proc.returncode is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+
+async def run_command(command, verbose=0, prefix='', env=None, cwd=None,
+                      stdin=None, capture=None, timeout=None):
+    """
+    Run a command, streaming and capturing its output.
+
+    Args:
+        command (str | List[str]): the command. Strings are split like a
+            shell would (but no shell is used).
+        verbose (int): 0 is silent, 1 echoes output, 2 also prints the
+            command before running it.
+        prefix (str): prepended to every echoed line (e.g. "[host] ")
+        env (Dict | None): environment of the process
+        cwd (str | None): working directory of the process
+        stdin (None | bytes | PathLike | List[str]): None inherits stdin,
+            bytes and the contents of a file are written to stdin, and a
+            command has its stdout piped into stdin. A file can be sent to
+            many processes at once.
+        capture (int | None): if given, keep only about the last
+            ``capture`` bytes of stdout and of stderr in the result. The
+            output is still echoed in full.
+        timeout (float | None): seconds after which the command and its
+            children are killed. It then exits with :data:`TIMEOUT_RET` and
+            its stderr ends with "timed out after N s".
+
+    Returns:
+        Dict: with keys "ret", "out", "err", "command", "bytes" (the
+        number of bytes written to stdin) and "timed_out"
+
+    Example:
+        >>> from git_sync.executor import run_command, run_sync
+        >>> info = run_sync(run_command(['cat'], stdin=b'hello'))
+        >>> info['out'], info['bytes'], info['ret']
+        ('hello', 5, 0)
+        >>> info = run_sync(run_command(['cat'], stdin=['echo', 'piped']))
+        >>> info['out']
+        'piped\\n'
+        >>> import ubelt as ub
+        >>> fpath = ub.Path.appdir('git_sync/tests/executor').ensuredir() / 'stdin.txt'
+        >>> _ = fpath.write_text('from a file')
+        >>> run_sync(run_command(['cat'], stdin=fpath))['out']
+        'from a file'
+        >>> info = run_sync(run_command(['seq', '100000'], capture=1024))
+        >>> len(info['out']) < 70000, info['out'].endswith('100000\\n')
+        (True, True)
+        >>> info = run_sync(run_command(['sleep', '10'], timeout=0.1))
+        >>> info['ret'], info['timed_out'], info['err']
+        (124, True, 'timed out after 0.1s\\n')
+
+    Example:
+        >>> # xdoctest: +REQUIRES(LINUX)
+        >>> # Children of a command that timed out are killed as well
+        >>> from git_sync.executor import run_command, run_sync
+        >>> import time
+        >>> import ubelt as ub
+        >>> start = time.monotonic()
+        >>> info = run_sync(run_command(['sh', '-c', 'sleep 37 & echo $!; wait'], timeout=0.5))
+        >>> assert time.monotonic() - start < 10
+        >>> stat_fpath = ub.Path('/proc') / info['out'].strip() / 'stat'
+        >>> time.sleep(0.2)
+        >>> # gone, or a zombie waiting to be reaped
+        >>> assert not stat_fpath.exists() or ') Z ' in stat_fpath.read_text()
+    """
+    argv = _normalize_argv(command)
+    if verbose >= 2:
+        print(f'{prefix}$ {_command_text(command)}', flush=True)
+    producer = None
+    proc = None
+    counter = [0]
+    timed_out = False
+    try:
+        if isinstance(stdin, (list, tuple)):
+            producer = await asyncio.create_subprocess_exec(
+                *_normalize_argv(stdin), cwd=cwd, env=env,
+                stdout=aio_subprocess.PIPE, stderr=aio_subprocess.PIPE,
+                start_new_session=True)
+        proc = await asyncio.create_subprocess_exec(
+            *argv, cwd=cwd, env=env,
+            stdin=None if stdin is None else aio_subprocess.PIPE,
+            stdout=aio_subprocess.PIPE, stderr=aio_subprocess.PIPE,
+            start_new_session=True)
+        out_chunks, err_chunks, producer_err = [], [], []
+        echo = verbose >= 1
+        jobs = [
+            _pump(proc.stdout, out_chunks, prefix, sys.stdout, echo, capture),
+            _pump(proc.stderr, err_chunks, prefix, sys.stderr, echo, capture),
+        ]
+        if producer is not None:
+            jobs.append(_feed(proc.stdin, producer.stdout, counter))
+            jobs.append(_pump(producer.stderr, producer_err, prefix,
+                              sys.stderr, False))
+        elif stdin is not None:
+            jobs.append(_feed(proc.stdin, stdin, counter))
+
+        async def communicate():
+            await asyncio.gather(*jobs)
+            return await proc.wait()
+
+        try:
+            ret = await asyncio.wait_for(communicate(), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            _kill(producer)
+            _kill(proc)
+            await proc.wait()
+            ret = TIMEOUT_RET
+            err_chunks.append(f'timed out after {timeout:g}s\n'.encode())
+        if producer is not None:
+            producer_ret = await producer.wait()
+            if producer_ret != 0 and not timed_out:
+                err_chunks.insert(0, b''.join(producer_err))
+                if ret == 0:
+                    ret = producer_ret
+    except BaseException:
+        # Cancelled (e.g. Ctrl-C or a timeout) or failed: do not leave the
+        # processes behind.
+        _kill(producer)
+        _kill(proc)
+        for p in [producer, proc]:
+            if p is not None:
+                try:
+                    await asyncio.shield(p.wait())
+                except BaseException:
+                    pass
+        raise
+    info = {
+        'command': _command_text(command),
+        'ret': ret,
+        'out': b''.join(out_chunks).decode('utf8', errors='replace'),
+        'err': b''.join(err_chunks).decode('utf8', errors='replace'),
+        'bytes': counter[0],
+        'timed_out': timed_out,
+    }
+    return info
+
+
+def is_transient(info):
+    """
+    Check if a command failed because of a network problem that may go away,
+    e.g. a reset connection. Only failures of ssh itself count: once the
+    command on the host produced output it may have had effects, and it is
+    not run again. Commands that timed out are not retried either.
+
+    Args:
+        info (Dict): the result of :func:`run_command`
+
+    Returns:
+        bool
+
+    Example:
+        >>> from git_sync.executor import is_transient
+        >>> is_transient({'ret': 255, 'err': 'Connection reset by 10.0.0.1 port 22'})
+        True
+        >>> is_transient({'ret': 255, 'err': 'ssh: Could not resolve hostname node9'})
+        False
+        >>> is_transient({'ret': 1, 'err': 'error: failed to push some refs'})
+        False
+        >>> # The command on the host failed, not ssh
+        >>> is_transient({'ret': 255, 'err': ''})
+        False
+        >>> is_transient({'ret': 1, 'err': 'cat: write error: Broken pipe'})
+        False
+        >>> is_transient({'ret': 255, 'out': 'building', 'err': 'client_loop: send disconnect: Broken pipe'})
+        False
+        >>> is_transient({'ret': 128, 'err': 'remote: Resolving deltas' + chr(10) + 'Connection closed by 10.0.0.1 port 22'})
+        False
+    """
+    if info['ret'] in {0, None} or info.get('timed_out'):
+        return False
+    if (info.get('out') or '').strip():
+        return False
+    lines = [line.strip() for line in (info.get('err') or '').splitlines()]
+    if any(line.startswith('remote:') for line in lines):
+        # git relayed output of the host, e.g. of the hooks
+        return False
+    ssh_lines = [line for line in lines
+                 if line.startswith(SSH_DIAGNOSTIC_PREFIXES)]
+    if any(pattern in line for line in ssh_lines
+           for pattern in TRANSIENT_ERRORS):
+        return True
+    # ssh exits with 255 if it could not run the command, but so can the
+    # command itself
+    return info['ret'] == 255 and bool(ssh_lines) and not any(
+        pattern in line for line in ssh_lines
+        for pattern in PERMANENT_SSH_ERRORS)
+
+
+def backoff_delay(attempt, base=RETRY_BASE, cap=RETRY_CAP, rng=random):
+    """
+    Seconds to wait before running a command again after ``attempt`` failed
+    attempts. The delay doubles with every attempt (up to ``cap``) and a
+    random half of it is jitter, so hosts that failed together do not retry
+    in lockstep.
+
+    Example:
+        >>> from git_sync.executor import backoff_delay
+        >>> import random
+        >>> rng = random.Random(0)
+        >>> delays = [backoff_delay(n, rng=rng) for n in range(1, 8)]
+        >>> assert 0.5 <= delays[0] <= 1.0 and 1.0 <= delays[1] <= 2.0
+        >>> assert 15.0 <= delays[-1] <= 30.0
+    """
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay / 2 + rng.uniform(0, delay / 2)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking function in the default thread pool.
+    """
+    import functools
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def run_sync(coro):
+    """
+    Run a coroutine to completion from synchronous code.
+
+    If the calling thread already runs an event loop, the coroutine is run on
+    a fresh loop in a helper thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
@@ -0,0 +1,404 @@
+"""
+Read basic git metadata (HEAD, refs and remotes) directly from the ``.git``
+directory.
+
+Starting a git process is comparatively expensive on slow (e.g. network)
+filesystems, and git-sync only needs a few facts about the local repo before
+it can start its real work. This module reads them in-process, including for
+linked worktrees and submodules that use a ``.git`` file. Anything unusual
+(e.g. ``GIT_DIR`` overrides, bare repos, config includes) raises
+:class:`GitMetaError` and the public helpers fall back to asking git.
+"""
+import os
+import re
+import ubelt as ub
+from git_sync.utils import _getcwd
+
+
+class GitMetaError(Exception):
+    """
+    Raised when the repo layout is not understood by the in-process reader
+    """
+
+
+class RepoMeta:
+    """
+    In-process view of the metadata of the repo containing ``path``.
+
+    Args:
+        path (str | PathLike | None): any path inside the working tree.
+            Defaults to the current working directory.
+
+    Example:
+        >>> from git_sync.gitmeta import RepoMeta
+        >>> import ubelt as ub
+        >>> dpath = ub.Path.appdir('git_sync/tests/gitmeta').delete().ensuredir()
+        >>> _ = ub.cmd('git init -b main', cwd=dpath)
+        >>> _ = ub.cmd('git remote add origin https://example.com/repo.git', cwd=dpath)
+        >>> (dpath / 'sub').ensuredir()
+        >>> meta = RepoMeta(dpath / 'sub')
+        >>> assert meta.worktree == dpath.resolve()
+        >>> meta.branch
+        'main'
+        >>> meta.remotes['origin']['url']
+        'https://example.com/repo.git'
+        >>> assert meta.head_sha is None
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = _getcwd()
+        self.path = ub.Path(path).resolve()
+        self.worktree, self.git_dir = _find_git_dir(self.path)
+        commondir_fpath = self.git_dir / 'commondir'
+        if commondir_fpath.exists():
+            common = commondir_fpath.read_text().strip()
+            self.common_dir = (self.git_dir / common).resolve()
+        else:
+            self.common_dir = self.git_dir
+        self._config = None
+
+    @property
+    def config(self):
+        """
+        Dict[Tuple[str, str | None], Dict[str, List[str]]]: the repo config
+        """
+        if self._config is None:
+            self._config = parse_git_config(
+                (self.common_dir / 'config').read_text())
+        return self._config
+
+    def config_get(self, section, subsection, key, default=None):
+        """
+        Returns:
+            str | None: the last value of the config key
+        """
+        values = self.config.get((section, subsection), {}).get(key.lower())
+        return values[-1] if values else default
+
+    @property
+    def head(self):
+        """
+        str: the symbolic ref HEAD points to or the commit sha if detached
+        """
+        text = (self.git_dir / 'HEAD').read_text().strip()
+        if text.startswith('ref:'):
+            return text[4:].strip()
+        if re.fullmatch('[0-9a-f]{40,64}', text):
+            return text
+        raise GitMetaError(f'Unable to parse HEAD: {text!r}')
+
+    @property
+    def branch(self):
+        """
+        str: the checked out branch name, or "HEAD" if detached (which is what
+        ``git rev-parse --abbrev-ref HEAD`` reports)
+        """
+        head = self.head
+        if head.startswith('refs/heads/'):
+            return head[len('refs/heads/'):]
+        return 'HEAD'
+
+    @property
+    def head_sha(self):
+        """
+        str | None: the commit HEAD resolves to or None if there are no
+        commits yet.
+        """
+        return self.resolve_ref('HEAD')
+
+    def resolve_ref(self, refname, _depth=0):
+        """
+        Resolve a full ref name (e.g. "refs/heads/main" or "HEAD") to a sha.
+
+        Returns:
+            str | None: None if the ref does not exist
+        """
+        if _depth > 10:
+            raise GitMetaError(f'Symbolic ref loop at {refname}')
+        if re.fullmatch('[0-9a-f]{40,64}', refname):
+            return refname
+        # HEAD and other per-worktree refs live in the git dir, shared refs
+        # live in the common dir.
+        for dpath in ub.unique([self.git_dir, self.common_dir]):
+            fpath = dpath / refname
+            if fpath.is_file():
+                text = fpath.read_text().strip()
+                if text.startswith('ref:'):
+                    return self.resolve_ref(text[4:].strip(), _depth + 1)
+                return text
+        return self.packed_refs().get(refname, None)
+
+    def packed_refs(self):
+        """
+        Returns:
+            Dict[str, str]: mapping from ref name to sha from packed-refs
+        """
+        fpath = self.common_dir / 'packed-refs'
+        refs = {}
+        if not fpath.exists():
+            return refs
+        for line in fpath.read_text().splitlines():
+            if not line or line.startswith(('#', '^')):
+                continue
+            sha, _, name = line.partition(' ')
+            refs[name.strip()] = sha
+        return refs
+
+    @property
+    def remotes(self):
+        """
+        Dict[str, Dict[str, str]]: mapping from remote name to its "url" and
+        "pushurl" (if configured)
+        """
+        remotes = {}
+        for (section, subsection), items in self.config.items():
+            if section == 'remote' and subsection is not None:
+                info = {}
+                for key in ['url', 'pushurl']:
+                    if items.get(key):
+                        info[key] = items[key][-1]
+                if info:
+                    remotes[subsection] = info
+        return remotes
+
+    def default_push_remote(self):
+        """
+        Determine the remote ``git push`` would push the current branch to.
+
+        Returns:
+            str | None
+        """
+        branch = self.branch
+        for section, subsection, key in [
+                ('branch', branch, 'pushremote'),
+                ('remote', None, 'pushdefault'),
+                ('branch', branch, 'remote')]:
+            name = self.config_get(section, subsection, key)
+            if name and name != '.':
+                return name
+        remotes = self.remotes
+        if len(remotes) == 1:
+            return list(remotes)[0]
+        if 'origin' in remotes:
+            return 'origin'
+        return next(iter(remotes), None)
+
+
+def _find_git_dir(path):
+    """
+    Walk up from ``path`` to the working tree root and its git directory.
+
+    Returns:
+        Tuple[ub.Path, ub.Path]: the worktree root and the git dir
+    """
+    if os.environ.get('GIT_DIR') or os.environ.get('GIT_WORK_TREE'):
+        raise GitMetaError('GIT_DIR / GIT_WORK_TREE overrides are not handled')
+    for dpath in [path] + list(path.parents):
+        dotgit = dpath / '.git'
+        if dotgit.is_dir():
+            return dpath, dotgit
+        if dotgit.is_file():
+            # Linked worktrees and submodules use a file pointing at the
+            # real git dir
+            text = dotgit.read_text().strip()
+            if not text.startswith('gitdir:'):
+                raise GitMetaError(f'Unable to parse {dotgit}')
+            git_dir = ub.Path(text[len('gitdir:'):].strip())
+            if not git_dir.is_absolute():
+                git_dir = dpath / git_dir
+            return dpath, git_dir.resolve()
+    raise GitMetaError(f'{path} is not inside a git working tree')
+
+
+def parse_git_config(text):
+    r"""
+    Parse the subset of the git config format used in repo config files.
+
+    Args:
+        text (str): contents of a config file
+
+    Returns:
+        Dict[Tuple[str, str | None], Dict[str, List[str]]]: mapping from
+        (section, subsection) to lowercase keys and their values.
+
+    Example:
+        >>> from git_sync.gitmeta import parse_git_config
+        >>> text = ub.codeblock(
+        >>>     '''
+        >>>     [core]
+        >>>         bare = false  ; a comment
+        >>>     [remote "origin"]
+        >>>         url = git@github.com:user/repo.git
+        >>>         fetch = +refs/heads/*:refs/remotes/origin/*
+        >>>     [branch "main"]
+        >>>         remote = origin
+        >>>         merge = refs/heads/main
+        >>>     [Branch.Dev]
+        >>>         pushRemote = "my remote" # quoted
+        >>>     [core]
+        >>>         filemode
+        >>>     ''')
+        >>> config = parse_git_config(text)
+        >>> config[('remote', 'origin')]['url']
+        ['git@github.com:user/repo.git']
+        >>> config[('branch', 'dev')]['pushremote']
+        ['my remote']
+        >>> config[('core', None)]
+        {'bare': ['false'], 'filemode': ['true']}
+    """
+    config = {}
+    section_key = None
+    lines = iter(text.splitlines())
+    for line in lines:
+        stripped = line.strip()
+        if not stripped or stripped[0] in '#;':
+            continue
+        if stripped.startswith('['):
+            match = re.match(r'\[\s*([A-Za-z0-9.-]+)\s*(?:"((?:[^"\\]|\\.)*)")?\s*\]',
+                             stripped)
+            if match is None:
+                raise GitMetaError(f'Unable to parse config line {line!r}')
+            section, subsection = match.group(1), match.group(2)
+            if subsection is not None:
+                subsection = re.sub(r'\\(.)', r'\1', subsection)
+                section = section.lower()
+            elif '.' in section:
+                # Deprecated [section.subsection] syntax is case insensitive
+                section, subsection = section.lower().split('.', 1)
+            else:
+                section = section.lower()
+            if section in {'include', 'includeif'}:
+                raise GitMetaError('Config includes are not handled')
+            section_key = (section, subsection)
+            config.setdefault(section_key, {})
+            rest = stripped[match.end():].strip()
+            if not rest or rest[0] in '#;':
+                continue
+            stripped = rest
+        if section_key is None:
+            raise GitMetaError(f'Config entry outside a section: {line!r}')
+        key, sep, raw_value = stripped.partition('=')
+        if not sep:
+            key = re.split('[#;]', key)[0]
+        key = key.strip().lower()
+        if not sep:
+            value = 'true'
+        else:
+            # Handle line continuations
+            while raw_value.endswith('\\') and not raw_value.endswith('\\\\'):
+                raw_value = raw_value[:-1] + next(lines, '')
+            value = _parse_config_value(raw_value)
+        config[section_key].setdefault(key, []).append(value)
+    return config
+
+
+def _parse_config_value(raw_value):
+    escapes = {'n': '\n', 't': '\t', 'b': '\b', '\\': '\\', '"': '"'}
+    chars = []
+    in_quote = False
+    pending_space = ''
+    idx = 0
+    raw_value = raw_value.strip()
+    while idx < len(raw_value):
+        char = raw_value[idx]
+        if char == '\\' and idx + 1 < len(raw_value):
+            chars.append(pending_space)
+            pending_space = ''
+            chars.append(escapes.get(raw_value[idx + 1], raw_value[idx + 1]))
+            idx += 2
+            continue
+        if char == '"':
+            in_quote = not in_quote
+        elif not in_quote and char in '#;':
+            break
+        elif not in_quote and char.isspace():
+            pending_space += char
+        else:
+            chars.append(pending_space)
+            pending_space = ''
+            chars.append(char)
+        idx += 1
+    return ''.join(chars)
+
+
+def _repo_meta(cwd=None):
+    try:
+        return RepoMeta(cwd)
+    except (GitMetaError, OSError):
+        return None
+
+
+def current_branch(cwd=None):
+    """
+    Equivalent of ``git rev-parse --abbrev-ref HEAD``.
+
+    Returns:
+        str
+    """
+    meta = _repo_meta(cwd)
+    if meta is not None:
+        try:
+            return meta.branch
+        except (GitMetaError, OSError):
+            pass
+    return ub.cmd('git rev-parse --abbrev-ref HEAD', cwd=cwd)['out'].strip()
+
+
+def head_sha(cwd=None):
+    """
+    Equivalent of ``git rev-parse HEAD``.
+
+    Returns:
+        str | None: None if there are no commits
+    """
+    meta = _repo_meta(cwd)
+    if meta is not None:
+        try:
+            return meta.head_sha
+        except (GitMetaError, OSError):
+            pass
+    info = ub.cmd('git rev-parse --verify -q HEAD', cwd=cwd)
+    return info['out'].strip() or None
+
+
+def repo_root(cwd=None):
+    """
+    Equivalent of ``git rev-parse --show-toplevel``.
+
+    Returns:
+        str
+    """
+    meta = _repo_meta(cwd)
+    if meta is not None:
+        return os.fspath(meta.worktree)
+    info = ub.cmd('git rev-parse --show-toplevel', cwd=cwd)
+    if info['ret'] != 0:
+        raise Exception('Not in a git repo: {}'.format(info['err'].strip()))
+    return info['out'].strip()
+
+
+def git_default_push_remote_name(cwd=None):
+    """
+    Find the remote that ``git push`` would use for the current branch.
+
+    Returns:
+        str | None
+    """
+    meta = _repo_meta(cwd)
+    if meta is not None:
+        try:
+            return meta.default_push_remote()
+        except (GitMetaError, OSError):
+            pass
+    local_remotes = ub.cmd('git remote -v', cwd=cwd)['out'].strip()
+    lines = [line for line in local_remotes.split('\n') if line]
+    candidates = []
+    for line in lines:
+        parts = line.split('\t')
+        remote_name, remote_url_type = parts
+        if remote_url_type.endswith('(push)'):
+            candidates.append(remote_name)
+    if len(candidates) == 1 or 'origin' not in candidates:
+        return candidates[0] if candidates else None
+    return 'origin'
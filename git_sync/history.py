@@ -0,0 +1,391 @@
+"""
+An append-only log of every sync and the statistics over it.
+
+Each call of :func:`git_sync.sync_remote.git_sync` (that is not a dry run)
+appends one json line to ``history.jsonl`` in the cache directory with the
+repo, branch, synced commit, the outcome, commits and bytes sent to every
+host, and the duration of every phase. When the log grows past
+:data:`MAX_BYTES` it is rotated to ``history.jsonl.1`` (and so on, keeping
+:data:`KEEP` old files). Set ``GIT_SYNC_HISTORY=0`` to disable the log.
+
+``git-sync stats`` reads the log (oldest first, one line at a time) and
+reports latency percentiles per host and per phase, failure rates and how the
+median sync time of each host changes over time. Percentiles are computed
+from a fixed size random sample per key, so memory does not grow with the
+size of the log.
+"""
+import json
+import os
+import random
+import time
+import ubelt as ub
+from git_sync.cache import cache_dpath
+
+#: The log is rotated before it grows past this many bytes
+MAX_BYTES = 8 * 2 ** 20
+
+#: Number of rotated logs that are kept
+KEEP = 3
+
+#: Number of values kept per key to estimate percentiles
+RESERVOIR_SIZE = 1024
+
+
+def history_enabled():
+    """
+    Returns:
+        bool: False if the environment variable ``GIT_SYNC_HISTORY=0``
+    """
+    flag = os.environ.get('GIT_SYNC_HISTORY', '1').strip().lower()
+    return flag not in {'0', 'false', 'no', 'off'}
+
+
+def history_fpath():
+    return cache_dpath() / 'history.jsonl'
+
+
+def append_entry(entry, fpath=None, max_bytes=MAX_BYTES, keep=KEEP):
+    """
+    Append one entry to the log, rotating it first if it would get too big.
+
+    Example:
+        >>> import ubelt as ub
+        >>> from git_sync.history import append_entry, iter_entries
+        >>> dpath = ub.Path.appdir('git_sync/tests/history').delete().ensuredir()
+        >>> fpath = dpath / 'history.jsonl'
+        >>> for idx in range(5):
+        >>>     append_entry({'idx': idx}, fpath, max_bytes=30, keep=1)
+        >>> [e['idx'] for e in iter_entries(fpath, keep=1)]
+        [2, 3, 4]
+        >>> sorted(p.name for p in dpath.ls())
+        ['history.jsonl', 'history.jsonl.1']
+    """
+    if fpath is None:
+        fpath = history_fpath()
+    fpath = ub.Path(fpath)
+    line = (json.dumps(entry, sort_keys=True) + '\n').encode('utf8')
+    try:
+        size = fpath.stat().st_size
+    except FileNotFoundError:
+        size = 0
+    if size and size + len(line) > max_bytes:
+        _rotate(fpath, keep)
+    # A single write of the whole line in append mode, so lines of
+    # concurrent syncs do not interleave
+    fd = os.open(fpath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def _rotate(fpath, keep):
+    for idx in range(keep, 0, -1):
+        src = fpath if idx == 1 else fpath.with_name(f'{fpath.name}.{idx - 1}')
+        dst = fpath.with_name(f'{fpath.name}.{idx}')
+        if src.exists():
+            os.replace(src, dst)
+    if keep < 1:
+        fpath.unlink()
+
+
+def iter_entries(fpath=None, keep=KEEP, since=None):
+    """
+    Iterate over the logged syncs, oldest first, including rotated logs.
+
+    Args:
+        fpath (PathLike | None): the log, defaults to :func:`history_fpath`
+        keep (int): the number of rotated logs to look for
+        since (float | None): skip entries older than this unix time
+
+    Yields:
+        Dict: one entry per sync. Lines that are not valid json (e.g. cut
+        off by a crash) are skipped.
+    """
+    if fpath is None:
+        fpath = history_fpath()
+    fpath = ub.Path(fpath)
+    fpaths = [fpath.with_name(f'{fpath.name}.{idx}')
+              for idx in range(keep, 0, -1)] + [fpath]
+    for path in fpaths:
+        if not path.exists():
+            continue
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if since is not None and entry.get('time', 0) < since:
+                    continue
+                yield entry
+
+
+def build_entry(start, elapsed, repo, branch, head, results, records,
+                transport='push', commit=True, error=None):
+    """
+    Build the log entry of one sync.
+
+    Args:
+        start (float): unix time the sync started
+        elapsed (float): seconds the sync took
+        repo (str | None): the local repo root
+        branch (str | None): the synced branch
+        head (str | None): the commit the hosts were synced to
+        results (List[Dict] | None): the per host results of the sync
+        records (List[Dict]): the phase records of the sync
+        transport (str): the transport that was used
+        commit (bool): False if the working tree was sent as a diff
+        error (str | None): the error the sync raised, if any
+
+    Returns:
+        Dict
+    """
+    hosts = []
+    for r in results or []:
+        hosts.append(ub.udict(r) & {
+            'host', 'status', 'ret', 'elapsed', 'bytes', 'commits', 'noop',
+            'via', 'post_sync_ret', 'stalled', 'direction'})
+    phases = [
+        ub.udict(r) & {'phase', 'host', 'elapsed', 'status', 'bytes',
+                       'error_class', 'attempt'}
+        for r in records if r.get('elapsed') is not None]
+    if error is not None:
+        status = 'error'
+    elif hosts and all(h['status'] == 'ok' for h in hosts):
+        status = 'ok'
+    else:
+        status = 'failed'
+    return {
+        'time': start,
+        'elapsed': elapsed,
+        'repo': None if repo is None else os.fspath(repo),
+        'branch': branch,
+        'head': head,
+        'transport': transport if commit else 'patch',
+        'status': status,
+        'error': error,
+        'hosts': hosts,
+        'phases': phases,
+    }
+
+
+class Reservoir:
+    """
+    A fixed size uniform random sample of a stream of numbers, used to
+    estimate percentiles.
+
+    Example:
+        >>> from git_sync.history import Reservoir
+        >>> res = Reservoir(size=100)
+        >>> for value in range(1, 10001):
+        >>>     res.add(value)
+        >>> res.count, len(res.values)
+        (10000, 100)
+        >>> small = Reservoir()
+        >>> for value in [5, 1, 3, 2, 4]:
+        >>>     small.add(value)
+        >>> small.percentile(50), small.percentile(99)
+        (3, 5)
+    """
+
+    def __init__(self, size=RESERVOIR_SIZE, seed=0):
+        self.size = size
+        self.count = 0
+        self.values = []
+        self._rng = random.Random(seed)
+
+    def add(self, value):
+        self.count += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            idx = self._rng.randrange(self.count)
+            if idx < self.size:
+                self.values[idx] = value
+
+    def percentile(self, q):
+        """
+        Returns:
+            float | None: the nearest-rank ``q``-th percentile of the sample
+        """
+        if not self.values:
+            return None
+        ordered = sorted(self.values)
+        rank = max(1, int(-(-q * len(ordered) // 100)))
+        return ordered[rank - 1]
+
+
+class SyncStats:
+    """
+    Aggregates log entries one at a time.
+
+    Args:
+        bucket (float): width in seconds of the buckets of the trend
+
+    Example:
+        >>> from git_sync.history import SyncStats
+        >>> stats = SyncStats(bucket=10)
+        >>> for idx in range(6):
+        >>>     stats.add({'time': idx * 5, 'status': 'ok', 'hosts': [
+        >>>         {'host': 'n1', 'status': 'ok', 'elapsed': 1.0 + idx},
+        >>>         {'host': 'n2', 'status': 'failed' if idx % 2 else 'ok', 'elapsed': 2.0}],
+        >>>         'phases': [{'phase': 'push', 'host': None, 'elapsed': 0.5, 'status': 'ok'}]})
+        >>> stats.hosts['n2']['failed']
+        3
+        >>> print(stats.report())  # xdoctest: +IGNORE_WANT
+        6 syncs, 0 failed (0.0%)
+        ...
+    """
+
+    def __init__(self, bucket=86400):
+        self.bucket = bucket
+        self.num_syncs = 0
+        self.num_failed = 0
+        self.first = None
+        self.last = None
+        self.hosts = {}
+        self.phases = {}
+        self.trend = {}
+
+    def _group(self, table, key):
+        if key not in table:
+            table[key] = {'latency': Reservoir(), 'failed': 0, 'bytes': 0}
+        return table[key]
+
+    def add(self, entry):
+        self.num_syncs += 1
+        self.num_failed += entry.get('status') != 'ok'
+        when = entry.get('time', 0)
+        self.first = when if self.first is None else min(self.first, when)
+        self.last = when if self.last is None else max(self.last, when)
+        bucket = int(when // self.bucket)
+        for h in entry.get('hosts', []):
+            group = self._group(self.hosts, h['host'])
+            group['latency'].add(h.get('elapsed') or 0.0)
+            group['failed'] += h.get('status') != 'ok'
+            group['bytes'] += h.get('bytes') or 0
+            if h.get('status') == 'ok' and not h.get('noop'):
+                trend = self.trend.setdefault(h['host'], {})
+                if bucket not in trend:
+                    trend[bucket] = Reservoir(size=128)
+                trend[bucket].add(h.get('elapsed') or 0.0)
+        for p in entry.get('phases', []):
+            group = self._group(self.phases, p['phase'])
+            group['latency'].add(p.get('elapsed') or 0.0)
+            group['failed'] += p.get('status') != 'ok'
+            group['bytes'] += p.get('bytes') or 0
+
+    def to_json(self, num_buckets=7):
+        def summarize(table):
+            rows = {}
+            for key, group in table.items():
+                latency = group['latency']
+                rows[key] = {
+                    'count': latency.count,
+                    'failed': group['failed'],
+                    'failure_rate': group['failed'] / max(latency.count, 1),
+                    'p50': latency.percentile(50),
+                    'p95': latency.percentile(95),
+                    'p99': latency.percentile(99),
+                    'bytes': group['bytes'],
+                }
+            return rows
+        trend = {}
+        for host, buckets in self.trend.items():
+            keys = sorted(buckets)[-num_buckets:]
+            trend[host] = [{'start': key * self.bucket,
+                            'p50': buckets[key].percentile(50),
+                            'count': buckets[key].count} for key in keys]
+        return {
+            'syncs': self.num_syncs,
+            'failed': self.num_failed,
+            'first': self.first,
+            'last': self.last,
+            'hosts': summarize(self.hosts),
+            'phases': summarize(self.phases),
+            'trend': trend,
+        }
+
+    def report(self, num_buckets=7):
+        """
+        Returns:
+            str: the statistics as text tables
+        """
+        from git_sync.sync_remote import _byte_str
+        data = self.to_json(num_buckets=num_buckets)
+        if not data['syncs']:
+            return 'No syncs were recorded'
+        rate = 100.0 * data['failed'] / data['syncs']
+        lines = ['{} syncs, {} failed ({:.1f}%) from {} to {}'.format(
+            data['syncs'], data['failed'], rate,
+            _time_str(data['first']), _time_str(data['last']))]
+
+        def seconds(value):
+            return '-' if value is None else '{:.3f}s'.format(value)
+
+        for title, rows in [('host', data['hosts']), ('phase', data['phases'])]:
+            table = [[title, 'count', 'failed', 'p50', 'p95', 'p99', 'bytes']]
+            for key, row in sorted(rows.items(), key=lambda kv: str(kv[0])):
+                table.append([
+                    str(key), str(row['count']),
+                    '{:.1%}'.format(row['failure_rate']),
+                    seconds(row['p50']), seconds(row['p95']),
+                    seconds(row['p99']), _byte_str(row['bytes']),
+                ])
+            lines += [''] + _format_table(table)
+
+        if data['trend']:
+            starts = sorted({b['start'] for buckets in data['trend'].values()
+                             for b in buckets})[-num_buckets:]
+            table = [['p50 trend'] + [_time_str(s, date_only=self.bucket >= 86400)
+                                      for s in starts]]
+            for host, buckets in sorted(data['trend'].items()):
+                by_start = {b['start']: b['p50'] for b in buckets}
+                table.append([host] + [
+                    seconds(by_start[s]) if s in by_start else '-'
+                    for s in starts])
+            lines += [''] + _format_table(table)
+        return '\n'.join(lines)
+
+
+def _time_str(when, date_only=False):
+    fmt = '%Y-%m-%d' if date_only else '%Y-%m-%d %H:%M'
+    return time.strftime(fmt, time.localtime(when))
+
+
+def _format_table(rows):
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+            for row in rows]
+
+
+def compute_stats(fpath=None, since=None, host=None, repo=None,
+                  bucket=86400):
+    """
+    Stream the log into a :class:`SyncStats`.
+
+    Args:
+        fpath (PathLike | None): the log
+        since (float | None): only use entries newer than this unix time
+        host (str | None): only use this host
+        repo (str | None): only use syncs of this local repo root
+        bucket (float): width in seconds of the trend buckets
+
+    Returns:
+        SyncStats
+    """
+    stats = SyncStats(bucket=bucket)
+    for entry in iter_entries(fpath, since=since):
+        if repo is not None and entry.get('repo') != os.fspath(repo):
+            continue
+        if host is not None:
+            hosts = [h for h in entry.get('hosts', []) if h['host'] == host]
+            if not hosts:
+                continue
+            entry = dict(entry, hosts=hosts, phases=[
+                p for p in entry.get('phases', [])
+                if p.get('host') in {None, host}])
+            entry['status'] = hosts[0]['status']
+        stats.add(entry)
+    return stats
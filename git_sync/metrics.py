@@ -0,0 +1,269 @@
+"""
+Prometheus / OpenMetrics export of the phase instrumentation.
+
+:class:`Metrics` subscribes to the same phase events as ``--profile`` (see
+:mod:`git_sync.profiling`) and aggregates them into:
+
+* ``git_sync_phase_duration_seconds``: a histogram per phase and host
+* ``git_sync_phase_bytes_total``: bytes sent per phase and host
+* ``git_sync_phase_retries_total``: phases that were run again
+* ``git_sync_phase_failures_total``: failed phases per phase, host and error
+  class (e.g. ``push-rejected``, ``ssh-unreachable``, ``remote-dirty``, see
+  :func:`git_sync.profiling.classify_error`)
+
+The metrics can be written to a textfile for the node-exporter textfile
+collector (``--metrics-textfile``). Every run adds to the counts in the file,
+so it holds the totals over all runs. They can also be served on a local
+HTTP endpoint (``--metrics-port``) for as long as git-sync runs, which is
+mostly useful with ``--watch``.
+
+No Prometheus client library is needed.
+"""
+import json
+import os
+import threading
+import ubelt as ub
+from git_sync import profiling
+
+#: Upper bounds in seconds of the duration histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_HELP = {
+    'git_sync_phase_duration_seconds': 'Wall time of a git-sync phase',
+    'git_sync_phase_bytes': 'Bytes sent by a git-sync phase',
+    'git_sync_phase_retries': 'git-sync phases that were retried',
+    'git_sync_phase_failures': 'Failed git-sync phases by error class',
+}
+
+
+class Metrics:
+    """
+    Aggregates phase records into Prometheus metrics.
+
+    Example:
+        >>> from git_sync.metrics import Metrics
+        >>> from git_sync import profiling
+        >>> with Metrics() as metrics:
+        ...     with profiling.phase('push') as record:
+        ...         record['ret'], record['bytes'] = 0, 1024
+        ...     with profiling.phase('sync', 'node1') as record:
+        ...         profiling.record_result(record, {'ret': 255, 'err': ''})
+        >>> text = metrics.render()
+        >>> print(text)  # xdoctest: +IGNORE_WANT
+        # HELP git_sync_phase_duration_seconds Wall time of a git-sync phase
+        # TYPE git_sync_phase_duration_seconds histogram
+        git_sync_phase_duration_seconds_bucket{host="",phase="push",le="0.05"} 1
+        ...
+        >>> assert 'git_sync_phase_bytes_total{host="",phase="push"} 1024' in text
+        >>> assert 'error_class="ssh-unreachable"' in text
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # (phase, host) -> {"buckets": [...], "sum": float, "count": int}
+        self.durations = {}
+        self.bytes = {}
+        self.retries = {}
+        # (phase, host, error_class) -> int
+        self.failures = {}
+
+    def __call__(self, event, record):
+        if event != 'end':
+            return
+        key = (record['phase'], record.get('host') or '')
+        with self._lock:
+            hist = self.durations.get(key)
+            if hist is None:
+                hist = self.durations[key] = {
+                    'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            elapsed = record.get('elapsed') or 0.0
+            for idx, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    hist['buckets'][idx] += 1
+            hist['sum'] += elapsed
+            hist['count'] += 1
+            if record.get('bytes'):
+                self.bytes[key] = self.bytes.get(key, 0) + record['bytes']
+            if (record.get('attempt') or 1) > 1:
+                self.retries[key] = self.retries.get(key, 0) + 1
+            if record.get('status') == 'failed':
+                fkey = key + (record.get('error_class') or 'other',)
+                self.failures[fkey] = self.failures.get(fkey, 0) + 1
+
+    def __enter__(self):
+        profiling.add_hook(self, passive=True)
+        return self
+
+    def __exit__(self, *exc):
+        profiling.remove_hook(self)
+
+    def to_json(self):
+        """
+        Returns:
+            Dict: the state, which :func:`merge` can add to another instance
+        """
+        with self._lock:
+            return {
+                'buckets': list(self.buckets),
+                'durations': [[list(k), v] for k, v in self.durations.items()],
+                'bytes': [[list(k), v] for k, v in self.bytes.items()],
+                'retries': [[list(k), v] for k, v in self.retries.items()],
+                'failures': [[list(k), v] for k, v in self.failures.items()],
+            }
+
+    def merge(self, state):
+        """
+        Add the counts of a state from :func:`to_json`. States with different
+        histogram buckets are ignored.
+        """
+        if tuple(state.get('buckets', ())) != self.buckets:
+            return
+        with self._lock:
+            for key, hist in state['durations']:
+                key = tuple(key)
+                mine = self.durations.setdefault(key, {
+                    'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+                mine['buckets'] = [a + b for a, b in zip(mine['buckets'], hist['buckets'])]
+                mine['sum'] += hist['sum']
+                mine['count'] += hist['count']
+            for attr in ['bytes', 'retries', 'failures']:
+                table = getattr(self, attr)
+                for key, value in state[attr]:
+                    key = tuple(key)
+                    table[key] = table.get(key, 0) + value
+
+    def render(self, openmetrics=False):
+        """
+        Format the metrics in the Prometheus text exposition format, or as
+        OpenMetrics text if ``openmetrics`` is True.
+
+        Returns:
+            str
+        """
+        lines = []
+
+        def family(name, kind, suffix=''):
+            # OpenMetrics names counter families without the _total suffix
+            shown = name if openmetrics else name + suffix
+            lines.append(f'# HELP {shown} {_HELP[name]}')
+            lines.append(f'# TYPE {shown} {kind}')
+
+        with self._lock:
+            name = 'git_sync_phase_duration_seconds'
+            family(name, 'histogram')
+            for (phase, host), hist in sorted(self.durations.items()):
+                labels = _labels(host=host, phase=phase)
+                for bound, count in zip(self.buckets, hist['buckets']):
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        name, labels, _number(bound), count))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                    name, labels, hist['count']))
+                lines.append(f'{name}_sum{{{labels}}} {_number(hist["sum"])}')
+                lines.append(f'{name}_count{{{labels}}} {hist["count"]}')
+            for name, table, keys in [
+                    ('git_sync_phase_bytes', self.bytes, ('phase', 'host')),
+                    ('git_sync_phase_retries', self.retries, ('phase', 'host')),
+                    ('git_sync_phase_failures', self.failures,
+                     ('phase', 'host', 'error_class'))]:
+                family(name, 'counter', '_total')
+                for key, value in sorted(table.items()):
+                    labels = _labels(**dict(zip(keys, key)))
+                    lines.append(f'{name}_total{{{labels}}} {value}')
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, fpath):
+        """
+        Add this run to the totals kept next to ``fpath`` and atomically
+        (re)write ``fpath`` for the node-exporter textfile collector. The
+        totals are kept in ``fpath`` with ``.state.json`` appended, which the
+        collector ignores because it does not end in ``.prom``.
+
+        Example:
+            >>> import ubelt as ub
+            >>> from git_sync.metrics import Metrics
+            >>> dpath = ub.Path.appdir('git_sync/tests/metrics').delete().ensuredir()
+            >>> for _ in range(2):
+            >>>     metrics = Metrics()
+            >>>     metrics('end', {'phase': 'push', 'host': None, 'elapsed': 0.2,
+            >>>                     'status': 'ok', 'bytes': 10})
+            >>>     metrics.write_textfile(dpath / 'git_sync.prom')
+            >>> text = (dpath / 'git_sync.prom').read_text()
+            >>> assert 'git_sync_phase_bytes_total{host="",phase="push"} 20' in text
+            >>> sorted(p.name for p in dpath.ls())
+            ['git_sync.prom', 'git_sync.prom.state.json']
+        """
+        fpath = ub.Path(fpath)
+        state_fpath = fpath.parent / (fpath.name + '.state.json')
+        total = Metrics(self.buckets)
+        if state_fpath.exists():
+            try:
+                total.merge(json.loads(state_fpath.read_text()))
+            except (ValueError, KeyError, TypeError):
+                pass
+        total.merge(self.to_json())
+        _atomic_write(state_fpath, json.dumps(total.to_json()))
+        _atomic_write(fpath, total.render())
+
+    def serve(self, port, addr='127.0.0.1'):
+        """
+        Serve the metrics on ``http://addr:port/metrics`` from a daemon
+        thread.
+
+        Returns:
+            http.server.ThreadingHTTPServer: call ``shutdown()`` to stop it
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in {'/', '/metrics'}:
+                    self.send_error(404)
+                    return
+                accept = self.headers.get('Accept', '')
+                openmetrics = 'application/openmetrics-text' in accept
+                body = metrics.render(openmetrics=openmetrics).encode('utf8')
+                if openmetrics:
+                    ctype = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+                else:
+                    ctype = 'text/plain; version=0.0.4; charset=utf-8'
+                self.send_response(200)
+                self.send_header('Content-Type', ctype)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((addr, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+
+def _labels(**labels):
+    """
+    Example:
+        >>> from git_sync.metrics import _labels
+        >>> print(_labels(host='a"b', phase='push'))
+        host="a\\"b",phase="push"
+    """
+    parts = []
+    for key, value in sorted(labels.items()):
+        value = str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+        parts.append(f'{key}="{value}"')
+    return ','.join(parts)
+
+
+def _number(value):
+    return repr(float(value))
+
+
+def _atomic_write(fpath, text):
+    tmp_fpath = fpath.augment(prefix='.', tail='.tmp')
+    tmp_fpath.write_text(text)
+    os.replace(tmp_fpath, fpath)
@@ -0,0 +1,329 @@
+"""
+Per-phase timing of a sync.
+
+Every phase of :func:`git_sync.sync_remote.git_sync` and
+:func:`git_sync.discover_remote.dvc_discover_ssh_remote` (commit, push, ssh
+connect, remote lookup, the remote sync step, ...) is wrapped in
+:func:`phase`. Each phase produces a record with its name, host, wall time,
+exit code and the number of bytes sent where that is known.
+
+Tools that embed git-sync can subscribe to the start and end of every phase
+with :func:`add_hook`. :class:`Profile` is such a subscriber, which collects
+the records and formats them as the ``--profile`` report.
+
+Example:
+    >>> from git_sync import profiling
+    >>> events = []
+    >>> def hook(event, record):
+    ...     events.append((event, record['phase'], record['host']))
+    >>> profiling.add_hook(hook)
+    >>> with profiling.phase('push') as record:
+    ...     record['ret'] = 0
+    >>> profiling.remove_hook(hook)
+    >>> events
+    [('start', 'push', None), ('end', 'push', None)]
+"""
+import json
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+
+_HOOKS = []
+_PASSIVE = set()
+_HOOKS_LOCK = threading.Lock()
+
+
+def add_hook(func, passive=False):
+    """
+    Subscribe to phase events.
+
+    Args:
+        func (Callable[[str, Dict], None]): called with the event ("start" or
+            "end") and the phase record. The record is shared between both
+            calls. On "end" it has the keys "phase", "host", "start" (unix
+            time), "elapsed" (seconds), "status" (ok or failed), "ret",
+            "bytes" and "error". Hooks may be called from worker threads.
+        passive (bool): only observe. Passive hooks do not make
+            :func:`hooks_active` true, so they do not turn on measurements
+            that change the output of a sync (like push progress).
+
+    Returns:
+        Callable: ``func``, so this can be used as a decorator
+    """
+    with _HOOKS_LOCK:
+        _HOOKS.append(func)
+        if passive:
+            _PASSIVE.add(id(func))
+    return func
+
+
+def remove_hook(func):
+    """
+    Unsubscribe a function registered with :func:`add_hook`.
+    """
+    with _HOOKS_LOCK:
+        if func in _HOOKS:
+            _HOOKS.remove(func)
+        if func not in _HOOKS:
+            _PASSIVE.discard(id(func))
+
+
+def hooks_active():
+    """
+    Returns:
+        bool: True if anything that is not passive is subscribed to phase
+        events
+    """
+    with _HOOKS_LOCK:
+        return any(id(func) not in _PASSIVE for func in _HOOKS)
+
+
+def _emit(event, record):
+    with _HOOKS_LOCK:
+        hooks = list(_HOOKS)
+    for func in hooks:
+        try:
+            func(event, record)
+        except Exception as ex:
+            # A broken subscriber must not break the sync itself
+            warnings.warn(f'git-sync phase hook {func!r} failed: {ex!r}')
+
+
+@contextmanager
+def phase(name, host=None, **extra):
+    """
+    Time a phase and notify the subscribed hooks.
+
+    The body can fill in the "ret" and "bytes" keys of the yielded record. If
+    the body raises, the phase is recorded as failed and the error is
+    re-raised.
+
+    Args:
+        name (str): name of the phase, e.g. "commit" or "sync"
+        host (str | None): the host the phase is for, if any
+        **extra: additional keys for the record
+
+    Yields:
+        Dict: the phase record
+    """
+    record = {
+        'phase': name,
+        'host': host,
+        'start': time.time(),
+        'elapsed': None,
+        'status': None,
+        'ret': None,
+        'bytes': None,
+        'error': None,
+        'error_class': None,
+    }
+    record.update(extra)
+    _emit('start', record)
+    start_time = time.perf_counter()
+    try:
+        yield record
+    except BaseException as ex:
+        record['status'] = 'failed'
+        record['error'] = repr(ex)
+        if record['error_class'] is None:
+            record['error_class'] = classify_error(str(ex))
+        raise
+    finally:
+        record['elapsed'] = time.perf_counter() - start_time
+        if record['status'] is None:
+            ok = record['ret'] in {0, None} and record['error'] is None
+            record['status'] = 'ok' if ok else 'failed'
+        if record['status'] == 'ok':
+            record['error_class'] = None
+        _emit('end', record)
+
+
+#: Patterns in the output of a failed command and the error class they imply,
+#: the first match wins
+ERROR_CLASSES = [
+    ('ssh-unreachable', [
+        'Could not resolve hostname', 'Connection refused',
+        'Connection timed out', 'No route to host', 'Connection closed by',
+        'Connection reset by', 'Host key verification failed',
+        'Permission denied (publickey', 'Network is unreachable']),
+    ('timeout', ['timed out after']),
+    ('remote-dirty', [
+        'would be overwritten', 'not uptodate', 'Your local changes',
+        'uncommitted changes']),
+    ('push-rejected', [
+        '[rejected]', '[remote rejected]', 'failed to push some refs',
+        'non-fast-forward']),
+    ('not-fast-forward', ['Not possible to fast-forward', 'not a fast-forward']),
+    ('repo-missing', [
+        'No such file or directory', "can't cd to", 'not a git repository']),
+]
+
+
+def classify_error(text, ret=None):
+    """
+    Put the output of a failed command into a coarse error class for
+    reporting.
+
+    Args:
+        text (str): the error output
+        ret (int | None): the exit code. ssh exits with 255 if it cannot
+            connect.
+
+    Returns:
+        str: one of the classes in :data:`ERROR_CLASSES` or "other"
+
+    Example:
+        >>> from git_sync.profiling import classify_error
+        >>> classify_error(' ! [rejected]        main -> main (fetch first)')
+        'push-rejected'
+        >>> classify_error('', ret=255)
+        'ssh-unreachable'
+        >>> classify_error('fatal: something else', ret=128)
+        'other'
+    """
+    text = text or ''
+    for name, patterns in ERROR_CLASSES:
+        if any(pattern in text for pattern in patterns):
+            return name
+    if ret == 255:
+        return 'ssh-unreachable'
+    return 'other'
+
+
+def record_result(record, info):
+    """
+    Copy the exit code of a finished command into a phase record and, if it
+    failed, the class of the error.
+
+    Args:
+        record (Dict): the phase record
+        info (Dict): the result of the command with keys "ret" and "err"
+    """
+    record['ret'] = info['ret']
+    if info['ret'] not in {0, None}:
+        record['error_class'] = classify_error(info.get('err', ''), info['ret'])
+
+
+def parse_push_bytes(text):
+    """
+    Extract the size of the pack sent by ``git push`` from its progress
+    output.
+
+    Returns:
+        int | None: None if git did not report it
+
+    Example:
+        >>> from git_sync.profiling import parse_push_bytes
+        >>> parse_push_bytes('Writing objects: 100% (3/3), 290 bytes | 290.00 KiB/s, done.')
+        290
+        >>> parse_push_bytes('Writing objects: 100% (9/9), 1.50 KiB | 1.50 MiB/s, done.')
+        1536
+        >>> parse_push_bytes('Everything up-to-date') is None
+        True
+    """
+    import re
+    units = {'bytes': 1, 'KiB': 2 ** 10, 'MiB': 2 ** 20, 'GiB': 2 ** 30}
+    found = None
+    pattern = r'Writing objects:.*?,\s*([0-9.]+)\s*(bytes|KiB|MiB|GiB)\b'
+    for match in re.finditer(pattern, text):
+        found = int(float(match.group(1)) * units[match.group(2)])
+    return found
+
+
+class Profile:
+    """
+    Collects the records of every finished phase while it is active.
+
+    Args:
+        passive (bool): subscribe as a passive hook (see :func:`add_hook`)
+
+    Example:
+        >>> from git_sync.profiling import Profile, phase
+        >>> with Profile() as profile:
+        ...     with phase('commit') as record:
+        ...         record['ret'] = 0
+        ...     with phase('sync', host='node1') as record:
+        ...         record['ret'], record['bytes'] = 0, 2048
+        >>> [r['phase'] for r in profile.records]
+        ['commit', 'sync']
+        >>> print(profile.table())  # xdoctest: +IGNORE_WANT
+        phase   host   status  ret  elapsed  bytes
+        commit  -      ok      0    0.000s   -
+        sync    node1  ok      0    0.000s   2.0 KB
+        total                       0.000s
+    """
+
+    def __init__(self, passive=False):
+        self.passive = passive
+        self.records = []
+        self._lock = threading.Lock()
+        self._start = None
+        self._stop = None
+
+    def __call__(self, event, record):
+        if event == 'end':
+            with self._lock:
+                self.records.append(dict(record))
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        add_hook(self, passive=self.passive)
+        return self
+
+    def __exit__(self, *exc):
+        remove_hook(self)
+        self._stop = time.perf_counter()
+
+    @property
+    def total(self):
+        """
+        float: wall time while the profile was active
+        """
+        if self._start is None:
+            return 0.0
+        stop = time.perf_counter() if self._stop is None else self._stop
+        return stop - self._start
+
+    def table(self):
+        """
+        Returns:
+            str: the records in start order as a text table
+        """
+        from git_sync.sync_remote import _byte_str
+        header = ['phase', 'host', 'status', 'ret', 'elapsed', 'bytes']
+        rows = []
+        for r in sorted(self.records, key=lambda r: r['start']):
+            rows.append([
+                r['phase'],
+                '-' if r['host'] is None else r['host'],
+                r['status'],
+                '-' if r['ret'] is None else str(r['ret']),
+                '{:.3f}s'.format(r['elapsed']),
+                '-' if r['bytes'] is None else _byte_str(r['bytes']),
+            ])
+        rows.append(['total', '', '', '', '{:.3f}s'.format(self.total), ''])
+        widths = [max(len(row[i]) for row in [header] + rows)
+                  for i in range(len(header))]
+        lines = []
+        for row in [header] + rows:
+            cells = [cell.ljust(width) for cell, width in zip(row, widths)]
+            lines.append('  '.join(cells).rstrip())
+        return '\n'.join(lines)
+
+    def to_json(self):
+        """
+        Returns:
+            Dict: the total time and all phase records
+        """
+        return {
+            'total': self.total,
+            'phases': sorted(self.records, key=lambda r: r['start']),
+        }
+
+    def dump(self, fpath):
+        """
+        Write :func:`to_json` to ``fpath``.
+        """
+        with open(fpath, 'w') as file:
+            json.dump(self.to_json(), file, indent=2)
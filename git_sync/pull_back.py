@@ -0,0 +1,207 @@
+"""
+Syncing in the other direction, from the repo on a host back to the local
+repo.
+
+Pulling back takes one ssh call: the script from
+:func:`build_snapshot_script` commits the uncommitted changes on the host
+onto its branch (without touching its working tree) and points a hidden ref
+at the result. The local repo then fetches that ref over the shared ssh
+connection, which only transfers the objects it is missing, and
+fast-forwards, rebases or merges onto it.
+
+For syncing in both directions, :func:`build_compare_script` reports the HEAD
+of the host, whether it has uncommitted changes and whether it contains the
+local HEAD, without transferring any objects. :func:`decide_direction` then
+picks which way to sync, or reports that both sides have new work.
+"""
+import json
+import shlex
+import ubelt as ub
+
+#: Hidden ref on the host with the snapshot of its branch
+SNAPSHOT_REF = 'refs/git-sync/snapshot'
+
+#: Hidden ref prefix in the local repo for snapshots fetched from hosts
+PULLED_REF = 'refs/git-sync/pulled'
+
+#: Ways to resolve local and host changes that diverged
+DIVERGE_POLICIES = ('refuse', 'rebase', 'merge')
+
+
+def build_snapshot_script(remote_cwd, branch, message='wip [skip ci]',
+                          include_untracked=False):
+    """
+    Build the script run on the host that commits its uncommitted changes on
+    ``branch`` and points :data:`SNAPSHOT_REF` at the branch.
+
+    The commit is written from a temporary index, so the working tree is not
+    touched. Afterwards the real index matches the commit, so the host has
+    no uncommitted changes.
+
+    Args:
+        remote_cwd (str): the repo directory on the host
+        branch (str): the branch the host must have checked out
+        message (str): message of the commit
+        include_untracked (bool): also commit untracked files that are not
+            ignored
+
+    Example:
+        >>> from git_sync.pull_back import build_snapshot_script
+        >>> script = build_snapshot_script('code/repo', 'main')
+        >>> assert 'git add -u' in script
+        >>> assert 'refs/git-sync/snapshot/main' in script
+    """
+    branch_q = shlex.quote(branch)
+    script = ub.codeblock(
+        r'''
+        set -e
+        cd {remote_cwd}
+        branch=$(git symbolic-ref -q --short HEAD || echo HEAD)
+        if [ "$branch" != {branch_q} ]; then
+            echo "git-sync: the host has $branch checked out instead of "{branch_q} >&2
+            exit 5
+        fi
+        head=$(git rev-parse --verify HEAD)
+        index=$(git rev-parse --git-path index)
+        tmpdir=$(mktemp -d "${{TMPDIR:-/tmp}}/git-sync-XXXXXX")
+        trap 'rm -rf "$tmpdir"' EXIT
+        if [ -f "$index" ]; then cp "$index" "$tmpdir/index"; fi
+        GIT_INDEX_FILE="$tmpdir/index" git add {add_flag}
+        tree=$(GIT_INDEX_FILE="$tmpdir/index" git write-tree)
+        commit=$head
+        if [ "$tree" != "$(git rev-parse "$head^{{tree}}")" ]; then
+            commit=$(printf '%s\n' {message} | git commit-tree "$tree" -p "$head")
+            git update-ref -m "git-sync: pull back" refs/heads/{branch_q} "$commit" "$head"
+            git read-tree "$commit"
+            git update-index -q --refresh >/dev/null || true
+        fi
+        git update-ref {snapshot_ref} "$commit"
+        echo "git-sync-snapshot $head $commit $(git rev-parse --show-toplevel)"
+        ''').format(
+            remote_cwd=shlex.quote(str(remote_cwd)), branch_q=branch_q,
+            add_flag='-A' if include_untracked else '-u',
+            message=shlex.quote(message),
+            snapshot_ref=shlex.quote(f'{SNAPSHOT_REF}/{branch}'))
+    return script + '\n'
+
+
+def parse_snapshot_output(text):
+    """
+    Returns:
+        Dict: with keys "head" (the commit the host had checked out),
+        "commit" (the snapshot, equal to "head" if the host had no changes)
+        and "root" (the top level directory of the repo on the host)
+
+    Example:
+        >>> from git_sync.pull_back import parse_snapshot_output
+        >>> parse_snapshot_output('motd' + chr(10) + 'git-sync-snapshot aaa bbb /home/u/my repo')
+        {'head': 'aaa', 'commit': 'bbb', 'root': '/home/u/my repo'}
+    """
+    for line in reversed(text.splitlines()):
+        parts = line.split(' ', 3)
+        if len(parts) == 4 and parts[0] == 'git-sync-snapshot':
+            return {'head': parts[1], 'commit': parts[2], 'root': parts[3]}
+    raise ValueError('The host did not report a snapshot of its repo')
+
+
+def build_compare_script(remote_cwd, local_head):
+    """
+    Build the script run on the host that prints its HEAD, branch, number of
+    uncommitted changes and whether HEAD contains ``local_head`` as one line
+    of json.
+
+    Example:
+        >>> from git_sync.pull_back import build_compare_script
+        >>> script = build_compare_script('code/repo', 'abc123')
+        >>> assert 'merge-base --is-ancestor abc123 HEAD' in script
+    """
+    script = ub.codeblock(
+        r'''
+        cd {remote_cwd} || exit 3
+        head=$(git rev-parse --verify -q HEAD)
+        branch=$(git symbolic-ref -q --short HEAD || echo HEAD)
+        git update-index -q --refresh >/dev/null 2>&1
+        dirty=$(git diff --name-only HEAD -- 2>/dev/null | grep -c '' || true)
+        if ! git cat-file -e {local_head}^{{commit}} 2>/dev/null; then
+            contains=null
+        elif git merge-base --is-ancestor {local_head} HEAD 2>/dev/null; then
+            contains=true
+        else
+            contains=false
+        fi
+        printf '{{"head": "%s", "branch": "%s", "dirty": %s, "contains_local": %s}}\n' \
+            "$head" "$branch" "${{dirty:-0}}" "$contains"
+        ''').format(remote_cwd=shlex.quote(str(remote_cwd)),
+                    local_head=shlex.quote(local_head))
+    return script + '\n'
+
+
+def parse_compare_output(text):
+    """
+    Example:
+        >>> from git_sync.pull_back import parse_compare_output
+        >>> parse_compare_output('{"head": "aaa", "branch": "main", "dirty": 0, "contains_local": true}')
+        {'head': 'aaa', 'branch': 'main', 'dirty': 0, 'contains_local': True}
+    """
+    for line in reversed(text.splitlines()):
+        line = line.strip()
+        if line.startswith('{'):
+            return json.loads(line)
+    raise ValueError('The host did not report the state of its repo')
+
+
+def decide_direction(state, branch, local_head, local_dirty, local_contains):
+    """
+    Decide which way to sync from the state of both repos.
+
+    Args:
+        state (Dict): the output of :func:`build_compare_script`
+        branch (str): the local branch
+        local_head (str): the local HEAD
+        local_dirty (bool): the local repo has uncommitted changes
+        local_contains (bool): the local HEAD contains the HEAD of the host
+
+    Returns:
+        Dict: with keys "action" (one of "noop", "push", "pull", "diverged"
+        or "abort") and "reason"
+
+    Example:
+        >>> from git_sync.pull_back import decide_direction
+        >>> state = {'head': 'aaa', 'branch': 'main', 'dirty': 0, 'contains_local': True}
+        >>> decide_direction(state, 'main', 'aaa', False, True)['action']
+        'noop'
+        >>> decide_direction(state, 'main', 'aaa', True, True)['action']
+        'push'
+        >>> decide_direction(dict(state, head='bbb'), 'main', 'aaa', False, False)['action']
+        'pull'
+        >>> decide_direction(dict(state, dirty=2), 'main', 'aaa', True, True)['action']
+        'diverged'
+    """
+    if state.get('branch') != branch:
+        return {'action': 'abort', 'reason': (
+            f'the host has {state.get("branch")!r} checked out instead of '
+            f'{branch!r}')}
+    host_head = state.get('head')
+    host_new = bool(state.get('dirty')) or (
+        host_head != local_head and not local_contains)
+    local_new = local_dirty or (
+        host_head != local_head and not state.get('contains_local'))
+    if host_new and local_new:
+        return {'action': 'diverged', 'reason': (
+            'both the local repo and the host have changes the other does '
+            'not have')}
+    if host_new:
+        return {'action': 'pull', 'reason': 'only the host has new changes'}
+    if local_new:
+        return {'action': 'push', 'reason': 'only the local repo has new changes'}
+    return {'action': 'noop', 'reason': f'both at {local_head[:8]}'}
+
+
+def pulled_ref(host, branch):
+    """
+    Example:
+        >>> from git_sync.pull_back import pulled_ref
+        >>> pulled_ref('user@node1', 'main')
+        'refs/git-sync/pulled/user@node1/main'
+    """
+    return f'{PULLED_REF}/{host}/{branch}'
@@ -0,0 +1,152 @@
+"""
+Relay (tree) propagation for syncing many hosts.
+
+Instead of every host getting the new commits from the local machine or the
+central remote, only the first tier of hosts does. Each synced host then
+pushes the commits on to the hosts below it in the tree, so the upstream
+bandwidth is spent once per tier-one host and the rest of the transfer stays
+inside the cluster. Hosts are attached below a host on the same subnet when
+one has room, which keeps most hops local.
+
+The relay hops are driven from the local machine: for each edge it runs
+``git push`` on the parent (over ssh) into a hidden ref of the child's repo,
+then moves the child's branch like the bundle transport does. Every hop is
+reported back as the result of the child host. The parent must be able to
+reach the child by the host name that was given to git-sync.
+"""
+import ipaddress
+import shlex
+import socket
+import ubelt as ub
+
+#: Prefix lengths that define "the same subnet"
+IPV4_PREFIX = 24
+IPV6_PREFIX = 64
+
+
+def host_subnet(host):
+    """
+    Find the subnet of a host, resolving ssh aliases with ``ssh -G``.
+
+    Args:
+        host (str): ssh destination, e.g. ``user@node1``
+
+    Returns:
+        str | None: the network in CIDR notation, or None if the host cannot
+        be resolved
+
+    Example:
+        >>> from git_sync.relay import host_subnet
+        >>> host_subnet('user@127.0.0.5')
+        '127.0.0.0/24'
+    """
+    hostname = host.rsplit('@', 1)[-1]
+    try:
+        address = ipaddress.ip_address(hostname)
+    except ValueError:
+        info = ub.cmd(['ssh', '-G', host])
+        if info['ret'] == 0:
+            for line in info['out'].splitlines():
+                key, _, value = line.partition(' ')
+                if key == 'hostname' and value.strip():
+                    hostname = value.strip()
+                    break
+        try:
+            address = ipaddress.ip_address(
+                socket.getaddrinfo(hostname, None)[0][4][0])
+        except (OSError, ValueError, IndexError):
+            return None
+    prefix = IPV4_PREFIX if address.version == 4 else IPV6_PREFIX
+    return str(ipaddress.ip_network(f'{address}/{prefix}', strict=False))
+
+
+def build_relay_tree(hosts, fanout, subnets=None):
+    """
+    Arrange hosts into a tree where every node (including the local machine
+    at the root) has at most ``fanout`` children.
+
+    The first host of every subnet is attached as high in the tree as
+    possible so each subnet is seeded early. Every other host goes below the
+    shallowest host on its own subnet that has room, falling back to the
+    shallowest host anywhere.
+
+    Args:
+        hosts (List[str]): hosts in the given order
+        fanout (int): the maximum number of hosts a host forwards to
+        subnets (Dict[str, str | None] | None): the subnet of each host. Hosts
+            without one are only grouped with each other by being attached
+            anywhere.
+
+    Returns:
+        Dict[str, str | None]: the parent of each host, None for the hosts
+        updated directly
+
+    Example:
+        >>> from git_sync.relay import build_relay_tree
+        >>> hosts = ['a1', 'a2', 'a3', 'b1', 'b2', 'b3']
+        >>> subnets = {h: h[0] for h in hosts}
+        >>> tree = build_relay_tree(hosts, 2, subnets)
+        >>> tree
+        {'a1': None, 'b1': None, 'a2': 'a1', 'a3': 'a1', 'b2': 'b1', 'b3': 'b1'}
+        >>> build_relay_tree(['n1', 'n2', 'n3', 'n4'], 1)
+        {'n1': None, 'n2': 'n1', 'n3': 'n2', 'n4': 'n3'}
+    """
+    if fanout < 1:
+        raise ValueError('The relay fan-out must be at least 1')
+    subnets = subnets or {}
+    seeds = []
+    seen = set()
+    for host in hosts:
+        subnet = subnets.get(host)
+        if subnet is not None and subnet not in seen:
+            seen.add(subnet)
+            seeds.append(host)
+    order = seeds + [h for h in hosts if h not in seeds]
+
+    parents = {}
+    depth = {None: 0}
+    num_children = {None: 0}
+    for host in order:
+        subnet = subnets.get(host)
+        open_nodes = [n for n in parents if num_children[n] < fanout]
+        local = [n for n in open_nodes
+                 if subnet is not None and subnets.get(n) == subnet]
+        if local:
+            parent = min(local, key=depth.__getitem__)
+        elif num_children[None] < fanout:
+            parent = None
+        else:
+            parent = min(open_nodes, key=depth.__getitem__)
+        parents[host] = parent
+        depth[host] = depth[parent] + 1
+        num_children[parent] += 1
+        num_children[host] = 0
+    return parents
+
+
+def build_hop_script(parent_cwd, child, child_cwd, branch, target,
+                     progress=False):
+    """
+    Build the script run on the parent that pushes ``target`` into a hidden
+    ref of the repo on ``child``.
+
+    Example:
+        >>> from git_sync.relay import build_hop_script
+        >>> print(build_hop_script('code/repo', 'node2', 'code/repo', 'main', 'abc123'))
+        set -e
+        cd code/repo
+        GIT_SSH_COMMAND="${GIT_SSH_COMMAND:-ssh -o BatchMode=yes}" git push -q --force node2:code/repo abc123:refs/git-sync/incoming/main
+    """
+    url = f'{child}:{child_cwd}'
+    push = ['git', 'push', '-q', '--force']
+    if progress:
+        push.append('--progress')
+    push += [url, f'{target}:refs/git-sync/incoming/{branch}']
+    lines = [
+        'set -e',
+        f'cd {shlex.quote(str(parent_cwd))}',
+        # Never wait for a password or host key prompt on the parent
+        'GIT_SSH_COMMAND="${GIT_SSH_COMMAND:-ssh -o BatchMode=yes}" ' +
+        ' '.join(shlex.quote(p) for p in push),
+    ]
+    return '\n'.join(lines) + '\n'
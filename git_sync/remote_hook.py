@@ -0,0 +1,241 @@
+"""
+Hooks that turn a push into a host's repo into the whole sync.
+
+``git-sync install-hook HOST`` installs hooks in the repo on the host:
+
+* ``push-to-checkout`` updates the working tree when the checked out branch
+  is pushed. The mode is sent with the push as the push option
+  ``git-sync.mode``: ``ff`` (the default) moves the tree like
+  ``receive.denyCurrentBranch=updateInstead`` does and refuses the push if it
+  would overwrite local changes, ``force`` discards local changes. git only
+  exposes push options to the receive hooks, so a ``pre-receive`` hook hands
+  the mode over in ``$GIT_DIR/git-sync-mode``.
+* ``post-receive`` runs the post-sync command (e.g. to restart a service) in
+  the working tree. That is the push option ``git-sync.postSync`` if one is
+  sent (an empty one runs nothing), otherwise the command configured on the
+  host as ``git-sync.postSync``. Its output and exit code are streamed back
+  to the pushing side by git.
+
+Once the hook is installed (which the snapshot of the host reports, see
+:func:`hook_active`), syncing with the host as the git remote is a single
+``git push`` and the ssh step is skipped.
+"""
+import shlex
+import ubelt as ub
+from git_sync import ssh_control
+
+#: Marks hooks written by git-sync, which may be overwritten
+HOOK_MARKER = '# Installed by git-sync'
+
+PRE_RECEIVE_HOOK = ub.codeblock(
+    r'''
+    #!/bin/sh
+    # Installed by git-sync: pass the sync mode to push-to-checkout, which
+    # does not see the push options.
+    mode=ff
+    i=0
+    while [ "$i" -lt "${GIT_PUSH_OPTION_COUNT:-0}" ]; do
+        eval "opt=\$GIT_PUSH_OPTION_$i"
+        case "$opt" in
+            git-sync.mode=*) mode=${opt#git-sync.mode=} ;;
+        esac
+        i=$((i + 1))
+    done
+    echo "$mode" > "$GIT_DIR/git-sync-mode"
+    ''')
+
+PUSH_TO_CHECKOUT_HOOK = ub.codeblock(
+    r'''
+    #!/bin/sh
+    # Installed by git-sync: update the working tree to the pushed commit.
+    mode=$(cat "$GIT_DIR/git-sync-mode" 2>/dev/null)
+    rm -f "$GIT_DIR/git-sync-mode"
+    if [ "$mode" = force ]; then
+        git read-tree --reset -u "$1"
+    else
+        # Stat-only changes must not count as local changes
+        git update-index -q --refresh >/dev/null 2>&1
+        git read-tree -u -m HEAD "$1"
+    fi
+    ''')
+
+POST_RECEIVE_HOOK = ub.codeblock(
+    r'''
+    #!/bin/sh
+    # Installed by git-sync: run the post-sync command after the checked out
+    # branch was pushed.
+    head=$(git symbolic-ref -q HEAD)
+    updated=no
+    while read -r old new ref; do
+        if [ "$ref" = "$head" ]; then
+            updated=yes
+        fi
+    done
+    command=$(git config git-sync.postSync)
+    i=0
+    while [ "$i" -lt "${GIT_PUSH_OPTION_COUNT:-0}" ]; do
+        eval "opt=\$GIT_PUSH_OPTION_$i"
+        case "$opt" in
+            git-sync.postSync=*) command=${opt#git-sync.postSync=} ;;
+        esac
+        i=$((i + 1))
+    done
+    worktree=$(git config git-sync.worktree)
+    if [ "$updated" = yes ] && [ -n "$command" ] && [ -n "$worktree" ]; then
+        cd "$worktree" || exit 0
+        unset GIT_DIR GIT_QUARANTINE_PATH
+        sh -c "$command"
+        echo "git-sync: post-sync command exited with $?"
+    fi
+    ''')
+
+
+def hook_active(state):
+    """
+    Check if a push into the repo on a host goes through the git-sync hooks.
+
+    Args:
+        state (Dict): the snapshot of the host (see
+            :func:`git_sync.remote_state.parse_state_output`)
+
+    Example:
+        >>> from git_sync.remote_hook import hook_active
+        >>> state = {'hook': True, 'receive': {'advertisePushOptions': 'true'}}
+        >>> hook_active(state)
+        True
+        >>> hook_active(dict(state, receive={'advertisePushOptions': ''}))
+        False
+    """
+    # The mode is sent as a push option, which the host must accept
+    advertise = state.get('receive', {}).get('advertisePushOptions', '')
+    return bool(state.get('hook')) and advertise.lower() in {
+        'true', 'yes', 'on', '1'}
+
+
+def push_options(force=False, post_sync=None):
+    """
+    Args:
+        force (bool): discard local changes on the host
+        post_sync (str | None): the post-sync command the hook runs instead
+            of the one configured on the host. An empty string runs nothing.
+
+    Returns:
+        List[str]: ``git push`` arguments that select the hook mode
+
+    Example:
+        >>> from git_sync.remote_hook import push_options
+        >>> push_options(force=True)
+        ['-o', 'git-sync.mode=force']
+        >>> push_options(post_sync='make test')
+        ['-o', 'git-sync.mode=ff', '-o', 'git-sync.postSync=make test']
+    """
+    options = ['-o', 'git-sync.mode={}'.format('force' if force else 'ff')]
+    if post_sync is not None:
+        options += ['-o', f'git-sync.postSync={post_sync}']
+    return options
+
+
+def build_install_script(remote_cwd, post_sync=None, overwrite=False):
+    """
+    Build the script that installs the hooks in the repo on the host.
+
+    Example:
+        >>> from git_sync.remote_hook import build_install_script
+        >>> script = build_install_script('code/repo', post_sync='make test')
+        >>> assert 'git config git-sync.postSync' in script
+        >>> assert 'receive.advertisePushOptions true' in script
+    """
+    lines = [
+        'set -e',
+        f'cd {shlex.quote(str(remote_cwd))}',
+        'hooks=$(git rev-parse --git-path hooks)',
+        'mkdir -p "$hooks"',
+    ]
+    for name, text in [('pre-receive', PRE_RECEIVE_HOOK),
+                       ('push-to-checkout', PUSH_TO_CHECKOUT_HOOK),
+                       ('post-receive', POST_RECEIVE_HOOK)]:
+        if not overwrite:
+            lines += [
+                f'if [ -e "$hooks/{name}" ] && ! grep -q {shlex.quote(HOOK_MARKER)} "$hooks/{name}"; then',
+                f'    echo "git-sync: $hooks/{name} exists and was not installed by git-sync" >&2',
+                '    exit 3',
+                'fi',
+            ]
+        lines += [
+            f'cat > "$hooks/{name}" <<\'GIT_SYNC_HOOK\'',
+            text,
+            'GIT_SYNC_HOOK',
+            f'chmod +x "$hooks/{name}"',
+        ]
+    lines += [
+        'git config receive.denyCurrentBranch updateInstead',
+        'git config receive.advertisePushOptions true',
+        'git config git-sync.worktree "$(git rev-parse --show-toplevel)"',
+    ]
+    if post_sync:
+        lines.append(f'git config git-sync.postSync {shlex.quote(post_sync)}')
+    else:
+        lines.append('git config --unset git-sync.postSync || true')
+    return '\n'.join(lines) + '\n'
+
+
+def install_hook(host, post_sync=None, overwrite=False, forward_ssh_agent=False,
+                 multiplex=True, home=None, dry=False):
+    """
+    Install the git-sync hooks in the repo on ``host`` that corresponds to
+    the current directory, and add ``host`` as a git remote if there is no
+    remote with that name.
+
+    Args:
+        host (str): ssh destination
+        post_sync (str | None): command run on the host after every sync
+        overwrite (bool): replace existing hooks not written by git-sync
+        forward_ssh_agent (bool): forward the ssh agent
+        multiplex (bool): use the managed ssh master connection
+        home (str | None): overwrite the local home directory
+        dry (bool): only print the install script
+
+    Returns:
+        int: the exit code of the install
+    """
+    from os.path import expanduser, relpath
+    from git_sync import gitmeta
+    from git_sync.sync_remote import _RemoteLocator
+    from git_sync.utils import _getcwd
+    cwd = _getcwd()
+    if home is None:
+        home = expanduser('~')
+    ssh_flags = ssh_control.build_ssh_flags(forward_ssh_agent,
+                                            multiplex=multiplex)
+    locator = _RemoteLocator(cwd, relpath(cwd, home), home)
+    remote_cwd = locator.remote_cwd(host, ssh_flags, probe=not dry)
+    script = build_install_script(remote_cwd, post_sync=post_sync,
+                                  overwrite=overwrite)
+    # The remote has to point at the repo, not at the subdirectory of it
+    # this runs in
+    remote_url = '{}:{}'.format(
+        host, locator.remote_root(host, ssh_flags, probe=not dry))
+    meta_remotes = {}
+    try:
+        meta_remotes = gitmeta.RepoMeta(cwd).remotes
+    except (gitmeta.GitMetaError, OSError):
+        pass
+    add_remote = host not in meta_remotes
+    if dry:
+        print(f'# install on {host}:')
+        print(script)
+        if add_remote:
+            print(f'git remote add {host} {remote_url}')
+        return 0
+    ssh_control.ensure_connection(host, forward_ssh_agent=forward_ssh_agent,
+                                  multiplex=multiplex)
+    argv = ssh_control.build_remote_argv(host, script, ssh_flags)
+    info = ub.cmd(argv, verbose=1)
+    if info['ret'] != 0:
+        return info['ret']
+    if add_remote:
+        ub.cmd(['git', 'remote', 'add', host, remote_url], verbose=2,
+               check=True)
+    print(f'Installed the git-sync hooks on {host}. Sync with: '
+          f'git-sync {host} {host}')
+    return 0
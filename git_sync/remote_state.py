@@ -0,0 +1,275 @@
+"""
+A snapshot of the repo on a host, taken in one ssh round trip, and the
+planner that decides what a sync has to do with it.
+
+The snapshot script prints a single line of json with the checked out branch,
+HEAD, branch tips, uncommitted and untracked paths, the configured remotes
+and the receive config. Given the commit the local repo wants the host to
+have, :func:`plan_sync` picks the smallest action: nothing, a fast-forward, a
+hard reset (only when forced) or aborting before any data is pushed.
+"""
+import json
+import shlex
+import ubelt as ub
+from git_sync.remote_hook import HOOK_MARKER
+
+#: At most this many uncommitted / untracked paths are listed in a snapshot
+MAX_PATHS = 100
+
+#: The scripts that report on a host exit with this when the repo directory
+#: does not exist (``cd ... || exit 3``), e.g. because the repo was moved
+REPO_MISSING_RET = 3
+
+
+def build_state_script(remote_cwd):
+    """
+    Build the script run on the host that prints the state of its repo as
+    json.
+
+    Example:
+        >>> from git_sync.remote_state import build_state_script
+        >>> script = build_state_script('code/repo')
+        >>> assert script.startswith('cd code/repo || exit 3')
+    """
+    script = ub.codeblock(
+        r'''
+        cd {remote_cwd} || exit 3
+        q() {{
+            printf '"%s"' "$(printf '%s' "$1" | sed -e 's/\\/\\\\/g' -e 's/"/\\"/g' -e 's/\t/\\t/g')"
+        }}
+        qlist() {{
+            sep=
+            printf '['
+            while IFS= read -r line; do
+                [ -n "$line" ] || continue
+                printf '%s' "$sep"; q "$line"; sep=', '
+            done
+            printf ']'
+        }}
+        count() {{
+            printf '%s' "$1" | grep -c ''
+        }}
+        head=$(git rev-parse --verify -q HEAD)
+        git update-index -q --refresh >/dev/null 2>&1
+        changed=$(git diff -z --name-only HEAD -- 2>/dev/null | tr '\0' '\n')
+        untracked=$(git ls-files -z --others --exclude-standard --directory 2>/dev/null | tr '\0' '\n')
+        printf '{{"head": '
+        if [ -n "$head" ]; then q "$head"; else printf null; fi
+        printf ', "branch": '
+        q "$(git symbolic-ref -q --short HEAD || echo HEAD)"
+        printf ', "bare": %s' "$(git rev-parse --is-bare-repository)"
+        printf ', "dirty": %s, "changed": ' "$(count "$changed")"
+        printf '%s\n' "$changed" | head -n {max_paths} | qlist
+        printf ', "untracked": %s, "untracked_paths": ' "$(count "$untracked")"
+        printf '%s\n' "$untracked" | head -n {max_paths} | qlist
+        printf ', "refs": {{'
+        sep=
+        git for-each-ref --format='%(objectname) %(refname)' refs/heads |
+        while read -r sha ref; do
+            printf '%s' "$sep"; q "$ref"; printf ': '; q "$sha"; sep=', '
+        done
+        printf '}}, "remotes": {{'
+        sep=
+        git config --get-regexp '^remote\..*\.url$' |
+        while read -r key url; do
+            name=${{key#remote.}}
+            printf '%s' "$sep"; q "${{name%.url}}"; printf ': '; q "$url"; sep=', '
+        done
+        printf '}}, "receive": {{"denyCurrentBranch": '
+        q "$(git config receive.denyCurrentBranch)"
+        printf ', "advertisePushOptions": '
+        q "$(git config receive.advertisePushOptions)"
+        printf '}}, "hook": '
+        if grep -qs {marker} "$(git rev-parse --git-path hooks)/push-to-checkout"; then
+            printf true
+        else
+            printf false
+        fi
+        printf '}}\n'
+        ''').format(remote_cwd=shlex.quote(str(remote_cwd)),
+                    max_paths=MAX_PATHS, marker=shlex.quote(HOOK_MARKER))
+    return script
+
+
+def parse_state_output(text):
+    """
+    Parse the output of :func:`build_state_script`. Lines printed before the
+    json (e.g. by a login script) are ignored.
+
+    Returns:
+        Dict: the snapshot, including "head" (the commit checked out or
+        None), "branch" and "refs" (the branch tips by ref name).
+
+    Example:
+        >>> from git_sync.remote_state import parse_state_output
+        >>> text = 'Welcome!' + chr(10) + (
+        >>>     '{"head": "aaa", "branch": "main", "bare": false, "dirty": 0, '
+        >>>     '"changed": [], "untracked": 0, "untracked_paths": [], '
+        >>>     '"refs": {"refs/heads/main": "aaa"}, '
+        >>>     '"remotes": {"origin": "git@host:repo.git"}, '
+        >>>     '"receive": {"denyCurrentBranch": "", "advertisePushOptions": ""}, '
+        >>>     '"hook": false}')
+        >>> state = parse_state_output(text)
+        >>> state['branch'], state['remotes']
+        ('main', {'origin': 'git@host:repo.git'})
+    """
+    for line in reversed(text.splitlines()):
+        line = line.strip()
+        if line.startswith('{'):
+            return json.loads(line)
+    raise ValueError('The host did not report the state of its repo')
+
+
+def build_head_script(remote_cwd):
+    """
+    Build the script run on the host that only prints the commit and branch
+    it has checked out. The no-op fast path needs nothing else, and this is
+    much cheaper than :func:`build_state_script` in a large working tree.
+
+    Example:
+        >>> from git_sync.remote_state import build_head_script
+        >>> script = build_head_script('code/my repo')
+        >>> assert script.startswith("cd 'code/my repo' || exit 3")
+    """
+    script = ub.codeblock(
+        r'''
+        cd {remote_cwd} || exit 3
+        printf 'git-sync-head %s %s\n' "$(git rev-parse --verify -q HEAD || echo -)" "$(git symbolic-ref -q --short HEAD || echo HEAD)"
+        ''').format(remote_cwd=shlex.quote(str(remote_cwd)))
+    return script
+
+
+def parse_head_output(text):
+    """
+    Parse the output of :func:`build_head_script`.
+
+    Returns:
+        Dict: with "head" (None if nothing is checked out) and "branch"
+
+    Example:
+        >>> from git_sync.remote_state import parse_head_output
+        >>> parse_head_output('Welcome!' + chr(10) + 'git-sync-head aaa main')
+        {'head': 'aaa', 'branch': 'main'}
+        >>> parse_head_output('git-sync-head - HEAD')
+        {'head': None, 'branch': 'HEAD'}
+    """
+    for line in reversed(text.splitlines()):
+        parts = line.split()
+        if len(parts) == 3 and parts[0] == 'git-sync-head':
+            head = None if parts[1] == '-' else parts[1]
+            return {'head': head, 'branch': parts[2]}
+    raise ValueError('The host did not report its HEAD')
+
+
+def plan_sync(state, branch, target, force=False, remote=None, direct=False,
+              hook=False, cwd=None):
+    """
+    Decide what a host needs to end up on ``target``.
+
+    Args:
+        state (Dict): the snapshot of the repo on the host
+        branch (str): the local branch that is synced
+        target (str): the commit the host should have checked out
+        force (bool): discard changes and commits on the host
+        remote (str | None): the remote the host pulls from. None if the host
+            does not pull or uses its default upstream.
+        direct (bool): the host is updated by pushing into its repo
+        hook (bool): the git-sync hooks do the update of a direct host
+        cwd (str | None): local repo directory
+
+    Returns:
+        Dict: with keys "action" (one of "noop", "fast-forward", "reset" or
+        "abort"), "reason" and "error_class" (why the sync was aborted, for
+        reporting)
+
+    Example:
+        >>> from git_sync.remote_state import plan_sync
+        >>> state = {'head': 'aaa', 'branch': 'main', 'bare': False,
+        >>>          'dirty': 0, 'changed': [], 'untracked': 0,
+        >>>          'untracked_paths': [], 'refs': {'refs/heads/main': 'aaa'},
+        >>>          'remotes': {'origin': 'url'}, 'receive': {}, 'hook': False}
+        >>> plan_sync(state, 'main', 'aaa')['action']
+        'noop'
+        >>> plan_sync(state, 'main', 'bbb', remote='upstream')['action']
+        'abort'
+        >>> plan_sync(dict(state, branch='dev'), 'main', 'bbb', direct=True)['action']
+        'abort'
+        >>> plan_sync(dict(state, dirty=1), 'main', 'bbb', force=True)['action']
+        'reset'
+    """
+    head = state.get('head')
+    host_branch = state.get('branch')
+    if state.get('bare'):
+        return _plan('abort', 'the repo on the host is bare', 'remote-bare')
+    if not direct and remote and remote not in state.get('remotes', {}):
+        return _plan('abort', f'the repo on the host has no remote {remote!r}',
+                     'remote-misconfigured')
+    if host_branch == branch and head == target and not state.get('dirty'):
+        return _plan('noop', f'already at {target[:8]}')
+    if direct and host_branch != branch:
+        return _plan('abort', (
+            f'the host has {host_branch!r} checked out, pushing only updates '
+            f'the working tree of {branch!r}'), 'remote-wrong-branch')
+    if force:
+        return _plan('reset', 'forced')
+
+    tip = state.get('refs', {}).get(f'refs/heads/{branch}')
+    known = _local_known_commits([head, tip], cwd=cwd)
+    if tip is not None and tip != target:
+        if tip not in known or not _is_ancestor(tip, target, cwd=cwd):
+            return _plan('abort', (
+                f'{branch!r} on the host has commits that are not in the '
+                'local branch, use --force to overwrite them'), 'remote-diverged')
+
+    if state.get('dirty') and direct and not hook:
+        return _plan('abort', (
+            'the host has uncommitted changes, which '
+            'receive.denyCurrentBranch=updateInstead refuses to overwrite. '
+            'Use --force or git-sync install-hook'), 'remote-dirty')
+    if (state.get('dirty') or state.get('untracked')) and head in known:
+        incoming = _changed_paths(head, target, cwd=cwd)
+        conflicts = sorted(_overlap(incoming, state.get('changed', []),
+                                    state.get('untracked_paths', [])))
+        if conflicts:
+            shown = ', '.join(conflicts[:5])
+            if len(conflicts) > 5:
+                shown += ', ...'
+            return _plan('abort', (
+                'the sync would overwrite uncommitted or untracked files on '
+                f'the host: {shown}'), 'remote-dirty')
+    return _plan('fast-forward', f'{(tip or head or "")[:8]} -> {target[:8]}')
+
+
+def _plan(action, reason, error_class=None):
+    return {'action': action, 'reason': reason, 'error_class': error_class}
+
+
+def _local_known_commits(shas, cwd=None):
+    from git_sync.transport import local_known_commits
+    return local_known_commits(shas, cwd=cwd)
+
+
+def _is_ancestor(ancestor, commit, cwd=None):
+    info = ub.cmd(['git', 'merge-base', '--is-ancestor', ancestor, commit],
+                  cwd=cwd)
+    return info['ret'] == 0
+
+
+def _changed_paths(old, new, cwd=None):
+    info = ub.cmd(['git', 'diff', '--name-only', old, new], cwd=cwd)
+    return info['out'].splitlines()
+
+
+def _overlap(incoming, changed, untracked):
+    """
+    Example:
+        >>> from git_sync.remote_state import _overlap
+        >>> sorted(_overlap(['a.py', 'build/x', 'c.py'], ['c.py'], ['build/']))
+        ['build/x', 'c.py']
+    """
+    changed = set(changed)
+    for path in incoming:
+        if path in changed or any(
+                path == u or (u.endswith('/') and path.startswith(u))
+                for u in untracked):
+            yield path
@@ -0,0 +1,362 @@
+"""
+Persistent ssh connections shared by all remote steps.
+
+Each remote action in git-sync is its own ``ssh`` invocation. Instead of
+paying for a new handshake every time, git-sync starts one OpenSSH
+ControlMaster connection per host the first time that host is contacted and
+points every later ``ssh`` (and ``git`` over ssh) at it via ``ControlPath``.
+The master exits on its own after being idle for ``persist`` seconds and all
+masters started by this process are closed when the process exits.
+
+The control sockets live in a private temporary directory and use the ``%C``
+token, so the same options work for every host and can be handed to git via
+``GIT_SSH_COMMAND``. If a master cannot be started, clients silently fall back
+to a direct connection.
+"""
+import atexit
+import os
+import sys
+import threading
+
+
+#: Seconds a master connection is kept alive without any clients
+DEFAULT_PERSIST = 300
+
+
+def multiplex_supported():
+    """
+    Returns:
+        bool: False on platforms where OpenSSH does not support connection
+        sharing, or if the user disabled it by setting the environment
+        variable ``GIT_SYNC_SSH_MULTIPLEX=0``.
+    """
+    if sys.platform.startswith('win32'):
+        return False
+    flag = os.environ.get('GIT_SYNC_SSH_MULTIPLEX', '1').strip().lower()
+    return flag not in {'0', 'false', 'no', 'off'}
+
+
+class SSHMultiplexer:
+    """
+    Lazily starts and tracks one ssh master connection per host.
+
+    Args:
+        persist (int): seconds an idle master stays alive
+
+    Example:
+        >>> from git_sync.ssh_control import SSHMultiplexer
+        >>> mux = SSHMultiplexer(persist=30)
+        >>> opts = mux.client_options()
+        >>> assert opts[0] == '-o ControlMaster=no'
+        >>> assert opts[1].endswith('%C')
+        >>> mux.close_all()
+    """
+
+    def __init__(self, persist=DEFAULT_PERSIST):
+        self.persist = persist
+        self._dpath = None
+        self._started = {}
+        self._lock = threading.Lock()
+        self._host_locks = {}
+
+    @property
+    def control_dpath(self):
+        if self._dpath is None:
+            import tempfile
+            # Keep the path short, unix socket paths are limited to ~100 chars
+            self._dpath = tempfile.mkdtemp(prefix='git-sync-ssh-')
+        return self._dpath
+
+    @property
+    def control_path(self):
+        return os.path.join(self.control_dpath, '%C')
+
+    def client_options(self):
+        """
+        Options that make an ssh client reuse an existing master connection
+        (and connect normally if there is none).
+
+        Returns:
+            List[str]
+        """
+        return [
+            '-o ControlMaster=no',
+            f'-o ControlPath={self.control_path}',
+        ]
+
+    def _host_lock(self, host):
+        with self._lock:
+            if host not in self._host_locks:
+                self._host_locks[host] = threading.Lock()
+            return self._host_locks[host]
+
+    def ensure(self, host, ssh_options=(), timeout=None):
+        """
+        Start the master connection for ``host`` if it is not running.
+
+        Args:
+            host (str): the ssh destination
+            ssh_options (List[str]): extra options for the master (e.g. -A)
+            timeout (float | None): seconds to wait for the master to connect
+                and authenticate
+
+        Returns:
+            bool: True if a master connection is available
+
+        Raises:
+            TimeoutError: if connecting took longer than ``timeout``
+        """
+        import subprocess
+        with self._host_lock(host):
+            if self._started.get(host) and self.check(host):
+                return True
+            command = [
+                'ssh', '-M', '-N', '-f',
+                '-o', f'ControlPath={self.control_path}',
+                '-o', f'ControlPersist={self.persist}',
+                # Keep long lived (e.g. watch mode) masters from being dropped
+                '-o', 'ServerAliveInterval=30',
+            ]
+            for option in ssh_options:
+                command.extend(option.split(' ', 1))
+            command.append(host)
+            try:
+                # The backgrounded master must not hold on to our pipes
+                proc = subprocess.run(command, stdout=subprocess.DEVNULL,
+                                      timeout=timeout)
+            except OSError:
+                return False
+            except subprocess.TimeoutExpired:
+                self._started[host] = False
+                raise TimeoutError(
+                    f'connecting to {host} timed out after {timeout:g}s')
+            ok = proc.returncode == 0
+            self._started[host] = ok
+            return ok
+
+    def check(self, host):
+        """
+        Returns:
+            bool: True if a master for ``host`` is running
+        """
+        import subprocess
+        command = ['ssh', '-O', 'check', '-o',
+                   f'ControlPath={self.control_path}', host]
+        proc = subprocess.run(command, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        return proc.returncode == 0
+
+    def close(self, host):
+        import subprocess
+        command = ['ssh', '-O', 'exit', '-o',
+                   f'ControlPath={self.control_path}', host]
+        subprocess.run(command, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        self._started.pop(host, None)
+
+    def close_all(self):
+        """
+        Stop every master started by this object and remove the socket dir.
+        """
+        for host in list(self._started):
+            if self._started[host]:
+                self.close(host)
+            self._started.pop(host, None)
+        if self._dpath is not None:
+            import shutil
+            shutil.rmtree(self._dpath, ignore_errors=True)
+            self._dpath = None
+
+
+_MULTIPLEXER = None
+
+
+def get_multiplexer():
+    """
+    Returns:
+        SSHMultiplexer | None: the process-wide multiplexer, or None if
+        multiplexing is not supported
+    """
+    global _MULTIPLEXER
+    if not multiplex_supported():
+        return None
+    if _MULTIPLEXER is None:
+        _MULTIPLEXER = SSHMultiplexer()
+        atexit.register(_MULTIPLEXER.close_all)
+    return _MULTIPLEXER
+
+
+def build_ssh_options(forward_ssh_agent=False, connect_timeout=None):
+    """
+    Build the connection options shared by the master and the clients.
+
+    Returns:
+        List[str]
+
+    Example:
+        >>> from git_sync.ssh_control import build_ssh_options
+        >>> build_ssh_options(True, 10)
+        ['-A', '-o ConnectTimeout=10']
+    """
+    ssh_options = []
+    if forward_ssh_agent:
+        ssh_options += ['-A']
+    if connect_timeout is not None:
+        ssh_options += [f'-o ConnectTimeout={connect_timeout}']
+    return ssh_options
+
+
+def build_ssh_flags(forward_ssh_agent=False, connect_timeout=None,
+                    multiplex=True):
+    """
+    Build the flag string inserted after ``ssh`` in remote commands.
+
+    Args:
+        forward_ssh_agent (bool): add ``-A``
+        connect_timeout (int | None): ssh ConnectTimeout in seconds
+        multiplex (bool): reuse the managed master connection
+
+    Returns:
+        str
+
+    Example:
+        >>> from git_sync.ssh_control import build_ssh_flags
+        >>> build_ssh_flags(forward_ssh_agent=True, multiplex=False)
+        '-A'
+    """
+    parts = build_ssh_options(forward_ssh_agent, connect_timeout)
+    mux = get_multiplexer() if multiplex else None
+    if mux is not None:
+        parts += mux.client_options()
+    return ' '.join(parts)
+
+
+def ensure_connection(host, forward_ssh_agent=False, connect_timeout=None,
+                      multiplex=True, timeout=None):
+    """
+    Start the managed master connection to ``host`` if needed. This is a
+    no-op when multiplexing is disabled.
+
+    Raises:
+        TimeoutError: if connecting took longer than ``timeout`` seconds
+    """
+    mux = get_multiplexer() if multiplex else None
+    if mux is None:
+        return False
+    ssh_options = build_ssh_options(forward_ssh_agent, connect_timeout)
+    return mux.ensure(host, ssh_options, timeout=timeout)
+
+
+def git_ssh_env(ssh_flags):
+    """
+    Environment for git commands so that git's own ssh transport reuses the
+    managed connections.
+
+    Args:
+        ssh_flags (str): flags from :func:`build_ssh_flags`
+
+    Returns:
+        Dict[str, str] | None: None if the user already configured
+        ``GIT_SSH_COMMAND`` or there are no flags to add.
+    """
+    if not ssh_flags or 'GIT_SSH_COMMAND' in os.environ:
+        return None
+    env = os.environ.copy()
+    env['GIT_SSH_COMMAND'] = f'ssh {ssh_flags}'
+    return env
+
+
+def build_remote_argv(host, script, ssh_flags='', token=None):
+    """
+    Build an argv that runs a multi-line POSIX shell script on ``host``.
+
+    The script is passed to ``sh -c`` so it does not depend on the login
+    shell of the remote user.
+
+    Args:
+        host (str): the ssh destination
+        script (str): the script
+        ssh_flags (str): flags from :func:`build_ssh_flags`
+        token (str | None): if given, the session can be stopped with
+            :func:`build_stop_script` (see :func:`build_track_command`)
+
+    Returns:
+        List[str]
+
+    Example:
+        >>> from git_sync.ssh_control import build_remote_argv
+        >>> argv = build_remote_argv('host', 'echo "$HOME"', '-A')
+        >>> print(argv[-1])
+        sh -c 'echo "$HOME"'
+    """
+    import shlex
+    if token is not None:
+        # The script runs in its own shell, so its traps do not replace the
+        # one that removes the pid file
+        script = build_track_command(token) + '\nsh -c ' + shlex.quote(script)
+    return ['ssh', *shlex.split(ssh_flags), host, 'sh -c ' + shlex.quote(script)]
+
+
+def new_token():
+    """
+    Returns:
+        str: a random name for a remote session, see
+        :func:`build_track_command`
+    """
+    import uuid
+    return uuid.uuid4().hex[:16]
+
+
+def _pid_fpath(token):
+    return '${TMPDIR:-/tmp}/git-sync-' + token + '.pid'
+
+
+def build_track_command(token):
+    """
+    Build the shell command that starts a remote session which git-sync may
+    have to stop. It records the pid of the session shell, which sshd made
+    the leader of its own process group, under the name ``token``.
+
+    Killing the local ssh client does not stop the commands on the host (e.g.
+    a ``git pull`` waiting for credentials), so on a timeout or Ctrl-C
+    git-sync runs :func:`build_stop_script` in a second session.
+
+    The command contains no double quotes, so it can be put into a double
+    quoted remote command.
+
+    Example:
+        >>> from git_sync.ssh_control import build_track_command
+        >>> print(build_track_command('abc'))
+        echo $$ > ${TMPDIR:-/tmp}/git-sync-abc.pid && trap 'rm -f ${TMPDIR:-/tmp}/git-sync-abc.pid' EXIT
+    """
+    fpath = _pid_fpath(token)
+    return f"echo $$ > {fpath} && trap 'rm -f {fpath}' EXIT"
+
+
+def build_stop_script(token):
+    """
+    Build the script that terminates the process group of the remote session
+    started with :func:`build_track_command`. If the session shell does not
+    lead its own group, it and its children are terminated instead.
+
+    Example:
+        >>> from git_sync.ssh_control import build_stop_script
+        >>> script = build_stop_script('abc')
+        >>> assert 'kill -TERM "-$pid"' in script
+    """
+    import ubelt as ub
+    return ub.codeblock(
+        '''
+        f={fpath}
+        [ -f "$f" ] || exit 0
+        pid=$(cat "$f")
+        rm -f "$f"
+        [ -n "$pid" ] || exit 0
+        if [ "$(ps -o pgid= -p "$pid" 2>/dev/null | tr -d ' ')" = "$pid" ]; then
+            kill -TERM "-$pid" 2>/dev/null
+        else
+            pkill -TERM -P "$pid" 2>/dev/null
+            kill -TERM "$pid" 2>/dev/null
+        fi
+        exit 0
+        ''').format(fpath=_pid_fpath(token)) + '\n'
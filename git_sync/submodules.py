@@ -0,0 +1,145 @@
+"""
+Submodule support for :func:`git_sync.git_sync`.
+
+``git commit -am`` in the superproject only records new submodule commits,
+it does not create or push them. With submodules enabled, git-sync finds the
+submodules that have uncommitted changes or new commits (recursively), commits
+and pushes them depth-first before the superproject (siblings in parallel,
+children before their parent), and the remote step runs ``git submodule
+update`` for only the submodules that changed.
+"""
+import asyncio
+import os
+import shlex
+from git_sync import executor
+from git_sync import profiling
+
+
+def parse_changed_submodules(text):
+    """
+    Find the submodules with new commits or tracked modifications in the
+    output of ``git status --porcelain=v2``.
+
+    Returns:
+        List[str]: submodule paths relative to the repo
+
+    Example:
+        >>> from git_sync.submodules import parse_changed_submodules
+        >>> text = chr(10).join([
+        >>>     '1 .M SC.. 160000 160000 160000 aaa bbb libs/core',
+        >>>     '1 .M S.M. 160000 160000 160000 aaa aaa libs/viz',
+        >>>     '1 .M S..U 160000 160000 160000 aaa aaa libs/untracked-only',
+        >>>     '1 .M N... 100644 100644 100644 aaa bbb README.md',
+        >>> ])
+        >>> parse_changed_submodules(text)
+        ['libs/core', 'libs/viz']
+    """
+    paths = []
+    for line in text.splitlines():
+        if line.startswith('1 '):
+            parts = line.split(' ', 8)
+        elif line.startswith('2 '):
+            parts = line.split(' ', 9)
+            parts[-1] = parts[-1].split('\t')[0]
+        else:
+            continue
+        sub = parts[2]
+        # S<commit changed><tracked changes><untracked changes>
+        if sub.startswith('S') and (sub[1] == 'C' or sub[2] == 'M'):
+            paths.append(parts[-1])
+    return paths
+
+
+async def changed_submodule_tree(root, relpath=''):
+    """
+    Build the tree of changed submodules below ``root``.
+
+    Returns:
+        Dict: with keys "path" (absolute), "relpath" (relative to the
+        top-level repo) and "children" (changed submodules of this repo)
+    """
+    info = await executor.run_command(
+        ['git', 'status', '--porcelain=v2', '--untracked-files=no',
+         '--ignore-submodules=none'], cwd=root)
+    if info['ret'] != 0:
+        raise Exception('Unable to get the status of {}: {}'.format(
+            root, info['err'].strip()))
+    paths = parse_changed_submodules(info['out'])
+    children = await asyncio.gather(*[
+        changed_submodule_tree(os.path.join(root, p),
+                               os.path.join(relpath, p) if relpath else p)
+        for p in paths])
+    return {'path': os.fspath(root), 'relpath': relpath,
+            'children': list(children)}
+
+
+def iter_tree(node):
+    yield node
+    for child in node['children']:
+        yield from iter_tree(child)
+
+
+async def commit_and_push_tree(node, message, force=False, env=None,
+                               verbose=2):
+    """
+    Commit and push every changed submodule in the tree (but not the root),
+    children before their parent and siblings concurrently.
+
+    Returns:
+        bool: True if every submodule was pushed
+    """
+    done = await asyncio.gather(*[
+        _commit_and_push_node(child, message, force, env, verbose)
+        for child in node['children']])
+    return all(done)
+
+
+async def _commit_and_push_node(node, message, force, env, verbose):
+    if not await commit_and_push_tree(node, message, force, env, verbose):
+        return False
+    name = node['relpath']
+    prefix = f'[{name}] '
+    from git_sync import gitmeta
+    branch = await executor.run_blocking(gitmeta.current_branch, node['path'])
+    if branch == 'HEAD':
+        print(f'{prefix}the submodule is on a detached HEAD, check out a '
+              'branch to sync it')
+        return False
+    push_command = ['git', 'push'] + (['--force'] if force else [])
+    for part, command in [('commit', ['git', 'commit', '-am', message]),
+                          ('push', push_command)]:
+        with profiling.phase(part, repo=name) as record:
+            info = await executor.run_command(
+                command, verbose=verbose, prefix=prefix, cwd=node['path'],
+                env=env)
+            profiling.record_result(record, info)
+            if part == 'commit' and info['ret'] == 1:
+                # Nothing to commit, the new commits still need a push
+                record['status'] = 'ok'
+        if info['ret'] != 0 and not (part == 'commit' and info['ret'] == 1):
+            print(f'{prefix}{part} failed')
+            return False
+    return True
+
+
+def build_update_command(paths):
+    """
+    Build the remote command that checks out the recorded commit of only the
+    given submodules (and their nested submodules).
+
+    Args:
+        paths (List[str]): submodule paths relative to the repo root. The
+            command may run in a subdirectory of the repo.
+
+    Example:
+        >>> from git_sync.submodules import build_update_command
+        >>> print(build_update_command(['libs/core', 'my lib']))
+        (cd "$(git rev-parse --show-toplevel)" && git submodule update --init --recursive -- libs/core 'my lib')
+        >>> build_update_command([]) is None
+        True
+    """
+    if not paths:
+        return None
+    quoted = ' '.join(shlex.quote(p) for p in paths)
+    return ('(cd "$(git rev-parse --show-toplevel)" && '
+            f'git submodule update --init --recursive -- {quoted})')
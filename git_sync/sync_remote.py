@@ -2,34 +2,126 @@ from os.path import expanduser
 from os.path import relpath
 import ubelt as ub
 from git_sync.utils import _getcwd
+from git_sync import ssh_control
+from git_sync import gitmeta
+from git_sync.gitmeta import git_default_push_remote_name  # NOQA
 
 
-def git_default_push_remote_name():
-    local_remotes = ub.cmd('git remote -v')['out'].strip()
-    lines = [line for line in local_remotes.split('\n') if line]
-    candidates = []
-    for line in lines:
-        parts = line.split('\t')
-        remote_name, remote_url_type = parts
-        if remote_url_type.endswith('(push)'):
-            candidates.append(remote_name)
-    if len(candidates) == 1:
-        remote_name = candidates[0]
-    return remote_name
+#: Error git reports when pushing to the checked out branch of a non-bare repo
+NON_BARE_ERROR = 'updating the current branch in a non-bare repo'
+
+#: Lets a push into a non-bare repo update its working tree
+DIRECT_PUSH_CONFIG = 'git config --local receive.denyCurrentBranch updateInstead'
+
+#: Printed on the host after the post-sync command, followed by its exit code
+POST_SYNC_MARKER = 'git-sync: post-sync command exited with'
+
+#: Bytes of stdout and stderr of a remote step that are kept in its result
+CAPTURE_LIMIT = 1 << 16
+
+#: The phases that can be given a timeout
+TIMEOUT_PHASES = ('commit', 'push', 'connect', 'sync')
+
+#: Seconds to wait for the processes of a stalled step on a host to be stopped
+STOP_TIMEOUT = 10
+
+
+def resolve_hosts(host):
+    """
+    Expand a host specification into a list of hosts.
+
+    Args:
+        host (str | List[str]):
+            A single host, a comma separated list of hosts, or a list of
+            hosts. Any item of the form ``@groupname`` is replaced by the hosts
+            listed under that group in the host group config file (see
+            :func:`host_groups_fpath`).
+
+    Returns:
+        List[str]: unique hosts in the order they were given
+
+    Example:
+        >>> from git_sync.sync_remote import resolve_hosts
+        >>> resolve_hosts('user@remote.com')
+        ['user@remote.com']
+        >>> resolve_hosts('node1,node2, node1')
+        ['node1', 'node2']
+        >>> resolve_hosts(['node1', 'node3,node2'])
+        ['node1', 'node3', 'node2']
+    """
+    if isinstance(host, str):
+        items = [host]
+    else:
+        items = list(host)
+    hosts = []
+    groups = None
+    for item in items:
+        for part in item.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            if part.startswith('@'):
+                if groups is None:
+                    groups = load_host_groups()
+                group_name = part[1:]
+                if group_name not in groups:
+                    raise KeyError(
+                        'Unknown host group {!r}. Define it in {}'.format(
+                            group_name, host_groups_fpath()))
+                hosts.extend(resolve_hosts(groups[group_name]))
+            else:
+                hosts.append(part)
+    hosts = list(ub.unique(hosts))
+    if len(hosts) == 0:
+        raise ValueError('No hosts were specified')
+    return hosts
+
+
+def host_groups_fpath():
+    """
+    The path to the json file mapping group names to lists of hosts, e.g.
+    ``{"gpu-pool": ["gpu01", "gpu02"]}``.
+    """
+    return ub.Path.appdir('git_sync', type='config') / 'host_groups.json'
+
+
+def load_host_groups():
+    import json
+    fpath = host_groups_fpath()
+    if not fpath.exists():
+        return {}
+    return json.loads(fpath.read_text())
 
 
 def git_sync(host, remote=None, message='wip [skip ci]',
-             forward_ssh_agent=False, dry=False, force=False, home=None):
+             forward_ssh_agent=False, dry=False, force=False, home=None,
+             workers=None, connect_timeout=None, multiplex=True,
+             use_cache=True, transport='push', commit=True,
+             include_untracked=False, submodules=False, fast_path=True,
+             relay=None, post_sync=None, timeout=None, retries=2,
+             resume=True, direction='push', on_diverge=None):
     """
     Commit any changes in the current working directory, ssh into a remote
     machine, and then pull those changes.
 
     Args:
-        host (str):
-            The name of the host to sync to: e.g. user@remote.com
+        host (str | List[str]):
+            The name of the host to sync to: e.g. user@remote.com. Multiple
+            hosts can be given as a list or as a comma separated string, and
+            host groups can be referenced as ``@groupname``. The commit and
+            push happen once and the remote sync step runs on all hosts
+            concurrently.
 
         remote (str):
-            The git remote used to push and pull from
+            The git remote used to push and pull from. If the remote is one of
+            the hosts, the push goes directly into the repo on that host and
+            updates its working tree, so it needs no separate remote step. The
+            first time, the host repo is configured with
+            ``receive.denyCurrentBranch=updateInstead`` (when the snapshot of
+            the host's repo shows it is not set). If the git-sync hooks are
+            installed on the host (see :mod:`git_sync.remote_hook`), they
+            update the tree according to ``force`` and run the post-sync
+            command.
 
         message (str, default='wip [skip ci]'):
             Default git commit message.
@@ -47,6 +139,115 @@ def git_sync(host, remote=None, message='wip [skip ci]',
         home (str | PathLike | None):
             if specified, overwrite where git-sync thinks the home location is
 
+        workers (int | None):
+            The maximum number of hosts to sync at the same time. Defaults to
+            the number of hosts.
+
+        connect_timeout (int | None):
+            Seconds to wait for an ssh connection to be established. Defaults
+            to 10 when syncing to more than one host so an unreachable node
+            fails fast, otherwise the ssh default is used.
+
+        multiplex (bool, default=True):
+            Reuse one managed ssh master connection per host for every remote
+            step (see :mod:`git_sync.ssh_control`).
+
+        use_cache (bool, default=True):
+            Locate the repo on each host using the discovery cache (see
+            :class:`git_sync.cache.DiscoveryCache`), probing the host once on
+            a cache miss. If False, the remote repo is assumed to be at the
+            same location relative to the home directory.
+
+        transport (str, default='push'):
+            How commits reach the hosts. "push" pushes to the git remote and
+            pulls from it on each host. "bundle" skips the central remote and
+            streams a git bundle of only the commits each host is missing
+            over ssh (see :mod:`git_sync.transport`).
+
+        commit (bool, default=True):
+            If False, nothing is committed or pushed. Instead the binary diff
+            between the commit checked out on each host and the local working
+            tree is streamed to the host and applied there, replacing any
+            previous uncommitted state (which is kept as
+            ``refs/git-sync/backup`` on the host). The transport is ignored.
+
+        include_untracked (bool, default=False):
+            When ``commit=False``, also send untracked files that are not
+            ignored.
+
+        submodules (bool, default=False):
+            Also commit and push submodules with changes or new commits
+            (depth-first, see :mod:`git_sync.submodules`) and update only
+            those submodules on the hosts. Requires ``commit=True``.
+
+        fast_path (bool, default=True):
+            If the working tree is clean and the current commit is the one
+            last synced to every host (see :class:`git_sync.cache.SyncState`),
+            only confirm the HEAD of each host over the ssh connection and
+            skip the commit, push and remote step for hosts that match. Does
+            not apply to ``force`` or ``commit=False``.
+
+        relay (int | None):
+            If given, only some hosts get the commits from the local machine
+            (or the central remote), and every synced host pushes them on to
+            at most ``relay`` more hosts, preferring hosts on its own subnet
+            (see :mod:`git_sync.relay`). The results of relayed hosts have
+            the key "via". Requires ``commit=True``.
+
+        post_sync (str | None):
+            A shell command run in the repo on every host right after it was
+            updated, in the same ssh session. Its output is streamed (with a
+            host prefix when there are several hosts) and only the tail is
+            kept in memory. Its exit code is reported as "post_sync_ret" and
+            a nonzero exit fails the host. Hosts that were already up to date
+            do not run it. A host that is pushed into directly runs it in a
+            separate ssh session, or, if the git-sync hooks are installed
+            there, the hooks run it instead of their configured command.
+
+        timeout (float | str | Dict[str, float] | None):
+            Seconds after which a phase is given up: "commit" and "push"
+            (the local git commands), "connect" (connecting to a host and
+            taking the snapshot of its repo) and "sync" (the remote steps on
+            a host). A number applies to every phase, a string looks like
+            "push=60,sync=300". The processes of a stalled phase are killed,
+            on the host as well, and the host result has the phase as
+            "stalled". Other hosts are not held up. No timeout by default.
+
+        retries (int, default=2):
+            How often the push and the remote steps are run again when they
+            failed because of a network problem (e.g. a reset connection or
+            ssh exiting with 255). The delay between attempts grows
+            exponentially and is jittered.
+
+        resume (bool, default=True):
+            Skip the phases that an earlier run for the same commit already
+            completed before it failed: the commit, the push and the hosts
+            that were synced (see :class:`git_sync.cache.SyncJournal`). This
+            only applies when the working tree has no new changes.
+
+        direction (str, default='push'):
+            "push" syncs the local changes to the hosts. "pull" brings the
+            changes made on a single host back: they are committed on the
+            host (``include_untracked`` also adds untracked files) and the
+            local branch is fast-forwarded to that commit, or rebased or
+            merged onto it if it has commits of its own. "both" first
+            compares the HEADs of both sides without transferring anything
+            and then pushes or pulls, whichever is needed. See
+            :mod:`git_sync.pull_back`.
+
+        on_diverge (str | None):
+            What to do when both sides have changes the other does not have:
+            "refuse", "rebase" the local commits onto the ones of the host,
+            or "merge" them. With "both", the result is then pushed to the
+            host. Defaults to "rebase" for "pull" and "refuse" for "both".
+
+    Returns:
+        List[Dict]: one result per host with the keys "host", "status"
+        (ok, failed, skipped or dry), "ret" and "elapsed" (seconds).
+
+    Note:
+        This is a synchronous wrapper around :func:`async_git_sync`.
+
     Example:
         >>> # xdoctest: +IGNORE_WANT
         >>> from git_sync.sync_remote import *  # NOQA
@@ -59,51 +260,959 @@ def git_sync(host, remote=None, message='wip [skip ci]',
         git commit -am "this is the commit message"
         git push origin
         ssh user@remote.com "cd ... && git pull origin ..."
+
+    Example:
+        >>> # xdoctest: +IGNORE_WANT
+        >>> from git_sync.sync_remote import git_sync, _getcwd
+        >>> home = _getcwd()  # pretend the home is here for the test
+        >>> results = git_sync('node1,node2', 'origin', dry=True, home=home)
+        >>> assert [r['host'] for r in results] == ['node1', 'node2']
     """
-    cwd = _getcwd()
-    if home is None:
-        home = expanduser('~')
+    from git_sync import executor
+    return executor.run_sync(async_git_sync(
+        host, remote=remote, message=message,
+        forward_ssh_agent=forward_ssh_agent, dry=dry, force=force, home=home,
+        workers=workers, connect_timeout=connect_timeout,
+        multiplex=multiplex, use_cache=use_cache, transport=transport,
+        commit=commit, include_untracked=include_untracked,
+        submodules=submodules, fast_path=fast_path, relay=relay,
+        post_sync=post_sync, timeout=timeout, retries=retries,
+        resume=resume, direction=direction, on_diverge=on_diverge))
+
+
+async def async_git_sync(host, remote=None, message='wip [skip ci]',
+                         forward_ssh_agent=False, dry=False, force=False,
+                         home=None, workers=None, connect_timeout=None,
+                         multiplex=True, use_cache=True, transport='push',
+                         commit=True, include_untracked=False,
+                         submodules=False, fast_path=True, relay=None,
+                         post_sync=None, timeout=None, retries=2,
+                         resume=True, direction='push', on_diverge=None):
+    """
+    The asyncio implementation of :func:`git_sync`, which takes the same
+    arguments and returns the same results.
+
+    Steps that do not depend on each other overlap. While the local commit
+    runs, the connection to each host is opened, the repo on it is located
+    and a snapshot of its state is taken (see :mod:`git_sync.remote_state`).
+    Before anything is pushed, the snapshots decide what each host needs: a
+    host that is already up to date is skipped, and a host that cannot be
+    synced (e.g. diverged, or uncommitted changes that would be overwritten)
+    fails without its data being sent. The remote steps then run on all
+    hosts at the same time. If the local step fails, the pending host
+    preparation is cancelled.
+
+    Example:
+        >>> # xdoctest: +IGNORE_WANT
+        >>> import asyncio
+        >>> from git_sync.sync_remote import async_git_sync, _getcwd
+        >>> home = _getcwd()  # pretend the home is here for the test
+        >>> results = asyncio.run(async_git_sync('node1', 'origin', dry=True, home=home))
+        >>> assert results[0]['status'] == 'dry'
+    """
+    import functools
+    import time
+    from git_sync import history
+    from git_sync import profiling
+    run = _async_git_sync
+    if direction != 'push':
+        run = functools.partial(_async_sync_back, direction=direction,
+                                on_diverge=on_diverge)
+    kwargs = dict(
+        remote=remote, message=message, forward_ssh_agent=forward_ssh_agent,
+        dry=dry, force=force, home=home, workers=workers,
+        connect_timeout=connect_timeout, multiplex=multiplex,
+        use_cache=use_cache, transport=transport, commit=commit,
+        include_untracked=include_untracked, submodules=submodules,
+        fast_path=fast_path, relay=relay, post_sync=post_sync,
+        timeout=timeout, retries=retries, resume=resume)
+    if dry or not history.history_enabled():
+        return await run(host, **kwargs)
+    # Every sync is appended to the history log (see git_sync.history)
+    start = time.time()
+    results = None
+    error = None
+    with profiling.Profile(passive=True) as profile:
+        try:
+            results = await run(host, **kwargs)
+        except Exception as ex:
+            error = repr(ex)
+            raise
+        finally:
+            try:
+                repo, branch, head = None, None, None
+                repo = gitmeta.repo_root()
+                branch = gitmeta.current_branch()
+                head = gitmeta.head_sha()
+            except Exception:
+                pass
+            entry = history.build_entry(
+                start, profile.total, repo, branch, head, results,
+                profile.records, transport=transport, commit=commit,
+                error=error)
+            try:
+                history.append_entry(entry)
+            except OSError as ex:
+                print(f'git-sync: unable to write the history: {ex}')
+    return results
+
+
+async def _async_git_sync(host, remote=None, message='wip [skip ci]',
+                          forward_ssh_agent=False, dry=False, force=False,
+                          home=None, workers=None, connect_timeout=None,
+                          multiplex=True, use_cache=True, transport='push',
+                          commit=True, include_untracked=False,
+                          submodules=False, fast_path=True, relay=None,
+                          post_sync=None, timeout=None, retries=2,
+                          resume=True):
+    import asyncio
+    import functools
+    import shlex
+    import tempfile
+    import time
+    from git_sync import executor
+    from git_sync import profiling
+    from git_sync.cache import SyncJournal
+    from git_sync.cache import SyncState
+    from git_sync import remote_hook
+    from git_sync import remote_state
+    from git_sync import relay as relay_mod
+    from git_sync import submodules as submodules_mod
+    from git_sync import transport as transport_mod
+    if transport not in {'push', 'bundle'}:
+        raise KeyError(f'Unknown transport={transport!r}')
+    if submodules and not commit:
+        raise ValueError('Submodules can only be synced with commits')
+    if relay is not None and not commit:
+        raise ValueError('Relaying requires commits')
+    timeouts = _phase_timeouts(timeout)
+    hosts = resolve_hosts(host)
+    # Without a discovery cache entry, assume the remote directory is the
+    # same as the local one (relative to home)
+    locator = _make_locator(home, use_cache)
+
+    with profiling.phase('metadata'):
+        # Get branch name from the local
+        local_branch_name = gitmeta.current_branch()
+        if commit and transport == 'bundle' and local_branch_name == 'HEAD':
+            raise ValueError('The bundle transport requires a checked out branch')
+
+        if force and remote is None and transport == 'push':
+            # FIXME: might not work in all cases
+            remote = git_default_push_remote_name()
+
+    # Build one comand to execute locally
+    commit_command = 'git commit -am "{}"'.format(message)
+
+    push_args = ['git push']
+    if remote:
+        push_args.append(f'{remote}')
+    if force:
+        push_args.append('--force')
+    push_command = ' '.join(push_args)
+
+    if (connect_timeout is None and 'connect' not in timeouts and
+            len(hosts) > 1):
+        connect_timeout = 10
+    if workers is None:
+        workers = len(hosts)
+    session = _RemoteSession(
+        locator, timeouts, retries=retries,
+        forward_ssh_agent=forward_ssh_agent, connect_timeout=connect_timeout,
+        multiplex=multiplex, workers=min(workers, len(hosts)))
+    ssh_flags = session.ssh_flags
+
+    local_commands = [
+        ('commit', commit_command),
+        ('push', push_command),
+    ]
+    if not commit:
+        # The working tree diff goes straight to the hosts
+        local_commands = []
+    elif transport == 'bundle':
+        # The bundle goes straight to the hosts, the remote is not used
+        local_commands = local_commands[0:1]
+
+    submodule_tree = None
+    submodule_update = None
+    if submodules:
+        with profiling.phase('submodules'):
+            submodule_tree = await submodules_mod.changed_submodule_tree(
+                await executor.run_blocking(gitmeta.repo_root))
+        submodule_update = submodules_mod.build_update_command(
+            [child['relpath'] for child in submodule_tree['children']])
+
+    post_block = _post_sync_block(post_sync) if post_sync else None
+    # Run on the host after its branch was updated
+    remote_extra = [c for c in [submodule_update, post_block] if c] or None
+
+    def pull_command(host_, remote_cwd, token=None):
+        remote_parts = _build_remote_parts(
+            host_, remote, local_branch_name, force)
+        if submodule_update is not None:
+            remote_parts.append(submodule_update.replace('"', r'\"'))
+        if post_block is not None:
+            remote_parts.append(
+                post_block.replace('\\', '\\\\').replace('"', r'\"'))
+        return _build_remote_command(
+            ' && '.join(remote_parts), remote_cwd, ssh_flags, host_,
+            token=token)
+
+    # Hosts that get the commits from another host instead of from here. The
+    # host that is pushed into directly is always updated from here.
+    relay_parents = {}
+    if relay is not None:
+        tree_hosts = [h for h in hosts if not (transport == 'push' and h == remote)]
+        relay_parents = await _relay_parents(tree_hosts, relay)
+
+    if dry:
+        if submodule_tree is not None:
+            # Children come before their parents in reversed pre-order
+            for node in reversed(list(submodules_mod.iter_tree(submodule_tree))[1:]):
+                print('# commit and push submodule {}'.format(node['relpath']))
+        for part_name, command in local_commands:
+            print(command)
+        for host_ in hosts:
+            remote_cwd = locator.remote_cwd(host_, ssh_flags, probe=False)
+            if (commit and transport == 'push' and host_ != remote and
+                    host_ not in relay_parents):
+                print(pull_command(host_, remote_cwd))
+            else:
+                _print_dry_host(host_, remote_cwd, commit, transport,
+                                relay_parents.get(host_), post_sync)
+        return [{'host': h, 'status': 'dry', 'ret': None, 'elapsed': 0.0}
+                for h in hosts]
+
+    repo_root = gitmeta.repo_root()
+
+    # Pushing into the repo on one of the hosts updates it directly
+    direct_push = commit and transport == 'push' and remote in hosts
+    # Whether the git-sync hooks on that host do the update is read from its
+    # snapshot, which is taken before the push
+    hook_installed = False
+    # The stderr of the push, where git relays the output of the hooks
+    push_output = {'err': ''}
+
+    def direct_post_block():
+        # The hooks run the post-sync command of the directly pushed host,
+        # unless it cannot be sent as a push option
+        if hook_installed and (post_sync is None or '\n' not in post_sync):
+            return None
+        return post_block
+
+    async def install_direct_push(host_):
+        remote_cwd = await session.locate(host_)
+        command = _build_remote_command(
+            DIRECT_PUSH_CONFIG, remote_cwd, ssh_flags, host_)
+        return await executor.run_command(command, verbose=2)
+
+    async def probe_head(host_):
+        # The fast path only needs to know the commit on the host
+        remote_cwd = await session.locate(host_)
+        script = remote_state.build_head_script(remote_cwd)
+        async with session.semaphore:
+            out = await session.query(host_, script, name='probe')
+        return remote_state.parse_head_output(out)
+
+    async def prepare(host_):
+        # Everything about a host that does not depend on the local commit
+        nonlocal hook_installed
+        remote_cwd = await session.locate(host_)
+        async with session.semaphore:
+            script = remote_state.build_state_script(remote_cwd)
+            remote_info = remote_state.parse_state_output(
+                await session.query(host_, script))
+            if direct_push and host_ == remote:
+                hook_installed = remote_hook.hook_active(remote_info)
+            if direct_push and host_ == remote and not hook_installed:
+                receive = remote_info['receive']
+                if receive.get('denyCurrentBranch') != 'updateInstead':
+                    with profiling.phase('install', host_) as record:
+                        info = await install_direct_push(host_)
+                        profiling.record_result(record, info)
+                if force and remote_info['dirty']:
+                    # A forced sync discards changes on the host, which would
+                    # otherwise make updateInstead refuse the push
+                    command = _build_remote_command(
+                        'git reset -q --hard', remote_cwd, ssh_flags, host_)
+                    with profiling.phase('reset', host_) as record:
+                        info = await executor.run_command(command, verbose=2)
+                        profiling.record_result(record, info)
+        return remote_cwd, remote_info
+
+    # No-op fast path: when the tree is clean and every host was last synced
+    # to the current HEAD, the only network traffic is confirming the host
+    # HEADs over the (possibly already open) connection.
+    sync_state = SyncState()
+    journal = SyncJournal()
+    journal_params = {'remote': remote, 'transport': transport, 'force': force}
+    local_head = None
+    noop_candidate = False
+    entry = None
+    if commit:
+        local_head = gitmeta.head_sha()
+    if fast_path and commit and not force and local_head is not None:
+        with profiling.phase('fast-path'):
+            last_heads = [sync_state.last_head(h, repo_root, local_branch_name)
+                          for h in hosts]
+            noop_candidate = all(v == local_head for v in last_heads)
+    # Pick up a sync of the same commit that failed part way
+    if resume and commit and not submodules:
+        entry = journal.lookup(repo_root, local_branch_name)
+        if (entry is None or entry['params'] != journal_params or
+                entry['head'] != local_head):
+            entry = None
+    if noop_candidate or entry is not None:
+        # Both only apply to a clean tree
+        info = await executor.run_command(
+            ['git', 'status', '--porcelain', '--untracked-files=no'])
+        if info['ret'] != 0 or info['out'].strip():
+            noop_candidate = False
+            entry = None
+    resumed = entry
+    resumed_hosts = set()
+    if resumed is not None:
+        resumed_hosts = set(resumed['hosts']) & set(hosts)
+        local_commands = [(name, command) for name, command in local_commands
+                          if name not in resumed['phases']]
+        done = resumed['phases'] + [h for h in hosts if h in resumed_hosts]
+        if resumed_hosts == set(hosts):
+            print('git-sync: {} already synced to {} by an earlier run'.format(
+                ', '.join(hosts), resumed['head'][:8]))
+            # The journal is kept for the hosts of the earlier run that were
+            # not synced
+            for host_ in hosts:
+                sync_state.record(host_, repo_root, local_branch_name,
+                                  resumed['head'])
+            return [{'host': h, 'status': 'ok', 'ret': 0, 'elapsed': 0.0,
+                     'noop': True, 'resumed': True} for h in hosts]
+        if done:
+            print('git-sync: resuming the sync of {}, already done: {}'.format(
+                resumed['head'][:8], ', '.join(done)))
+
+    noop_hosts = set()
+    if noop_candidate:
+        probe_hosts = [h for h in hosts if h not in resumed_hosts]
+        probes = await asyncio.gather(
+            *[probe_head(h) for h in probe_hosts], return_exceptions=True)
+        for host_, probe in zip(probe_hosts, probes):
+            if (isinstance(probe, dict) and probe['head'] == local_head and
+                    probe['branch'] == local_branch_name):
+                noop_hosts.add(host_)
+        if noop_hosts | resumed_hosts == set(hosts):
+            print('git-sync: {} already at {}, nothing to sync'.format(
+                ', '.join(hosts), local_head[:8]))
+            journal.finish(repo_root, local_branch_name)
+            return [{'host': h, 'status': 'ok', 'ret': 0, 'elapsed': 0.0,
+                     'noop': True} for h in hosts]
+
+    # Hosts that were synced by the earlier run or are already up to date
+    # are only contacted if other hosts depend on them
+    prepare_tasks = {
+        h: asyncio.ensure_future(prepare(h)) for h in hosts
+        if h not in resumed_hosts | noop_hosts or h == remote or
+        h in relay_parents.values()}
+
+    if direct_push:
+        # The host must be configured before the push
+        await asyncio.wait([prepare_tasks[remote]])
+
+    async def abort(reason, stalled_phase=None):
+        print('git-sync cannot continue. {}'.format(reason))
+        for task in prepare_tasks.values():
+            task.cancel()
+        await asyncio.gather(*prepare_tasks.values(), return_exceptions=True)
+        results = [{'host': h, 'status': 'skipped', 'ret': None,
+                    'elapsed': 0.0} for h in hosts]
+        if stalled_phase is not None:
+            for result in results:
+                result['stalled'] = stalled_phase
+        return results
+
+    plans = {}
+
+    async def plan_hosts():
+        # Decide what each host needs before any data is sent to it
+        target = await executor.run_blocking(gitmeta.head_sha)
+        if prepare_tasks:
+            await asyncio.wait(list(prepare_tasks.values()))
+        for host_, task in prepare_tasks.items():
+            if task.cancelled() or task.exception() is not None:
+                # Reported by the host task
+                continue
+            direct = direct_push and host_ == remote
+            with profiling.phase('decide', host_) as record:
+                plans[host_] = plan = await executor.run_blocking(
+                    remote_state.plan_sync, task.result()[1],
+                    local_branch_name, target, force=force,
+                    remote=(None if transport == 'bundle' or host_ in relay_parents
+                            else remote),
+                    direct=direct, hook=direct and hook_installed)
+                if plan['action'] == 'abort':
+                    record['status'] = 'failed'
+                    record['error_class'] = plan['error_class']
+                    print('[{}] {}'.format(host_, plan['reason']))
+        if direct_push and plans.get(remote, {}).get('action') == 'abort':
+            # The push itself would be refused
+            return False
+        return not plans or any(p['action'] != 'abort' for p in plans.values())
+
+    if submodule_tree is not None:
+        pushed = await submodules_mod.commit_and_push_tree(
+            submodule_tree, message, force=force, env=session.git_env)
+        if not pushed:
+            return await abort('A submodule could not be synced')
+
+    for part_name, command in local_commands:
+        if part_name == 'push' and not await plan_hosts():
+            return await abort('No host can be synced, nothing was pushed')
+        if part_name == 'push' and hook_installed:
+            # The push options pick the mode of the hooks and the post-sync
+            # command. git refuses options with a newline, such a command
+            # runs over ssh instead.
+            hook_post_sync = post_sync
+            if post_sync is not None and direct_post_block() is not None:
+                hook_post_sync = ''
+            command = command + ' ' + ' '.join(
+                shlex.quote(option) for option in
+                remote_hook.push_options(force, post_sync=hook_post_sync))
+        if part_name == 'push' and profiling.hooks_active():
+            # Make git report the size of the pack it sends
+            command = command + ' --progress'
+
+        def measure(record, result, part_name=part_name):
+            if part_name == 'commit' and result['ret'] == 1:
+                # Nothing to commit
+                record['status'] = 'ok'
+            if part_name == 'push':
+                record['bytes'] = profiling.parse_push_bytes(result['err'])
+
+        result = await session.run_phase(
+            part_name, None, functools.partial(
+                executor.run_command, command, verbose=2, env=session.git_env,
+                timeout=timeouts.get(part_name)),
+            measure=measure)
+        retcode = result['ret']
+        if command.startswith('git commit') and retcode == 1:
+            pass
+        elif retcode != 0:
+            if result['timed_out']:
+                return await abort('The {} timed out after {:g}s'.format(
+                    part_name, timeouts[part_name]), stalled_phase=part_name)
+            if hook_installed and 'does not support push options' in result['err']:
+                return await abort(
+                    'The repo on {} does not accept push options, reinstall '
+                    'the hooks with git-sync install-hook {}'.format(
+                        remote, remote))
+            if part_name == 'push' and NON_BARE_ERROR in result['err']:
+                if direct_push:
+                    # The host lost its receive config since it was queried
+                    with profiling.phase('install', remote) as record:
+                        info = await install_direct_push(remote)
+                        profiling.record_result(record, info)
+                    if info['ret'] == 0:
+                        with profiling.phase(part_name, attempt=2) as record:
+                            result = await executor.run_command(
+                                command, verbose=2, env=session.git_env,
+                                timeout=timeouts.get(part_name))
+                            profiling.record_result(record, result)
+                            record['bytes'] = profiling.parse_push_bytes(
+                                result['err'])
+                        retcode = result['ret']
+                        if retcode == 0:
+                            journal.mark(repo_root, local_branch_name,
+                                         phase=part_name)
+                            continue
+                else:
+                    print(ub.paragraph(
+                        f'''
+                        The push remote {remote!r} is a non-bare repo. Pass
+                        it as one of the hosts to push into it directly, or
+                        run "git config receive.denyCurrentBranch
+                        updateInstead" in that repo.
+                        '''))
+
+            return await abort('retcode={}'.format(retcode))
+        if part_name == 'commit':
+            journal.begin(repo_root, local_branch_name,
+                          await executor.run_blocking(gitmeta.head_sha),
+                          params=journal_params)
+        if part_name == 'push':
+            push_output['err'] = result['err']
+        journal.mark(repo_root, local_branch_name, phase=part_name)
+
+    if commit and transport == 'bundle':
+        if not await plan_hosts():
+            return await abort('No host can be synced')
+
+    patch_tasks = {}
+    bundle_tasks = {}
+    session_dpath = None
+
+    async def relay_hop(host_, remote_cwd, verbose, prefix):
+        # The parent pushes the commits into a hidden ref on this host, then
+        # the branch here is moved like with a bundle
+        parent = relay_parents[host_]
+        parent_cwd = (await prepare_tasks[parent])[0]
+        target = await executor.run_blocking(gitmeta.head_sha)
+        script = relay_mod.build_hop_script(
+            parent_cwd, host_, remote_cwd, local_branch_name, target,
+            progress=profiling.hooks_active())
+        token = ssh_control.new_token()
+        command = session.remote_argv(parent, script, token=token)
+
+        def measure(record, hop):
+            record['bytes'] = profiling.parse_push_bytes(hop['err'])
+
+        async with session.semaphore:
+            hop = await session.run_phase(
+                'relay', host_, lambda: session.run_remote(
+                    host_, command, token, 'sync', ssh_host=parent,
+                    verbose=verbose, prefix=prefix, stdin=b''),
+                measure=measure, prefix=prefix, parent=parent)
+            if hop['ret'] != 0:
+                hop['err'] = 'relay from {} failed: {}'.format(
+                    parent, hop['err'].strip())
+                return hop
+            script = transport_mod.build_apply_script(
+                remote_cwd, local_branch_name, target, force=force,
+                has_bundle=False, extra_commands=remote_extra)
+            info = await session.run_phase(
+                'sync', host_, lambda: session.run_script(
+                    host_, script, 'sync', verbose=verbose, prefix=prefix,
+                    stdin=b'', capture=CAPTURE_LIMIT),
+                prefix=prefix)
+        info['bytes'] = profiling.parse_push_bytes(hop['err'])
+        return info
+
+    async def sync_host(host_, verbose, prefix):
+        nonlocal session_dpath
+        remote_cwd, remote_info = await prepare_tasks[host_]
+        if host_ in relay_parents:
+            return await relay_hop(host_, remote_cwd, verbose, prefix)
+        token = ssh_control.new_token()
+        if direct_push and host_ == remote:
+            # The push already updated the working tree, only the post-sync
+            # command is left to run
+            stdin = b''
+            script = 'cd {} || exit 3\n{}\n'.format(
+                shlex.quote(str(remote_cwd)), direct_post_block())
+            command = session.remote_argv(host_, script, token=token)
+        elif not commit:
+            with profiling.phase('plan', host_):
+                basis = await executor.run_blocking(
+                    transport_mod.patch_basis, host_, remote_info)
+                if basis not in patch_tasks:
+                    # Hosts on the same commit share one diff
+                    patch_tasks[basis] = asyncio.ensure_future(
+                        executor.run_blocking(
+                            transport_mod.working_tree_patch, basis,
+                            include_untracked=include_untracked))
+                stdin = await patch_tasks[basis]
+            script = transport_mod.build_patch_apply_script(remote_cwd, basis)
+            if post_block is not None:
+                script += post_block + '\n'
+            command = session.remote_argv(host_, script, token=token)
+        elif transport == 'bundle':
+            with profiling.phase('plan', host_):
+                producer, script = await executor.run_blocking(
+                    transport_mod.plan_bundle, remote_cwd, remote_info,
+                    local_branch_name, gitmeta.head_sha(), force=force,
+                    extra_commands=remote_extra)
+                stdin = b''
+                if producer is not None:
+                    key = tuple(producer)
+                    if key not in bundle_tasks:
+                        # Hosts with the same basis share one bundle file,
+                        # which is streamed to all of them at the same time
+                        if session_dpath is None:
+                            session_dpath = tempfile.TemporaryDirectory(
+                                prefix='git-sync-bundles-')
+                        bundle_tasks[key] = asyncio.ensure_future(
+                            executor.run_blocking(
+                                transport_mod.write_bundle, producer,
+                                session_dpath.name))
+                    stdin = await bundle_tasks[key]
+            command = session.remote_argv(host_, script, token=token)
+        else:
+            stdin = None
+            command = pull_command(host_, remote_cwd, token=token)
+
+        def measure(record, info):
+            if stdin is not None:
+                record['bytes'] = info['bytes']
+
+        async with session.semaphore:
+            return await session.run_phase(
+                'sync', host_, lambda: session.run_remote(
+                    host_, command, token, 'sync', verbose=verbose,
+                    prefix=prefix, stdin=stdin, capture=CAPTURE_LIMIT),
+                measure=measure, prefix=prefix)
+
+    async def run_host(host_):
+        # A single host streams its output like it always has. With multiple
+        # hosts each line is prefixed with the host it came from.
+        multi = len(hosts) > 1
+        prefix = f'[{host_}] ' if multi else ''
+        verbose = 1 if multi else 2
+        start_time = time.perf_counter()
+        if host_ in resumed_hosts:
+            print('{}already synced to {} by an earlier run'.format(
+                prefix, resumed['head'][:8]))
+            return {'host': host_, 'status': 'ok', 'ret': 0, 'elapsed': 0.0,
+                    'noop': True, 'resumed': True}
+        if host_ in noop_hosts:
+            print(f'{prefix}already at {local_head[:8]}, nothing to sync')
+            return {'host': host_, 'status': 'ok', 'ret': 0, 'elapsed': 0.0,
+                    'noop': True}
+        plan = plans.get(host_, {})
+        if plan.get('action') == 'noop':
+            print('{}{}, nothing to sync'.format(prefix, plan['reason']))
+            return {'host': host_, 'status': 'ok', 'ret': 0, 'elapsed': 0.0,
+                    'noop': True}
+        if plan.get('action') == 'abort':
+            return {'host': host_, 'status': 'failed', 'ret': None,
+                    'elapsed': 0.0, 'err': plan['reason']}
+        if direct_push and host_ == remote and direct_post_block() is None:
+            # The push already updated the working tree on this host, and
+            # git relayed the exit code of a post-sync command run by the
+            # hooks
+            info = {'ret': 0, 'out': '', 'err': ''}
+            post_sync_ret = _parse_post_sync_ret(push_output['err'])
+            if post_sync_ret:
+                info = {'ret': post_sync_ret, 'out': '',
+                        'err': push_output['err']}
+            result = _host_result(host_, info, 0.0)
+            result['direct'] = True
+            if post_sync_ret is not None:
+                result['post_sync_ret'] = post_sync_ret
+            return result
+        parent = relay_parents.get(host_)
+        if parent is not None:
+            if (await host_futures[parent])['status'] != 'ok':
+                print(f'{prefix}not synced because {parent} was not synced')
+                return {'host': host_, 'status': 'skipped', 'ret': None,
+                        'elapsed': 0.0, 'via': parent,
+                        'err': f'relay host {parent} was not synced'}
+            start_time = time.perf_counter()
+        try:
+            info = await sync_host(host_, verbose, prefix)
+        except Exception as ex:
+            # An unexpected error for one host is reported as a failure
+            # instead of aborting the other hosts.
+            print(f'{prefix}{ex}')
+            info = {'ret': None, 'out': '', 'err': str(ex)}
+        elapsed = time.perf_counter() - start_time
+        result = _host_result(host_, info, elapsed)
+        if parent is not None:
+            result['via'] = parent
+        if direct_push and host_ == remote:
+            result['direct'] = True
+        if host_ in session.stalled:
+            result['stalled'] = session.stalled[host_]
+        return result
+
+    async def host_task(host_):
+        # Every host that ends up at the commit is journaled, including the
+        # ones that already were, so a rerun does not contact them again
+        result = await run_host(host_)
+        if commit and result['status'] == 'ok':
+            journal.mark(repo_root, local_branch_name, host=host_)
+        return result
+
+    host_futures = {h: asyncio.ensure_future(host_task(h)) for h in hosts}
+    results = list(await asyncio.gather(*host_futures.values()))
+    if session_dpath is not None:
+        session_dpath.cleanup()
+    synced_head = await executor.run_blocking(gitmeta.head_sha)
+    if commit:
+        await _count_commits(results, prepare_tasks, synced_head)
+    for result in results:
+        if commit and result['status'] == 'ok':
+            sync_state.record(result['host'], repo_root, local_branch_name,
+                              synced_head)
+        else:
+            # Uncommitted changes were sent or the sync failed, the host
+            # state is unknown
+            sync_state.invalidate(result['host'], repo_root,
+                                  local_branch_name)
+    if commit and all(r['status'] == 'ok' for r in results):
+        journal.finish(repo_root, local_branch_name)
+    if len(hosts) > 1:
+        _print_host_report(results)
+    return results
+
+
+async def _async_sync_back(host, direction='pull', on_diverge=None, **kwargs):
+    """
+    Sync the changes on a host back to the local repo (``direction='pull'``)
+    or in whichever direction has new changes (``direction='both'``). The
+    other arguments are the ones of :func:`_async_git_sync`, which syncs in
+    the forward direction.
+
+    See :mod:`git_sync.pull_back` for the scripts that run on the host.
+    """
+    import functools
+    import time
+    from git_sync import executor
+    from git_sync import profiling
+    from git_sync import pull_back
+    from git_sync.cache import SyncState
+    if direction not in {'pull', 'both'}:
+        raise KeyError(f'Unknown direction={direction!r}')
+    if on_diverge is None:
+        on_diverge = 'rebase' if direction == 'pull' else 'refuse'
+    if on_diverge not in pull_back.DIVERGE_POLICIES:
+        raise KeyError(f'Unknown on_diverge={on_diverge!r}')
+    hosts = resolve_hosts(host)
+    if len(hosts) != 1:
+        raise ValueError('Changes can only be synced back from a single host')
+    host_ = hosts[0]
+    timeouts = _phase_timeouts(kwargs['timeout'])
+    locator = _make_locator(kwargs['home'], kwargs['use_cache'])
+
+    with profiling.phase('metadata'):
+        branch = gitmeta.current_branch()
+        local_head = gitmeta.head_sha()
+    if branch == 'HEAD' or local_head is None:
+        raise ValueError('Syncing back requires a checked out branch')
+    ref = pull_back.pulled_ref(host_, branch)
+
+    session = _RemoteSession(
+        locator, timeouts, retries=kwargs['retries'],
+        forward_ssh_agent=kwargs['forward_ssh_agent'],
+        connect_timeout=kwargs['connect_timeout'],
+        multiplex=kwargs['multiplex'])
+
+    if kwargs['dry']:
+        remote_cwd = locator.remote_cwd(host_, session.ssh_flags, probe=False)
+        if direction == 'both':
+            print('# compare {}:{} with {} and sync the side that has new '
+                  'changes'.format(host_, remote_cwd, local_head[:8]))
+        print('# commit the changes on {}:{} and fetch them into {}'.format(
+            host_, remote_cwd, ref))
+        print('# fast-forward {} to {} ({} if they diverged)'.format(
+            branch, ref, on_diverge))
+        return [{'host': host_, 'status': 'dry', 'ret': None, 'elapsed': 0.0}]
+
+    extra = {'direction': 'pull'}
+    # The commit the host is known to be at
+    host_heads = []
+
+    async def sync_back():
+        # Returns the info of the last step, or None if the local changes
+        # are to be synced forward instead
+        remote_cwd = await session.locate(host_)
+
+        if direction == 'both':
+            # Only the HEADs are compared, nothing is transferred yet
+            script = pull_back.build_compare_script(remote_cwd, local_head)
+            state = pull_back.parse_compare_output(
+                await session.query(host_, script))
+            with profiling.phase('decide', host_) as record:
+                local_dirty = not await _tree_clean()
+                local_contains = bool(state['head']) and (
+                    state['head'] == local_head or
+                    await _is_ancestor(state['head'], 'HEAD'))
+                decision = pull_back.decide_direction(
+                    state, branch, local_head, local_dirty, local_contains)
+                action = decision['action']
+                if action == 'abort' or (action == 'diverged' and
+                                         on_diverge == 'refuse'):
+                    record['status'] = 'failed'
+                    record['error_class'] = (
+                        'diverged' if action == 'diverged' else 'remote-branch')
+            print('[{}] {}'.format(host_, decision['reason']))
+            if action == 'noop':
+                extra['noop'] = True
+                host_heads.append(state['head'])
+                return {'ret': 0, 'out': '', 'err': ''}
+            if action == 'push':
+                return None
+            if action == 'abort':
+                return {'ret': 1, 'out': '', 'err': decision['reason']}
+            if action == 'diverged':
+                if on_diverge == 'refuse':
+                    return {'ret': 1, 'out': '', 'err': (
+                        'Nothing was synced because both sides changed. Use '
+                        '--on-diverge rebase or --on-diverge merge to '
+                        'combine them')}
+                extra['direction'] = 'both'
+
+        # One ssh call commits the changes on the host, then the fetch only
+        # transfers the objects that are missing here
+        script = pull_back.build_snapshot_script(
+            remote_cwd, branch, message=kwargs['message'],
+            include_untracked=kwargs['include_untracked'])
+        info = await session.run_phase('snapshot', host_, lambda: (
+            session.run_script(host_, script, 'sync', stdin=b'')))
+        if info['ret'] != 0:
+            return info
+        snapshot = pull_back.parse_snapshot_output(info['out'])
+        host_heads.append(snapshot['commit'])
+        fetch_command = [
+            'git', 'fetch', '-q', '--no-tags',
+            '{}:{}'.format(host_, snapshot['root']),
+            '+{}/{}:{}'.format(pull_back.SNAPSHOT_REF, branch, ref)]
+        info = await session.run_phase('fetch', host_, functools.partial(
+            executor.run_command, fetch_command, verbose=2,
+            env=session.git_env, timeout=timeouts.get('sync')))
+        if info['ret'] != 0:
+            if info['timed_out']:
+                session.stalled.setdefault(host_, 'sync')
+            return info
+
+        with profiling.phase('integrate', host_) as record:
+            commit = snapshot['commit']
+            if await _is_ancestor(commit, 'HEAD'):
+                print('[{}] {} is already contained in {}'.format(
+                    host_, commit[:8], branch))
+                extra['noop'] = True
+                info = {'ret': 0, 'out': '', 'err': ''}
+            elif await _is_ancestor('HEAD', commit):
+                info = await executor.run_command(
+                    ['git', 'merge', '-q', '--ff-only', '--autostash', ref],
+                    verbose=2)
+            elif on_diverge == 'refuse':
+                info = {'ret': 1, 'out': '', 'err': (
+                    'The changes on {} diverged from {}, they are in {}. Use '
+                    '--on-diverge rebase or --on-diverge merge to combine '
+                    'them'.format(host_, branch, ref))}
+            else:
+                if on_diverge == 'rebase':
+                    command = ['git', 'rebase', '-q', '--autostash', ref]
+                else:
+                    command = ['git', 'merge', '-q', '--no-edit',
+                               '--autostash', ref]
+                info = await executor.run_command(command, verbose=2)
+                if info['ret'] != 0:
+                    await executor.run_command(
+                        ['git', on_diverge, '--abort'])
+                    info['err'] += (
+                        'The {} onto {} failed and was undone, the changes '
+                        'of {} are in {}\n'.format(
+                            on_diverge, commit[:8], host_, ref))
+            profiling.record_result(record, info)
+        if info['ret'] == 0 and not extra.get('noop'):
+            count = await executor.run_command(
+                ['git', 'rev-list', '--count', f'{local_head}..HEAD'])
+            if count['ret'] == 0:
+                extra['commits'] = int(count['out'])
+        return info
+
+    start_time = time.perf_counter()
     try:
-        relcwd = relpath(cwd, home)
-    except ValueError:
-        raise ValueError((
-            'git-sync assumes that you are running relative '
-            'to your home directory. cwd={}, home={}').format(cwd, home))
+        info = await sync_back()
+    except Exception as ex:
+        print(f'[{host_}] {ex}')
+        info = {'ret': None, 'out': '', 'err': str(ex)}
+    elapsed = time.perf_counter() - start_time
+    if info is None:
+        results = await _async_git_sync(host_, **kwargs)
+        for result in results:
+            result['direction'] = 'push'
+        return results
+    result = _host_result(host_, info, elapsed)
+    result.update(extra)
+    if host_ in session.stalled:
+        result['stalled'] = session.stalled[host_]
+
+    # The host is at the snapshot, which the fast path can rely on if the
+    # local branch is there as well
+    repo_root = gitmeta.repo_root()
+    head = await executor.run_blocking(gitmeta.head_sha)
+    sync_state = SyncState()
+    if result['status'] == 'ok' and host_heads[-1:] == [head]:
+        sync_state.record(host_, repo_root, branch, head)
+    else:
+        sync_state.invalidate(host_, repo_root, branch)
+
+    if result['status'] == 'ok' and extra['direction'] == 'both':
+        # Both sides had changes: the combined branch goes back to the host
+        results = await _async_git_sync(host_, **kwargs)
+        for forward in results:
+            forward['direction'] = 'both'
+            forward['elapsed'] += elapsed
+        return results
+    return [result]
 
+
+async def _relay_parents(hosts, degree):
     """
-    # How to check if a branch exists
-    git branch --list ${branch}
+    Build the relay tree of the hosts, preferring parents on the same subnet.
 
-    # Get current branch name
+    Returns:
+        Dict[str, str]: the host each host gets the commits from, for the
+        hosts that do not get them from here
+    """
+    import asyncio
+    from git_sync import executor
+    from git_sync import profiling
+    from git_sync import relay as relay_mod
+    with profiling.phase('relay-tree'):
+        subnets = await asyncio.gather(*[
+            executor.run_blocking(relay_mod.host_subnet, h) for h in hosts])
+    tree = relay_mod.build_relay_tree(hosts, degree, dict(zip(hosts, subnets)))
+    return {h: p for h, p in tree.items() if p is not None}
 
-    if [[ "$(git rev-parse --abbrev-ref HEAD)" != "{branch}" ]];
-        then git checkout {branch} ;
-    fi
 
-    # git rev-parse --abbrev-ref HEAD
-    if [[ -z $(git branch --list ${branch}) ]]; then
-    else
-    fi
+def _print_dry_host(host, remote_cwd, commit, transport, parent, post_sync):
     """
+    Print what a sync would do on a host that is not updated with a pull.
 
-    # $(git branch --list ${branch})
+    Example:
+        >>> from git_sync.sync_remote import _print_dry_host
+        >>> _print_dry_host('node1', 'code/repo', True, 'bundle', None, 'make')
+        # stream a bundle of missing commits to node1:code/repo
+        # then run on node1: make
+    """
+    if not commit:
+        print('# stream a working tree diff to {}:{}'.format(host, remote_cwd))
+    elif parent is not None:
+        print('# {} pushes the commits on to {}:{}'.format(
+            parent, host, remote_cwd))
+    elif transport == 'bundle':
+        print('# stream a bundle of missing commits to {}:{}'.format(
+            host, remote_cwd))
+    else:
+        print('# {} is updated by the push (receive.denyCurrentBranch '
+              'updateInstead)'.format(host))
+    if post_sync:
+        print('# then run on {}: {}'.format(host, post_sync))
 
-    # Assume the remote directory is the same as the local one (relative to home)
-    remote_cwd = relcwd
 
-    # Build one command to execute on the remote
-    remote_parts = []
+async def _count_commits(results, prepare_tasks, head):
+    """
+    Add the number of commits each synced host received to its result.
+    """
+    from git_sync import executor
+    counts = {}
+    for result in results:
+        task = prepare_tasks.get(result['host'])
+        if (result['status'] != 'ok' or result.get('noop') or task is None or
+                not task.done() or task.cancelled() or task.exception()):
+            continue
+        before = task.result()[1]['head']
+        if before is None or head is None:
+            continue
+        if before not in counts:
+            info = await executor.run_command(
+                ['git', 'rev-list', '--count', f'{before}..{head}'])
+            counts[before] = int(info['out']) if info['ret'] == 0 else None
+        if counts[before] is not None:
+            result['commits'] = counts[before]
 
-    # Get branch name from the local
-    local_branch_name = ub.cmd('git rev-parse --abbrev-ref HEAD')['out'].strip()
-    # Assume the branches are the same between local / remote
-    remote_branch_name = local_branch_name
 
-    if force:
-        if remote is None:
-            # FIXME: might not work in all cases
-            remote = git_default_push_remote_name()
+def _build_remote_parts(host, remote, branch, force):
+    """
+    Build the shell commands that update the repo on ``host`` to the state of
+    the pushed branch.
 
+    Returns:
+        List[str]: commands to be joined with ``&&`` and run on the host
+    """
+    remote_parts = []
+    if force:
         # Force the remote to the state of the remote
         remote_checkout_branch_force = ub.paragraph(
             '''
@@ -114,11 +1223,11 @@ def git_sync(host, remote=None, message='wip [skip ci]',
             git reset {remote}/{branch} --hard
             ''').format(
                 remote=remote,
-                branch=remote_branch_name
+                branch=branch
             )
 
         remote_parts += [
-            'git fetch {remote}',
+            f'git fetch {remote}',
             remote_checkout_branch_force.replace('"', r'\"'),
         ]
     else:
@@ -130,80 +1239,438 @@ def git_sync(host, remote=None, message='wip [skip ci]',
             if [[ "$(git rev-parse --abbrev-ref HEAD)" != "{branch}" ]]; then
                 git checkout {branch};
             fi
-            ''').format(branch=local_branch_name)
-
-        if remote == host:
-            # If the remote is also the host, then we have to do things
-            # differently.
-            remote_parts += [
-                remote_checkout_branch_simple.replace('"', r'\"'),
-                'git reset --hard HEAD'
-            ]
-        else:
-            remote_parts += [
-                'git pull {remote}' if remote else 'git pull',
-                remote_checkout_branch_simple.replace('"', r'\"'),
-            ]
+            ''').format(branch=branch)
 
-    # Build one comand to execute locally
-    commit_command = 'git commit -am "{}"'.format(message)
+        # (If the remote is the host itself, the push already updated it and
+        # this is not used.)
+        remote_parts += [
+            f'git pull {remote}' if remote else 'git pull',
+            remote_checkout_branch_simple.replace('"', r'\"'),
+        ]
+    return remote_parts
 
-    push_args = ['git push']
-    if remote:
-        push_args.append(f'{remote}')
-    if force:
-        push_args.append('--force')
-    push_command = ' '.join(push_args)
 
-    ssh_flags = []
-    if forward_ssh_agent:
-        ssh_flags += ['-A']
-    ssh_flags = ' '.join(ssh_flags)
+def _host_result(host, info, elapsed):
+    """
+    Summarize the outcome of the remote step on one host.
 
-    sync_command = _build_remote_command(
-        ' && '.join(remote_parts), remote_cwd, ssh_flags, host)
+    Args:
+        host (str): the host
+        info (Dict): the ``ub.cmd``-like result of the remote step
+        elapsed (float): seconds the host took
 
-    local_commands = [
-        ('commit', commit_command),
-        ('push', push_command),
-        ('sync', sync_command),
-    ]
+    Example:
+        >>> from git_sync.sync_remote import _host_result
+        >>> info = {'ret': 0, 'out': '', 'err': '', 'bytes': 10}
+        >>> _host_result('node1', info, 1.5)
+        {'host': 'node1', 'status': 'ok', 'ret': 0, 'elapsed': 1.5, 'err': '', 'bytes': 10}
+    """
+    result = {
+        'host': host,
+        'status': 'ok' if info['ret'] == 0 else 'failed',
+        'ret': info['ret'],
+        'elapsed': elapsed,
+        'err': info['err'],
+    }
+    if info.get('bytes'):
+        result['bytes'] = info['bytes']
+    post_sync_ret = _parse_post_sync_ret(info['err'])
+    if post_sync_ret is not None:
+        result['post_sync_ret'] = post_sync_ret
+    return result
 
-    for part_name, command in local_commands:
-        if not dry:
-            result = ub.cmd(command, verbose=3)
-            retcode = result['ret']
-            if command.startswith('git commit') and retcode == 1:
-                pass
-            elif retcode != 0:
-                if part_name == 'push':
-                    if 'updating the current branch in a non-bare repo' in result['err']:
-                        from rich.prompt import Confirm
-                        # We can handle this case if the user wants to
-                        if Confirm.ask('Do you want to force this?'):
-                            fix_command = _build_remote_command(
-                                'git config --local receive.denyCurrentBranch warn',
-                                remote_cwd, ssh_flags, host)
-                            result = ub.cmd(fix_command, verbose=3)
-                            retcode = result['ret']
-                            if retcode == 0:
-                                # Retry after running the fix
-                                result = ub.cmd(command, verbose=3)
-                                retcode = result['ret']
-                                if retcode == 0:
-                                    continue
-
-                print('git-sync cannot continue. retcode={}'.format(retcode))
-                break
-        else:
-            print(command)
+
+def _should_retry(info):
+    """
+    Check if a push or remote step failed in a way that running it again can
+    fix. A step whose post-sync command ran is never repeated.
+
+    Example:
+        >>> from git_sync.sync_remote import _should_retry
+        >>> _should_retry({'ret': 255, 'err': 'Connection reset by 10.0.0.1 port 22'})
+        True
+        >>> _should_retry({'ret': 255, 'err': chr(10).join([
+        ...     'git-sync: post-sync command exited with 0',
+        ...     'Connection to node1 closed by remote host.'])})
+        False
+    """
+    from git_sync import executor
+    return (executor.is_transient(info) and
+            _parse_post_sync_ret(info.get('err')) is None)
+
+
+def _post_sync_block(command):
+    """
+    Build the shell snippet that runs the post-sync command on a host and
+    reports its exit code after :data:`POST_SYNC_MARKER`.
+
+    Example:
+        >>> from git_sync.sync_remote import _post_sync_block
+        >>> print(_post_sync_block('make test'))
+        { git_sync_ret=0; sh -c 'make test' || git_sync_ret=$?; echo "git-sync: post-sync command exited with $git_sync_ret" >&2; exit $git_sync_ret; }
+    """
+    import shlex
+    return ('{{ git_sync_ret=0; sh -c {} || git_sync_ret=$?; '
+            'echo "{} $git_sync_ret" >&2; exit $git_sync_ret; }}').format(
+                shlex.quote(command), POST_SYNC_MARKER)
+
+
+def _parse_post_sync_ret(text):
+    """
+    Find the exit code of the post-sync command in the stderr of a host.
+
+    Example:
+        >>> from git_sync.sync_remote import _parse_post_sync_ret
+        >>> _parse_post_sync_ret('ok' + chr(10) + 'git-sync: post-sync command exited with 3')
+        3
+        >>> _parse_post_sync_ret('remote: git-sync: post-sync command exited with 2        ')
+        2
+        >>> _parse_post_sync_ret('fatal: not a git repository') is None
+        True
+    """
+    import re
+    # git prefixes the output of the hooks on the host with "remote: " (and
+    # may pad the line)
+    pattern = re.compile(r'^(?:remote: )?{} (\d+)'.format(
+        re.escape(POST_SYNC_MARKER)))
+    found = None
+    for line in (text or '').splitlines():
+        match = pattern.match(line.strip())
+        if match:
+            found = int(match.group(1))
+    return found
+
+
+def _print_host_report(results):
+    width = max(len(r['host']) for r in results)
+    print('git-sync summary:')
+    for r in results:
+        line = '  {host:<{width}}  {status:<7}  ret={ret}  {elapsed:.2f}s'.format(
+            width=width, **r)
+        if r.get('bytes') is not None:
+            line += '  {}'.format(_byte_str(r['bytes']))
+        if r.get('via') is not None:
+            line += '  via {}'.format(r['via'])
+        if r.get('post_sync_ret') is not None:
+            line += '  post-sync ret={}'.format(r['post_sync_ret'])
+        if r.get('stalled') is not None:
+            line += '  stalled in {}'.format(r['stalled'])
+        print(line)
+    num_ok = sum(r['status'] == 'ok' for r in results)
+    print(f'  {num_ok} / {len(results)} hosts synced')
+
+
+def _make_locator(home=None, use_cache=True):
+    cwd = _getcwd()
+    if home is None:
+        home = expanduser('~')
+    try:
+        relcwd = relpath(cwd, home)
+    except ValueError:
+        raise ValueError((
+            'git-sync assumes that you are running relative '
+            'to your home directory. cwd={}, home={}').format(cwd, home))
+    return _RemoteLocator(cwd, relcwd, home, use_cache=use_cache)
+
+
+class _RemoteLocator:
+    """
+    Resolves and memoizes the directory on each host that corresponds to the
+    local working directory.
+    """
+
+    def __init__(self, cwd, relcwd, home, use_cache=True):
+        import threading
+        self.cwd = cwd
+        self.relcwd = relcwd
+        self.home = home
+        self.use_cache = use_cache
+        self._memo = {}
+        self._lock = threading.Lock()
+        self._identity = None
+
+    @property
+    def identity(self):
+        if self._identity is None:
+            from git_sync.discover_remote import local_repo_identity
+            self._identity = local_repo_identity()
+        return self._identity
+
+    def remote_cwd(self, host, ssh_flags='', probe=True):
+        from os.path import join, realpath, normpath
+        if not self.use_cache:
+            return self.relcwd
+        with self._lock:
+            if host in self._memo:
+                return self._memo[host]
+        from git_sync.discover_remote import discover_remote_root
+        repo_root, root_commit = self.identity
+        subdir = relpath(realpath(self.cwd), realpath(repo_root))
+        # The repo root as seen without dereferencing symlinks
+        local_root = normpath(join(self.cwd, relpath(
+            realpath(repo_root), realpath(self.cwd))))
+        entry = discover_remote_root(
+            host, repo_root, root_commit, ssh_flags=ssh_flags,
+            home=self.home, probe=probe, local_root=local_root)
+        if entry is None:
+            if probe:
+                raise Exception(
+                    f'Unable to find the repo {repo_root} on {host}')
+            return self.relcwd
+        remote_cwd = normpath(join(entry['remote_root'], subdir))
+        with self._lock:
+            self._memo[host] = remote_cwd
+        return remote_cwd
+
+    def remote_root(self, host, ssh_flags='', probe=True):
+        """
+        The top level directory of the repo on the host, which unlike
+        :func:`remote_cwd` does not depend on the subdirectory git-sync runs
+        in.
+        """
+        from os.path import join, realpath, normpath
+        remote_cwd = self.remote_cwd(host, ssh_flags, probe=probe)
+        repo_root = self.identity[0]
+        return normpath(join(remote_cwd, relpath(
+            realpath(repo_root), realpath(self.cwd))))
+
+    def invalidate(self, host):
+        if not self.use_cache:
+            return
+        from git_sync.cache import DiscoveryCache
+        repo_root, root_commit = self.identity
+        DiscoveryCache().invalidate(host, repo_root, root_commit)
+        with self._lock:
+            self._memo.pop(host, None)
+
+
+class _RemoteSession:
+    """
+    The connection settings, time limits and retries of one sync, and the
+    steps that run on the hosts with them. Both sync directions use it.
+
+    A step on a host that stalls or is interrupted is stopped there as well,
+    and the phase it stalled in is kept in :attr:`stalled`. A step that
+    failed because of a network problem is run again.
+    """
+
+    def __init__(self, locator, timeouts, retries=2, forward_ssh_agent=False,
+                 connect_timeout=None, multiplex=True, workers=1):
+        import asyncio
+        import math
+        if connect_timeout is None and 'connect' in timeouts:
+            connect_timeout = max(1, math.ceil(timeouts['connect']))
+        self.locator = locator
+        self.timeouts = timeouts
+        self.retries = retries
+        self.ssh_flags = ssh_control.build_ssh_flags(
+            forward_ssh_agent, connect_timeout, multiplex=multiplex)
+        self.connect_kw = dict(forward_ssh_agent=forward_ssh_agent,
+                               connect_timeout=connect_timeout,
+                               multiplex=multiplex)
+        # Let git's own ssh transport ride on the managed connections too
+        self.git_env = (ssh_control.git_ssh_env(self.ssh_flags)
+                        if multiplex else None)
+        self.semaphore = asyncio.Semaphore(max(1, workers))
+        # The phase each host stalled in
+        self.stalled = {}
+        self._locate_tasks = {}
+
+    def remote_argv(self, host, script, token=None):
+        return ssh_control.build_remote_argv(
+            host, script, self.ssh_flags, token=token)
+
+    async def stop_remote(self, host, token):
+        from git_sync import executor
+        script = ssh_control.build_stop_script(token)
+        await executor.run_command(self.remote_argv(host, script), stdin=b'',
+                                   timeout=STOP_TIMEOUT)
+
+    async def run_remote(self, host, command, token, phase_name,
+                         ssh_host=None, **kwargs):
+        """
+        Run a command that was built with ``token`` under the time limit of
+        ``phase_name``. Killing the ssh client leaves the commands on the
+        host running, so they are stopped via ``ssh_host`` (which defaults
+        to ``host``) too.
+        """
+        import asyncio
+        from git_sync import executor
+        ssh_host = host if ssh_host is None else ssh_host
+        try:
+            info = await executor.run_command(
+                command, timeout=self.timeouts.get(phase_name), **kwargs)
+        except asyncio.CancelledError:
+            await asyncio.shield(self.stop_remote(ssh_host, token))
+            raise
+        if info['timed_out']:
+            self.stalled.setdefault(host, phase_name)
+            await self.stop_remote(ssh_host, token)
+        return info
+
+    async def run_script(self, host, script, phase_name, **kwargs):
+        token = ssh_control.new_token()
+        return await self.run_remote(host, self.remote_argv(
+            host, script, token=token), token, phase_name, **kwargs)
+
+    async def run_phase(self, name, host, run, measure=None, prefix='',
+                        **extra):
+        """
+        Record ``await run()`` as a phase. A step that failed because of a
+        network problem is run again after an exponentially growing,
+        jittered delay, and every attempt is its own phase record.
+        """
+        import asyncio
+        from git_sync import executor
+        from git_sync import profiling
+        attempt = 1
+        while True:
+            if attempt > 1:
+                extra['attempt'] = attempt
+            with profiling.phase(name, host, **extra) as record:
+                info = await run()
+                profiling.record_result(record, info)
+                if measure is not None:
+                    measure(record, info)
+            if attempt > self.retries or not _should_retry(info):
+                return info
+            delay = executor.backoff_delay(attempt)
+            print('{}{} failed ({}), retrying in {:.1f}s'.format(
+                prefix, name, profiling.classify_error(info['err'], info['ret']),
+                delay))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def query(self, host, script, name='query'):
+        """
+        Run a script that reports on the repo on a host under the connect
+        time limit and return its stdout.
+        """
+        from git_sync import executor
+        from git_sync import remote_state
+        info = await self.run_phase(name, host, lambda: self.run_script(
+            host, script, 'connect', stdin=b''))
+        if info['ret'] == remote_state.REPO_MISSING_RET:
+            # The cached location is stale, rediscover it next time
+            await executor.run_blocking(self.locator.invalidate, host)
+        if info['ret'] != 0:
+            raise Exception('Unable to query the repo on {}: {}'.format(
+                host, info['err'].strip()))
+        return info['out']
+
+    def locate(self, host):
+        """
+        Open the connection to a host and find the repo on it, once per
+        session.
+
+        Returns:
+            asyncio.Future: resolves to the directory of the repo on the host
+        """
+        import asyncio
+        if host not in self._locate_tasks:
+            self._locate_tasks[host] = asyncio.ensure_future(
+                self._connect_and_locate(host))
+        return self._locate_tasks[host]
+
+    async def _connect_and_locate(self, host):
+        from git_sync import executor
+        from git_sync import profiling
+        async with self.semaphore:
+            with profiling.phase('connect', host):
+                try:
+                    await executor.run_blocking(
+                        ssh_control.ensure_connection, host,
+                        timeout=self.timeouts.get('connect'),
+                        **self.connect_kw)
+                except TimeoutError:
+                    self.stalled[host] = 'connect'
+                    raise
+            with profiling.phase('locate', host):
+                return await executor.run_blocking(
+                    self.locator.remote_cwd, host, self.ssh_flags)
+
+
+async def _tree_clean():
+    """
+    Check that the tracked files of the local repo have no uncommitted
+    changes.
+    """
+    from git_sync import executor
+    info = await executor.run_command(
+        ['git', 'status', '--porcelain', '--untracked-files=no'])
+    return info['ret'] == 0 and not info['out'].strip()
+
+
+async def _is_ancestor(commit, other):
+    from git_sync import executor
+    info = await executor.run_command(
+        ['git', 'merge-base', '--is-ancestor', commit, other])
+    return info['ret'] == 0
+
+
+def _byte_str(num_bytes):
+    """
+    Example:
+        >>> from git_sync.sync_remote import _byte_str
+        >>> _byte_str(512), _byte_str(2048), _byte_str(3 * 2 ** 20)
+        ('512 B', '2.0 KB', '3.0 MB')
+    """
+    for unit in ['B', 'KB', 'MB']:
+        if num_bytes < 1024 or unit == 'MB':
+            break
+        num_bytes /= 1024
+    if unit == 'B':
+        return f'{num_bytes} {unit}'
+    return f'{num_bytes:.1f} {unit}'
+
+
+def _phase_timeouts(timeout):
+    """
+    Normalize the ``timeout`` argument of :func:`git_sync`.
+
+    Returns:
+        Dict[str, float]: the timeout of every phase that has one
+
+    Example:
+        >>> from git_sync.sync_remote import _phase_timeouts
+        >>> _phase_timeouts('push=60,sync=300')
+        {'push': 60.0, 'sync': 300.0}
+        >>> _phase_timeouts(30)
+        {'commit': 30.0, 'push': 30.0, 'connect': 30.0, 'sync': 30.0}
+        >>> _phase_timeouts('45,push=120')
+        {'commit': 45.0, 'push': 120.0, 'connect': 45.0, 'sync': 45.0}
+        >>> _phase_timeouts(None)
+        {}
+    """
+    if timeout is None:
+        return {}
+    if isinstance(timeout, str):
+        # A bare number is the default of the phases not named
+        default, parsed = {}, {}
+        for item in timeout.split(','):
+            name, sep, value = item.strip().rpartition('=')
+            if sep:
+                parsed[name.strip()] = value
+            else:
+                default = dict.fromkeys(TIMEOUT_PHASES, value)
+        timeout = {**default, **parsed}
+    if not isinstance(timeout, dict):
+        return {name: float(timeout) for name in TIMEOUT_PHASES}
+    unknown = set(timeout) - set(TIMEOUT_PHASES)
+    if unknown:
+        raise KeyError('Unknown timeout phases {}, expected one of {}'.format(
+            sorted(unknown), list(TIMEOUT_PHASES)))
+    return {name: float(value) for name, value in timeout.items()}
 
 
-def _build_remote_command(command, remote_cwd, ssh_flags, host):
+def _build_remote_command(command, remote_cwd, ssh_flags, host, token=None):
+    import shlex
     remote_parts = [
-        f'cd {remote_cwd}',
+        f'cd {shlex.quote(str(remote_cwd))}',
         command
     ]
+    if token is not None:
+        remote_parts.insert(0, ssh_control.build_track_command(token))
     remote_part = ' && '.join(remote_parts)
     local_part = f'ssh {ssh_flags} {host} "' + remote_part + '"'
     return local_part
@@ -0,0 +1,259 @@
+"""
+Transports that move commits directly from the local repo to a host.
+
+The default git-sync data path is local -> ``git push`` -> central remote ->
+``git pull`` on the host, which sends every byte over the local uplink to the
+central server and then back down to the host. The bundle transport instead
+uses the commits the host advertises in its snapshot (see
+:mod:`git_sync.remote_state`) to build a git bundle of only the missing
+commits and streams it over the ssh connection, where it is fetched
+and checked out. The central remote is not involved.
+
+The patch transport does not create commits at all. It diffs the local working
+tree against the commit the host has checked out and applies that binary
+patch on the host, rolling back if it does not apply.
+"""
+import shlex
+import subprocess
+import ubelt as ub
+
+
+def local_known_commits(shas, cwd=None):
+    """
+    Determine which of the given commits exist in the local repo.
+
+    Returns:
+        Set[str]
+    """
+    shas = [s for s in ub.unique(shas) if s]
+    if not shas:
+        return set()
+    proc = subprocess.run(
+        ['git', 'cat-file', '--batch-check'], cwd=cwd,
+        input='\n'.join(shas) + '\n', stdout=subprocess.PIPE,
+        universal_newlines=True)
+    known = set()
+    for line in proc.stdout.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[1] == 'commit':
+            known.add(parts[0])
+    return known
+
+
+def build_apply_script(remote_cwd, branch, target, force=False,
+                       has_bundle=True, extra_commands=None):
+    """
+    Build the script run on the host that reads a bundle from stdin, fetches
+    it and moves the checked out branch to ``target``.
+
+    Args:
+        remote_cwd (str): the repo directory on the host
+        branch (str): branch to check out
+        target (str): commit sha the branch should end up at
+        force (bool): hard reset instead of a fast-forward merge
+        has_bundle (bool): if False, stdin is ignored because the host
+            already has every needed commit
+        extra_commands (List[str] | None): run after the branch is updated
+
+    Example:
+        >>> from git_sync.transport import build_apply_script
+        >>> script = build_apply_script('code/repo', 'main', 'abc123')
+        >>> assert 'git merge -q --ff-only abc123' in script
+        >>> script = build_apply_script('code/repo', 'main', 'abc123', force=True, has_bundle=False)
+        >>> assert 'git reset -q --hard abc123' in script
+        >>> assert 'cat >' not in script
+    """
+    branch_q = shlex.quote(branch)
+    lines = [
+        'set -e',
+        f'cd {shlex.quote(str(remote_cwd))}',
+    ]
+    if has_bundle:
+        lines += [
+            'tmp=$(mktemp "${TMPDIR:-/tmp}/git-sync-XXXXXX")',
+            'trap \'rm -f "$tmp"\' EXIT',
+            'cat > "$tmp"',
+            f'git fetch -q "$tmp" "+refs/heads/{branch}:refs/git-sync/incoming/{branch}"',
+        ]
+    lines += [
+        f'if [ "$(git rev-parse --abbrev-ref HEAD)" != {branch_q} ]; then',
+        f'    git checkout -q {branch_q} 2>/dev/null || git checkout -q -b {branch_q} {target}',
+        'fi',
+    ]
+    if force:
+        lines.append(f'git reset -q --hard {target}')
+    else:
+        lines.append(f'git merge -q --ff-only {target}')
+    lines += list(extra_commands or [])
+    return '\n'.join(lines) + '\n'
+
+
+def plan_bundle(remote_cwd, remote_info, branch, target, force=False,
+                cwd=None, extra_commands=None):
+    """
+    Decide what needs to be sent to a host given what it advertises.
+
+    Args:
+        remote_cwd (str): the repo directory on the host
+        remote_info (Dict): the snapshot of the host from
+            :func:`git_sync.remote_state.parse_state_output` (its "head" and
+            "refs" are used)
+        branch (str): branch to update
+        target (str): local commit sha to send
+        force (bool): hard reset the host instead of fast-forwarding
+        cwd (str | None): local repo directory
+        extra_commands (List[str] | None): run on the host after the branch
+            is updated
+
+    Returns:
+        Tuple[List[str] | None, str]: the local command that writes the
+        bundle (None if the host already has ``target``) and the script to
+        run on the host.
+    """
+    advertised = [remote_info['head']] + list(remote_info['refs'].values())
+    basis = local_known_commits(advertised, cwd=cwd)
+    has_bundle = target not in basis
+    script = build_apply_script(remote_cwd, branch, target, force=force,
+                                has_bundle=has_bundle,
+                                extra_commands=extra_commands)
+    if not has_bundle:
+        return None, script
+    # Only exclude what the host has checked out and its copy of the branch,
+    # so that hosts on the same commit get the same bundle (other branches
+    # rarely hold commits the branch is missing). Without either, fall back
+    # to everything the host advertises.
+    primary = basis & {remote_info['head'],
+                       remote_info['refs'].get(f'refs/heads/{branch}')}
+    # The bundle contains the branch tip and everything the host lacks
+    bundle_command = ['git', 'bundle', 'create', '-', f'refs/heads/{branch}']
+    bundle_command += ['^' + sha for sha in sorted(primary or basis)]
+    return bundle_command, script
+
+
+def write_bundle(bundle_command, dpath, cwd=None):
+    """
+    Run a bundle command from :func:`plan_bundle` and keep the bundle in a
+    file, so it can be sent to every host with the same basis.
+
+    Args:
+        bundle_command (List[str]): writes the bundle to stdout
+        dpath (str | PathLike): directory for the bundle file
+        cwd (str | None): local repo directory
+
+    Returns:
+        ub.Path: the bundle file
+    """
+    import hashlib
+    key = hashlib.sha1('\0'.join(bundle_command).encode('utf8')).hexdigest()
+    fpath = ub.Path(dpath) / f'{key[:16]}.bundle'
+    with open(fpath, 'wb') as file:
+        proc = subprocess.run(bundle_command, cwd=cwd, stdout=file,
+                              stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise Exception('Unable to create a bundle: {}'.format(
+            proc.stderr.decode('utf8', errors='replace').strip()))
+    return fpath
+
+
+def working_tree_patch(basis, include_untracked=False, cwd=None):
+    """
+    Compute a binary patch from the commit ``basis`` to the current state of
+    the working tree.
+
+    Args:
+        basis (str): commit the patch applies to
+        include_untracked (bool): also include untracked files that are not
+            ignored. A temporary index is used, so the real index is not
+            modified.
+        cwd (str | None): local repo directory
+
+    Returns:
+        bytes
+    """
+    import os
+    import shutil
+    import tempfile
+    from git_sync import gitmeta
+    env = None
+    tmp_dpath = None
+    if include_untracked:
+        tmp_dpath = tempfile.mkdtemp(prefix='git-sync-index-')
+        index_fpath = os.path.join(tmp_dpath, 'index')
+        meta = gitmeta.RepoMeta(cwd)
+        real_index = meta.git_dir / 'index'
+        if real_index.exists():
+            # Starting from a copy keeps the cached stat info
+            shutil.copy2(real_index, index_fpath)
+        env = dict(os.environ, GIT_INDEX_FILE=index_fpath)
+    try:
+        if include_untracked:
+            subprocess.run(['git', 'add', '-A'], cwd=cwd, env=env, check=True)
+            command = ['git', 'diff', '--binary', '--cached', basis]
+        else:
+            command = ['git', 'diff', '--binary', basis]
+        proc = subprocess.run(command, cwd=cwd, env=env, check=True,
+                              stdout=subprocess.PIPE)
+    finally:
+        if tmp_dpath is not None:
+            shutil.rmtree(tmp_dpath, ignore_errors=True)
+    return proc.stdout
+
+
+def build_patch_apply_script(remote_cwd, expected_head):
+    """
+    Build the script run on the host that reads a patch from stdin and makes
+    the working tree equal to ``expected_head`` plus that patch.
+
+    The previous state of the working tree is recorded with ``git stash
+    create`` and saved as ``refs/git-sync/backup``. If the patch does not
+    apply, the working tree is restored from it.
+
+    Example:
+        >>> from git_sync.transport import build_patch_apply_script
+        >>> script = build_patch_apply_script('code/repo', 'abc123')
+        >>> assert 'git apply --index' in script
+        >>> assert 'git stash apply' in script
+    """
+    script = ub.codeblock(
+        f'''
+        set -e
+        cd {shlex.quote(str(remote_cwd))}
+        tmp=$(mktemp "${{TMPDIR:-/tmp}}/git-sync-XXXXXX")
+        trap 'rm -f "$tmp"' EXIT
+        cat > "$tmp"
+        if [ "$(git rev-parse HEAD)" != "{expected_head}" ]; then
+            echo "git-sync: the host HEAD is no longer {expected_head}" >&2
+            exit 4
+        fi
+        backup=$(git stash create)
+        if [ -n "$backup" ]; then
+            git update-ref -m git-sync refs/git-sync/backup "$backup"
+        fi
+        git reset -q --hard
+        if [ -s "$tmp" ] && ! git apply --index --whitespace=nowarn "$tmp"; then
+            git reset -q --hard
+            if [ -n "$backup" ]; then
+                git stash apply -q --index "$backup"
+            fi
+            echo "git-sync: the patch did not apply, the host was restored" >&2
+            exit 1
+        fi
+        ''')
+    return script + '\n'
+
+
+def patch_basis(host, remote_info, cwd=None):
+    """
+    Returns:
+        str: the commit checked out on the host, which the working tree patch
+        for that host is computed against.
+
+    Raises:
+        Exception: if the local repo does not have that commit
+    """
+    basis = remote_info['head']
+    if basis is None or not local_known_commits([basis], cwd=cwd):
+        raise Exception((
+            'The commit checked out on {} ({}) is not in the local repo. '
+            'Run a normal sync first.').format(host, basis))
+    return basis
@@ -0,0 +1,436 @@
+"""
+Watch the working tree and sync whenever it changes.
+
+Changes are detected with inotify on Linux and by polling the files git knows
+about everywhere else. Files matched by ``.gitignore`` and anything inside
+``.git`` are ignored. A burst of saves is coalesced into a single sync that
+starts once the tree has been quiet for a configurable period, and changes
+that arrive while a sync is running queue exactly one follow-up sync.
+Stopping the watch (Ctrl-C) cancels a running sync and waits for it to clean
+up, like stopping a single sync does.
+"""
+import asyncio
+import inspect
+import os
+import subprocess
+import sys
+import threading
+import time
+import ubelt as ub
+
+
+class PollingWatcher:
+    """
+    Detects changes by comparing the size and mtime of the tracked and
+    untracked-but-not-ignored files in the repo.
+
+    Args:
+        root (str | PathLike): root of the working tree
+        interval (float): seconds between scans
+
+    Example:
+        >>> from git_sync.watch import PollingWatcher
+        >>> import ubelt as ub
+        >>> dpath = ub.Path.appdir('git_sync/tests/watch_poll').delete().ensuredir()
+        >>> _ = ub.cmd('git init', cwd=dpath)
+        >>> (dpath / '.gitignore').write_text('*.log' + chr(10))
+        >>> watcher = PollingWatcher(dpath, interval=0.01)
+        >>> (dpath / 'out.log').write_text('ignored')
+        >>> (dpath / 'a.py').write_text('print(1)')
+        >>> changed = watcher.wait(1.0)
+        >>> assert 'a.py' in changed
+        >>> assert 'out.log' not in changed
+    """
+
+    def __init__(self, root, interval=1.0):
+        self.root = ub.Path(root)
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        proc = subprocess.run(
+            ['git', 'ls-files', '-z', '--cached', '--others',
+             '--exclude-standard'],
+            cwd=self.root, stdout=subprocess.PIPE)
+        snapshot = {}
+        for relpath in proc.stdout.decode('utf8', 'replace').split('\0'):
+            if not relpath:
+                continue
+            try:
+                stat = os.lstat(self.root / relpath)
+            except OSError:
+                continue
+            snapshot[relpath] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def wait(self, timeout=None):
+        """
+        Block until something changes or ``timeout`` seconds pass.
+
+        Returns:
+            List[str]: changed paths relative to the root
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self._scan()
+            old = self._snapshot
+            self._snapshot = snapshot
+            changed = [p for p in set(old) | set(snapshot)
+                       if old.get(p) != snapshot.get(p)]
+            if changed:
+                return sorted(changed)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                time.sleep(min(self.interval, remaining))
+            else:
+                time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Detects changes using the Linux inotify API (via ctypes).
+
+    Every non-ignored directory in the working tree is watched and
+    directories created later are added as they appear.
+
+    Args:
+        root (str | PathLike): root of the working tree
+
+    Raises:
+        OSError: if inotify is not available or the watch limit is reached
+
+    Example:
+        >>> # xdoctest: +REQUIRES(LINUX)
+        >>> from git_sync.watch import InotifyWatcher
+        >>> import ubelt as ub
+        >>> dpath = ub.Path.appdir('git_sync/tests/watch_inotify').delete().ensuredir()
+        >>> _ = ub.cmd('git init', cwd=dpath)
+        >>> (dpath / 'sub').ensuredir()
+        >>> watcher = InotifyWatcher(dpath)
+        >>> (dpath / 'sub' / 'a.py').write_text('print(1)')
+        >>> changed = watcher.wait(1.0)
+        >>> assert 'sub/a.py' in changed
+        >>> watcher.close()
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+    def __init__(self, root):
+        import ctypes
+        import ctypes.util
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self.root = ub.Path(root)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._wd_to_dpath = {}
+        try:
+            dpaths = [self.root]
+            for dpath, dnames, _ in os.walk(self.root):
+                if '.git' in dnames:
+                    dnames.remove('.git')
+                dpaths.extend(ub.Path(dpath) / d for d in dnames)
+            ignored = set(_ignored_paths(self.root, [
+                os.path.relpath(d, self.root) for d in dpaths[1:]]))
+            for dpath in dpaths:
+                if os.path.relpath(dpath, self.root) not in ignored:
+                    self._add_watch(dpath)
+        except Exception:
+            self.close()
+            raise
+
+    def _add_watch(self, dpath):
+        import ctypes
+        wd = self._libc.inotify_add_watch(
+            self.fd, os.fsencode(dpath), self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), os.fspath(dpath))
+        self._wd_to_dpath[wd] = ub.Path(dpath)
+
+    def wait(self, timeout=None):
+        """
+        Block until something changes or ``timeout`` seconds pass.
+
+        Returns:
+            List[str]: changed paths relative to the root
+        """
+        import select
+        import struct
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        # Give the rest of a burst of events a moment to arrive
+        time.sleep(0.01)
+        changed = set()
+        header = struct.Struct('iIII')
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_len = header.unpack_from(data, offset)
+                offset += header.size
+                name = data[offset:offset + name_len].rstrip(b'\0')
+                offset += name_len
+                if mask & self.IN_Q_OVERFLOW:
+                    changed.add('.')
+                    continue
+                if mask & self.IN_IGNORED:
+                    self._wd_to_dpath.pop(wd, None)
+                    continue
+                dpath = self._wd_to_dpath.get(wd)
+                if dpath is None:
+                    continue
+                fpath = dpath / os.fsdecode(name)
+                rel = os.path.relpath(fpath, self.root)
+                if rel == '.git' or rel.startswith('.git' + os.sep):
+                    continue
+                changed.add(rel)
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    if not _ignored_paths(self.root, [rel]):
+                        try:
+                            self._add_watch(fpath)
+                        except OSError:
+                            pass
+        if changed and '.' not in changed:
+            changed -= set(_ignored_paths(self.root, sorted(changed)))
+        return sorted(changed)
+
+    def close(self):
+        if self.fd is not None and self.fd >= 0:
+            os.close(self.fd)
+        self.fd = None
+
+
+def _ignored_paths(root, relpaths):
+    """
+    Returns:
+        List[str]: the subset of relpaths that are ignored by git
+    """
+    if not relpaths:
+        return []
+    proc = subprocess.run(
+        ['git', 'check-ignore', '--stdin', '-z'], cwd=root,
+        input=b'\0'.join(os.fsencode(p) for p in relpaths) + b'\0',
+        stdout=subprocess.PIPE)
+    return [p for p in proc.stdout.decode('utf8', 'replace').split('\0') if p]
+
+
+def make_watcher(root, backend='auto', poll_interval=1.0):
+    """
+    Args:
+        root (str | PathLike): root of the working tree
+        backend (str): "inotify", "poll", or "auto" (inotify when possible)
+        poll_interval (float): seconds between scans of the polling backend
+
+    Returns:
+        InotifyWatcher | PollingWatcher
+    """
+    if backend in {'auto', 'inotify'}:
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as ex:
+            if backend == 'inotify':
+                raise
+            print(f'git-sync: inotify unavailable ({ex}), polling instead')
+    return PollingWatcher(root, interval=poll_interval)
+
+
+def watch(sync_fn, root=None, quiet_period=1.0, backend='auto',
+          poll_interval=1.0, max_syncs=None):
+    """
+    Run ``sync_fn`` whenever the working tree changes.
+
+    Args:
+        sync_fn (Callable[[], Any]): the sync to run, e.g. a partial of
+            :func:`git_sync.sync_remote.async_git_sync`. If it returns an
+            awaitable, that is run on an event loop of its own and is
+            cancelled when the watch is interrupted.
+        root (str | PathLike | None): root of the working tree. Defaults to
+            the root of the repo containing the current directory.
+        quiet_period (float): seconds without changes before a sync starts
+        backend (str): see :func:`make_watcher`
+        poll_interval (float): seconds between scans of the polling backend
+        max_syncs (int | None): stop after this many syncs (mainly for tests)
+
+    Example:
+        >>> from git_sync.watch import watch
+        >>> import ubelt as ub
+        >>> dpath = ub.Path.appdir('git_sync/tests/watch_loop').delete().ensuredir()
+        >>> _ = ub.cmd('git init', cwd=dpath)
+        >>> calls = []
+        >>> def sync_fn():
+        >>>     calls.append(time.monotonic())
+        >>>     if len(calls) == 1:
+        >>>         # edits during an in-flight sync queue one follow-up
+        >>>         for i in range(3):
+        >>>             (dpath / f'during{i}.txt').write_text('x')
+        >>>         time.sleep(0.2)
+        >>> def edit():
+        >>>     time.sleep(0.1)
+        >>>     for i in range(5):
+        >>>         (dpath / f'burst{i}.txt').write_text('x')
+        >>> thread = threading.Thread(target=edit)
+        >>> thread.start()
+        >>> watch(sync_fn, dpath, quiet_period=0.1, poll_interval=0.02, max_syncs=2)
+        >>> thread.join()
+        >>> assert len(calls) == 2
+    """
+    from git_sync import gitmeta
+    if root is None:
+        root = gitmeta.repo_root()
+    watcher = make_watcher(root, backend=backend, poll_interval=poll_interval)
+    num_syncs = 0
+    dirty = False
+    last_change = None
+    sync_thread = None
+    try:
+        while max_syncs is None or num_syncs < max_syncs or sync_thread is not None:
+            if sync_thread is not None:
+                # Poll frequently so the follow-up starts promptly
+                timeout = 0.1
+            elif dirty:
+                timeout = max(0.0, quiet_period - (time.monotonic() - last_change))
+            else:
+                timeout = None
+            changed = watcher.wait(timeout)
+            if changed:
+                dirty = True
+                last_change = time.monotonic()
+
+            if sync_thread is not None and not sync_thread.is_alive():
+                sync_thread.join()
+                sync_thread = None
+
+            quiet = last_change is not None and (
+                time.monotonic() - last_change >= quiet_period)
+            can_start = max_syncs is None or num_syncs < max_syncs
+            if dirty and quiet and sync_thread is None and can_start:
+                dirty = False
+                num_syncs += 1
+                print('git-sync: change detected, syncing')
+                sync_thread = _SyncThread(sync_fn)
+                sync_thread.start()
+    except KeyboardInterrupt:
+        if sync_thread is not None and sync_thread.is_alive():
+            # Let the sync stop its processes (also on the hosts)
+            print('git-sync: stopping the running sync')
+            sync_thread.cancel()
+            sync_thread.join()
+        raise
+    finally:
+        watcher.close()
+
+
+class _SyncThread(threading.Thread):
+    """
+    Runs one sync in the background.
+
+    Example:
+        >>> from git_sync.watch import _SyncThread
+        >>> import asyncio
+        >>> done = []
+        >>> async def slow_sync():
+        >>>     try:
+        >>>         await asyncio.sleep(30)
+        >>>     finally:
+        >>>         done.append('cleaned up')
+        >>> thread = _SyncThread(slow_sync)
+        >>> thread.start()
+        >>> time.sleep(0.1)
+        >>> thread.cancel()
+        >>> thread.join(5)
+        >>> assert not thread.is_alive() and done == ['cleaned up']
+    """
+
+    def __init__(self, sync_fn):
+        super().__init__(name='git-sync-watch-sync')
+        self.sync_fn = sync_fn
+        self._lock = threading.Lock()
+        self._loop = None
+        self._task = None
+        self._cancelled = False
+
+    def run(self):
+        try:
+            result = self.sync_fn()
+            if inspect.isawaitable(result):
+                asyncio.run(self._main(result))
+        except asyncio.CancelledError:
+            print('git-sync: sync cancelled')
+        except Exception as ex:
+            print(f'git-sync: sync failed: {ex!r}')
+
+    async def _main(self, awaitable):
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._task = asyncio.current_task()
+            cancelled = self._cancelled
+        if cancelled:
+            if inspect.iscoroutine(awaitable):
+                awaitable.close()
+            raise asyncio.CancelledError
+        return await awaitable
+
+    def cancel(self):
+        """
+        Cancel the sync if it is a coroutine. A plain function runs to the
+        end.
+        """
+        with self._lock:
+            self._cancelled = True
+            if self._task is not None:
+                try:
+                    self._loop.call_soon_threadsafe(self._task.cancel)
+                except RuntimeError:
+                    # The loop already finished
+                    pass
+
+
+#: Idle lifetime of the ssh master connections while watching
+WARM_PERSIST = 3600
+
+
+def watch_git_sync(quiet_period=1.0, backend='auto', poll_interval=1.0,
+                   **kwargs):
+    """
+    Watch the working tree and run :func:`git_sync.sync_remote.git_sync`
+    with ``kwargs`` after every burst of changes. The ssh master connections
+    are kept alive between syncs.
+    """
+    from functools import partial
+    from git_sync import ssh_control
+    from git_sync.sync_remote import async_git_sync
+    mux = ssh_control.get_multiplexer()
+    if mux is not None and kwargs.get('multiplex', True):
+        mux.persist = max(mux.persist, WARM_PERSIST)
+    sync_fn = partial(async_git_sync, **kwargs)
+    print('git-sync: watching for changes (Ctrl-C to stop)')
+    try:
+        watch(sync_fn, quiet_period=quiet_period, backend=backend,
+              poll_interval=poll_interval)
+    except KeyboardInterrupt:
+        print('git-sync: stopped watching')
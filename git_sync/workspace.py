@@ -0,0 +1,406 @@
+"""
+Sync a workspace of several repos at once.
+
+A workspace is either a manifest file or a directory. A manifest is a json
+file that lists the repos relative to the directory it is in:
+
+.. code:: json
+
+    {"repos": ["core", "plugins/viz", {"path": "data-tools", "remote": "origin"}]}
+
+For a directory, the git repos in it (up to ``max_depth`` levels down) are
+used.
+
+Repos without uncommitted changes and without commits that are ahead of their
+upstream are skipped without any network traffic. The others are committed
+and pushed locally in parallel. Each host is then updated with a single ssh
+session that pulls every synced repo in turn.
+"""
+import json
+import os
+import re
+import shlex
+import ubelt as ub
+from os.path import expanduser
+from os.path import relpath
+from git_sync import ssh_control
+from git_sync import gitmeta
+from git_sync.sync_remote import resolve_hosts
+
+#: Name of the manifest file looked for in a workspace directory
+MANIFEST_NAME = 'git-sync-workspace.json'
+
+
+def load_workspace(workspace, max_depth=2):
+    """
+    Find the repos in a workspace.
+
+    Args:
+        workspace (str | PathLike): a manifest file, or a directory. If the
+            directory contains a :data:`MANIFEST_NAME` file it is used,
+            otherwise repos are detected.
+        max_depth (int): how deep to look for repos when detecting them
+
+    Returns:
+        List[Dict]: one item per repo with the keys "name", "path" and
+        "remote" (which may be None)
+
+    Example:
+        >>> from git_sync.workspace import load_workspace
+        >>> import ubelt as ub
+        >>> dpath = ub.Path.appdir('git_sync/tests/workspace').delete().ensuredir()
+        >>> for name in ['repo1', 'group/repo2']:
+        >>>     _ = ub.cmd('git init', cwd=(dpath / name).ensuredir())
+        >>> [r['name'] for r in load_workspace(dpath)]
+        ['group/repo2', 'repo1']
+        >>> (dpath / 'git-sync-workspace.json').write_text(
+        >>>     '{"repos": ["repo1", {"path": "group/repo2", "remote": "origin"}]}')
+        >>> [(r['name'], r['remote']) for r in load_workspace(dpath)]
+        [('repo1', None), ('group/repo2', 'origin')]
+    """
+    workspace = ub.Path(workspace).expand()
+    if workspace.is_dir() and (workspace / MANIFEST_NAME).exists():
+        workspace = workspace / MANIFEST_NAME
+    if workspace.is_file():
+        manifest = json.loads(workspace.read_text())
+        root = workspace.parent
+        items = manifest.get('repos', [])
+    else:
+        root = workspace
+        items = [os.fspath(p.relative_to(root))
+                 for p in _detect_repos(root, max_depth)]
+    repos = []
+    for item in items:
+        if isinstance(item, str):
+            item = {'path': item}
+        path = (root / item['path']).absolute()
+        repos.append({
+            'name': item.get('name', item['path']),
+            'path': path,
+            'remote': item.get('remote', None),
+        })
+    return repos
+
+
+def _detect_repos(root, max_depth):
+    found = []
+    for dpath, dnames, fnames in os.walk(root):
+        dpath = ub.Path(dpath)
+        depth = len(dpath.relative_to(root).parts)
+        if '.git' in dnames or '.git' in fnames:
+            if dpath != root:
+                found.append(dpath)
+            # Do not look for nested repos (e.g. submodules)
+            dnames[:] = []
+        elif depth >= max_depth:
+            dnames[:] = []
+        else:
+            dnames[:] = [d for d in dnames if not d.startswith('.')]
+    return sorted(found)
+
+
+def parse_status(text):
+    """
+    Parse the output of ``git status --porcelain=v2 --branch``.
+
+    Returns:
+        Dict: with keys "dirty" (bool) and "ahead" (int | None, None if the
+        branch has no upstream)
+
+    Example:
+        >>> from git_sync.workspace import parse_status
+        >>> text = chr(10).join([
+        >>>     '# branch.oid 1111111111111111111111111111111111111111',
+        >>>     '# branch.head main',
+        >>>     '# branch.upstream origin/main',
+        >>>     '# branch.ab +2 -0',
+        >>> ])
+        >>> parse_status(text)
+        {'dirty': False, 'ahead': 2}
+        >>> parse_status('# branch.head main' + chr(10) + '1 .M N... 100644 100644 100644 a b file.txt')
+        {'dirty': True, 'ahead': None}
+    """
+    info = {'dirty': False, 'ahead': None}
+    for line in text.splitlines():
+        if line.startswith('# branch.ab '):
+            match = re.match(r'# branch\.ab \+(\d+) -(\d+)', line)
+            if match:
+                info['ahead'] = int(match.group(1))
+        elif line and not line.startswith('#'):
+            info['dirty'] = True
+    return info
+
+
+def remote_repo_cwd(path, host, home):
+    """
+    The location of a repo on a host: the discovery cache entry if there is
+    one, otherwise the same path relative to home. The host is never probed.
+    """
+    from git_sync.cache import DiscoveryCache
+    from git_sync.discover_remote import local_repo_identity
+    repo_root, root_commit = local_repo_identity(path)
+    entry = DiscoveryCache().lookup(host, repo_root, root_commit)
+    if entry is not None:
+        return entry['remote_root']
+    return relpath(os.fspath(path), home)
+
+
+def build_host_script(items, force=False):
+    r"""
+    Build one script that updates every synced repo on a host in turn.
+
+    Args:
+        items (List[Dict]): with keys "name", "remote_cwd", "remote" and
+            "branch"
+        force (bool): hard reset to the remote branch instead of pulling
+
+    Returns:
+        str: a POSIX shell script that prints ``git-sync: [<index>] <name>
+        ret=<code>`` after each repo
+
+    Example:
+        >>> from git_sync.workspace import build_host_script
+        >>> items = [{'name': 'core', 'remote_cwd': 'code/core', 'remote': 'origin', 'branch': 'main'}]
+        >>> print(build_host_script(items))
+        (
+            cd code/core &&
+            git pull origin &&
+            if [ "$(git rev-parse --abbrev-ref HEAD)" != main ]; then git checkout main; fi
+        )
+        echo "git-sync: [0] core ret=$?"
+    """
+    blocks = []
+    for idx, item in enumerate(items):
+        remote = item['remote']
+        branch = shlex.quote(item['branch'])
+        steps = [f'cd {shlex.quote(os.fspath(item["remote_cwd"]))}']
+        if force:
+            remote = remote or 'origin'
+            steps += [
+                f'git fetch {remote}',
+                f'git checkout {branch}',
+                f'git reset --hard {remote}/{branch}',
+            ]
+        else:
+            steps += [
+                f'git pull {remote}' if remote else 'git pull',
+                (f'if [ "$(git rev-parse --abbrev-ref HEAD)" != {branch} ]; '
+                 f'then git checkout {branch}; fi'),
+            ]
+        body = ' &&\n'.join('    ' + step for step in steps)
+        name = re.sub(r'[^A-Za-z0-9_./ -]', '', item['name'])
+        blocks.append('(\n' + body + '\n)\n' +
+                      f'echo "git-sync: [{idx}] {name} ret=$?"')
+    return '\n'.join(blocks)
+
+
+def parse_host_output(text):
+    """
+    Returns:
+        Dict[int, int]: the exit code of each repo index reported by the
+        script from :func:`build_host_script`
+    """
+    codes = {}
+    for match in re.finditer(r'^git-sync: \[(\d+)\] .* ret=(\d+)$', text,
+                             flags=re.MULTILINE):
+        codes[int(match.group(1))] = int(match.group(2))
+    return codes
+
+
+def workspace_sync(host, workspace, message='wip [skip ci]',
+                   forward_ssh_agent=False, dry=False, force=False,
+                   home=None, workers=None, connect_timeout=None,
+                   multiplex=True, remote=None, max_depth=2):
+    """
+    Commit, push and pull every repo in a workspace that has something to
+    sync.
+
+    Args:
+        host (str | List[str]): hosts, as in :func:`git_sync.git_sync`
+        workspace (str | PathLike): manifest file or directory (see
+            :func:`load_workspace`)
+        message (str): commit message
+        forward_ssh_agent (bool): forward the ssh agent
+        dry (bool): only print what would be done
+        force (bool): force push and hard reset the hosts
+        home (str | None): overwrite the local home directory
+        workers (int | None): maximum number of repos committed and pushed at
+            the same time, and of hosts updated at the same time
+        connect_timeout (int | None): ssh connect timeout
+        multiplex (bool): use the managed ssh master connections
+        remote (str | None): remote for repos that do not specify one
+        max_depth (int): how deep to look for repos in a directory
+
+    Returns:
+        List[Dict]: one result per repo and host with the keys "repo",
+        "host", "status" (ok, failed, skipped, clean or dry) and "ret"
+    """
+    from git_sync import executor
+    return executor.run_sync(_async_workspace_sync(
+        host, workspace, message=message,
+        forward_ssh_agent=forward_ssh_agent, dry=dry, force=force,
+        home=home, workers=workers, connect_timeout=connect_timeout,
+        multiplex=multiplex, remote=remote, max_depth=max_depth))
+
+
+async def _async_workspace_sync(host, workspace, message, forward_ssh_agent,
+                                dry, force, home, workers, connect_timeout,
+                                multiplex, remote, max_depth):
+    import asyncio
+    from git_sync import executor
+    from git_sync import profiling
+    hosts = resolve_hosts(host)
+    if home is None:
+        home = expanduser('~')
+    repos = load_workspace(workspace, max_depth=max_depth)
+    if not repos:
+        raise ValueError(f'No repos found in {workspace}')
+    for repo in repos:
+        if repo['remote'] is None:
+            repo['remote'] = remote
+
+    if workers is None:
+        workers = max(len(repos), len(hosts))
+    semaphore = asyncio.Semaphore(max(1, workers))
+
+    async def check(repo):
+        async with semaphore:
+            info = await executor.run_command(
+                ['git', 'status', '--porcelain=v2', '--branch',
+                 '--untracked-files=no'], cwd=repo['path'])
+        if info['ret'] != 0:
+            raise Exception('Unable to get the status of {}: {}'.format(
+                repo['name'], info['err'].strip()))
+        status = parse_status(info['out'])
+        repo['branch'] = gitmeta.current_branch(repo['path'])
+        repo['needs_sync'] = status['dirty'] or bool(status['ahead'])
+        return repo
+
+    with profiling.phase('status'):
+        await asyncio.gather(*[check(repo) for repo in repos])
+    active = [r for r in repos if r['needs_sync']]
+    for repo in repos:
+        if not repo['needs_sync']:
+            print(f'[{repo["name"]}] nothing to sync')
+
+    def result(repo, host_, status, ret=None):
+        return {'repo': repo['name'], 'host': host_, 'status': status,
+                'ret': ret}
+
+    if connect_timeout is None and len(hosts) > 1:
+        connect_timeout = 10
+    ssh_flags = ssh_control.build_ssh_flags(
+        forward_ssh_agent, connect_timeout, multiplex=multiplex)
+    connect_kw = dict(forward_ssh_agent=forward_ssh_agent,
+                      connect_timeout=connect_timeout, multiplex=multiplex)
+
+    def local_commands(repo):
+        push_args = ['git', 'push']
+        if repo['remote']:
+            push_args.append(repo['remote'])
+        if force:
+            push_args.append('--force')
+        return [['git', 'commit', '-am', message], push_args]
+
+    def host_items(host_, synced):
+        return [dict(repo, remote_cwd=remote_repo_cwd(repo['path'], host_, home))
+                for repo in synced]
+
+    if dry:
+        for repo in active:
+            for command in local_commands(repo):
+                print(f'[{repo["name"]}] ' + ' '.join(map(shlex.quote, command)))
+        if active:
+            for host_ in hosts:
+                script = build_host_script(host_items(host_, active), force)
+                print(f'# one ssh session to {host_}:')
+                print(script)
+        return [result(repo, h, 'dry' if repo['needs_sync'] else 'clean')
+                for repo in repos for h in hosts]
+
+    # Open the connections while the local commits and pushes run
+    connect_tasks = {}
+    if active:
+        connect_tasks = {
+            h: asyncio.ensure_future(executor.run_blocking(
+                ssh_control.ensure_connection, h, **connect_kw))
+            for h in hosts}
+    git_env = ssh_control.git_ssh_env(ssh_flags) if multiplex else None
+
+    async def commit_and_push(repo):
+        prefix = f'[{repo["name"]}] '
+        async with semaphore:
+            for command in local_commands(repo):
+                part = command[1]
+                with profiling.phase(part, repo=repo['name']) as record:
+                    info = await executor.run_command(
+                        command, verbose=1, prefix=prefix, cwd=repo['path'],
+                        env=git_env)
+                    profiling.record_result(record, info)
+                    if part == 'commit' and info['ret'] == 1:
+                        record['status'] = 'ok'
+                if part == 'commit' and info['ret'] == 1:
+                    # Nothing to commit, there may still be commits to push
+                    continue
+                if info['ret'] != 0:
+                    print(f'{prefix}{part} failed, the repo is skipped')
+                    return False
+        return True
+
+    pushed = await asyncio.gather(*[commit_and_push(r) for r in active])
+    synced = [repo for repo, ok in zip(active, pushed) if ok]
+
+    async def update_host(host_):
+        prefix = f'[{host_}] ' if len(hosts) > 1 else ''
+        try:
+            await connect_tasks[host_]
+            items = await executor.run_blocking(host_items, host_, synced)
+            script = build_host_script(items, force)
+            argv = ssh_control.build_remote_argv(host_, script, ssh_flags)
+            async with semaphore:
+                with profiling.phase('sync', host_) as record:
+                    info = await executor.run_command(
+                        argv, verbose=1, prefix=prefix, stdin=b'')
+                    profiling.record_result(record, info)
+            codes = parse_host_output(info['out'])
+        except Exception as ex:
+            print(f'{prefix}{ex}')
+            info, codes = {'ret': None}, {}
+        results = []
+        for idx, repo in enumerate(synced):
+            ret = codes.get(idx, info['ret'])
+            results.append(result(repo, host_, 'ok' if ret == 0 else 'failed', ret))
+        return results
+
+    host_results = []
+    if synced:
+        host_results = await asyncio.gather(*[update_host(h) for h in hosts])
+    by_key = {(r['repo'], r['host']): r for rs in host_results for r in rs}
+    results = []
+    for repo in repos:
+        for h in hosts:
+            if not repo['needs_sync']:
+                results.append(result(repo, h, 'clean'))
+            elif (repo['name'], h) in by_key:
+                results.append(by_key[(repo['name'], h)])
+            else:
+                results.append(result(repo, h, 'skipped'))
+    _print_workspace_report(results, hosts)
+    return results
+
+
+def _print_workspace_report(results, hosts):
+    repos = list(ub.unique(r['repo'] for r in results))
+    width = max(len(name) for name in repos + ['repo'])
+    widths = [max(len(h), 7) for h in hosts]
+    print('git-sync workspace summary:')
+    header = '  ' + 'repo'.ljust(width) + ''.join(
+        '  ' + h.ljust(w) for h, w in zip(hosts, widths))
+    print(header.rstrip())
+    lookup = {(r['repo'], r['host']): r['status'] for r in results}
+    for name in repos:
+        row = '  ' + name.ljust(width) + ''.join(
+            '  ' + lookup[(name, h)].ljust(w) for h, w in zip(hosts, widths))
+        print(row.rstrip())
+    num_ok = sum(r['status'] in {'ok', 'clean'} for r in results)
+    print(f'  {num_ok} / {len(results)} repo-host pairs in sync')
@@ -0,0 +1,146 @@
+"""
+The integration tests run the git-sync CLI against "hosts" that are
+directories on this machine. They are reached through the ssh stand-in of the
+benchmarks (``dev/benchmarks/fake_ssh.py``), which runs the remote commands
+with ``sh`` in the home directory of the host.
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import pytest
+import ubelt as ub
+import git_sync
+
+REPO_DPATH = ub.Path(__file__).parent.parent
+FAKE_SSH_FPATH = REPO_DPATH / 'dev/benchmarks/fake_ssh.py'
+# The CLI runs the git_sync that is tested, which may be installed
+PACKAGE_PARENT = ub.Path(git_sync.__file__).parent.parent
+
+
+class Sandbox:
+    """
+    A local repo at ``home/code/repo`` with the bare remote ``origin.git``,
+    and a clone of it at ``hosts/<host>/code/repo`` on every host. All repos
+    start at the same commit.
+    """
+
+    def __init__(self, dpath, hosts):
+        self.dpath = dpath
+        self.hosts = hosts
+        bin_dpath = (dpath / 'bin').ensuredir()
+        ssh_fpath = bin_dpath / 'ssh'
+        shutil.copy(FAKE_SSH_FPATH, ssh_fpath)
+        ssh_fpath.chmod(0o755)
+        self.home = (dpath / 'home').ensuredir()
+        self.hosts_dpath = (dpath / 'hosts').ensuredir()
+        self.log_fpath = dpath / 'calls.jsonl'
+        env = os.environ.copy()
+        for key in ['GIT_SSH', 'GIT_SSH_COMMAND', 'GIT_DIR', 'GIT_WORK_TREE',
+                    'GIT_SYNC_SSH_MULTIPLEX', 'GIT_SYNC_HISTORY']:
+            env.pop(key, None)
+        env.update({
+            'HOME': os.fspath(self.home),
+            'PATH': os.fspath(bin_dpath) + os.pathsep + env.get('PATH', ''),
+            'PYTHONPATH': os.pathsep.join(
+                [os.fspath(PACKAGE_PARENT)] +
+                [p for p in [env.get('PYTHONPATH')] if p]),
+            'XDG_CONFIG_HOME': os.fspath(dpath / 'config'),
+            'GIT_SYNC_CACHE_DPATH': os.fspath(dpath / 'cache'),
+            'GIT_SYNC_BENCH_HOSTS': os.fspath(self.hosts_dpath),
+            'GIT_SYNC_BENCH_LOG': os.fspath(self.log_fpath),
+            'GIT_CONFIG_NOSYSTEM': '1',
+            'GIT_AUTHOR_NAME': 'test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+            'GIT_COMMITTER_NAME': 'test',
+            'GIT_COMMITTER_EMAIL': 'test@example.com',
+        })
+        self.env = env
+
+        self.origin = dpath / 'origin.git'
+        self.git(dpath, 'init', '-q', '--bare', '-b', 'main', self.origin)
+        seed = dpath / 'seed'
+        self.git(dpath, 'init', '-q', '-b', 'main', seed)
+        (seed / 'a.txt').write_text('a\n')
+        (seed / 'b.txt').write_text('b\n')
+        self.git(seed, 'add', 'a.txt', 'b.txt')
+        self.git(seed, 'commit', '-q', '-m', 'initial')
+        self.git(seed, 'push', '-q', self.origin, 'main')
+        self.repo = self.home / 'code/repo'
+        for repo in [self.repo] + [self.host_repo(h) for h in hosts]:
+            self.git(dpath, 'clone', '-q', self.origin, repo)
+
+    def host_repo(self, host):
+        return self.hosts_dpath / host / 'code/repo'
+
+    def git(self, cwd, *args):
+        info = subprocess.run(['git'] + [os.fspath(a) for a in args],
+                              cwd=cwd, env=self.env, capture_output=True,
+                              text=True)
+        if info.returncode != 0:
+            raise AssertionError('git {} failed: {}'.format(
+                ' '.join(map(str, args)), info.stderr))
+        return info.stdout.strip()
+
+    def head(self, repo=None):
+        return self.git(self.repo if repo is None else repo, 'rev-parse',
+                        'HEAD')
+
+    def change(self, repo=None, fname='a.txt', text='change\n'):
+        """
+        Append to a file of a repo without committing
+        """
+        fpath = (self.repo if repo is None else repo) / fname
+        with open(fpath, 'a') as file:
+            file.write(text)
+
+    def popen(self, *args):
+        return subprocess.Popen(
+            [sys.executable, '-m', 'git_sync'] + list(args), cwd=self.repo,
+            env=self.env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True)
+
+    def run(self, *args, timeout=120, cwd=None):
+        """
+        Run the CLI in the local repo (or ``cwd``).
+
+        Returns:
+            subprocess.CompletedProcess: with the stdout and stderr in
+            ``stdout``
+        """
+        info = subprocess.run(
+            [sys.executable, '-m', 'git_sync'] + list(args),
+            cwd=self.repo if cwd is None else cwd, env=self.env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+            timeout=timeout)
+        print(info.stdout)
+        return info
+
+    def drop(self, host, count):
+        """
+        Make the next ``count`` ssh sessions to a host fail like a dropped
+        connection.
+        """
+        (self.hosts_dpath / f'{host}.drop').write_text(str(count))
+
+    def sessions(self, host=None):
+        """
+        The ssh sessions so far (control master invocations excluded).
+        """
+        if not self.log_fpath.exists():
+            return []
+        entries = [json.loads(line)
+                   for line in self.log_fpath.read_text().splitlines()]
+        return [e for e in entries if e['prog'] == 'ssh' and
+                not e.get('control') and (host is None or e['host'] == host)]
+
+
+@pytest.fixture
+def sandbox(tmp_path):
+    if sys.platform.startswith('win'):
+        pytest.skip('the ssh stand-in needs a POSIX shell')
+    if shutil.which('git') is None or shutil.which('sh') is None:
+        pytest.skip('git and sh are required')
+    if not FAKE_SSH_FPATH.exists():
+        pytest.skip('the ssh stand-in is not available')
+    return Sandbox(ub.Path(tmp_path), ['node1', 'node2', 'node3'])
@@ -0,0 +1,317 @@
+"""
+End-to-end tests of the CLI in the sandbox of ``conftest.py``.
+"""
+import os
+import signal
+import time
+
+
+def test_sync_to_hosts(sandbox):
+    sandbox.change()
+    info = sandbox.run('node1,node2', 'origin')
+    assert info.returncode == 0
+    head = sandbox.head()
+    assert sandbox.git(sandbox.repo, 'status', '--porcelain') == ''
+    assert sandbox.head(sandbox.origin) == head
+    for host in ['node1', 'node2']:
+        assert sandbox.head(sandbox.host_repo(host)) == head
+    assert sandbox.head(sandbox.host_repo('node3')) != head
+    assert '2 / 2 hosts synced' in info.stdout
+
+
+def test_unreachable_host_does_not_stop_the_others(sandbox):
+    sandbox.change()
+    info = sandbox.run('node1,nowhere', 'origin')
+    assert info.returncode == 1
+    assert sandbox.head(sandbox.host_repo('node1')) == sandbox.head()
+    assert '1 / 2 hosts synced' in info.stdout
+
+
+def test_dry_run_changes_nothing(sandbox):
+    sandbox.change()
+    before = sandbox.head()
+    info = sandbox.run('node1', 'origin', '--dry')
+    assert info.returncode == 0
+    assert 'git push origin' in info.stdout
+    assert sandbox.head() == before
+    assert sandbox.sessions() == []
+
+
+def test_fast_path_only_probes_the_hosts(sandbox):
+    sandbox.change()
+    assert sandbox.run('node1,node2', 'origin').returncode == 0
+    num_sessions = len(sandbox.sessions())
+    info = sandbox.run('node1,node2', 'origin')
+    assert info.returncode == 0
+    assert 'already at' in info.stdout
+    assert 'git push' not in info.stdout
+    # One session per host that only reads HEAD
+    assert len(sandbox.sessions()) - num_sessions == 2
+
+
+def test_fast_path_syncs_a_host_that_moved(sandbox):
+    sandbox.change()
+    assert sandbox.run('node1,node2', 'origin').returncode == 0
+    head = sandbox.head()
+    sandbox.git(sandbox.host_repo('node2'), 'reset', '-q', '--hard', 'HEAD~1')
+    info = sandbox.run('node1,node2', 'origin')
+    assert info.returncode == 0
+    assert sandbox.head(sandbox.host_repo('node2')) == head
+
+
+def test_direct_push_updates_the_host(sandbox):
+    host_repo = sandbox.host_repo('node1')
+    sandbox.git(sandbox.repo, 'remote', 'add', 'node1', 'node1:code/repo')
+    sandbox.change(text='direct\n')
+    info = sandbox.run('node1', 'node1')
+    assert info.returncode == 0
+    assert sandbox.head(host_repo) == sandbox.head()
+    assert (host_repo / 'a.txt').read_text() == 'a\ndirect\n'
+    assert sandbox.git(host_repo, 'config',
+                       'receive.denyCurrentBranch') == 'updateInstead'
+    # The origin is not involved
+    assert sandbox.head(sandbox.origin) != sandbox.head()
+
+
+def test_direct_push_refuses_to_overwrite_host_changes(sandbox):
+    host_repo = sandbox.host_repo('node1')
+    sandbox.git(sandbox.repo, 'remote', 'add', 'node1', 'node1:code/repo')
+    sandbox.change(repo=host_repo, text='on the host\n')
+    sandbox.change(text='local\n')
+    before = sandbox.head(host_repo)
+    info = sandbox.run('node1', 'node1')
+    assert info.returncode == 1
+    assert 'nothing was pushed' in info.stdout
+    assert sandbox.head(host_repo) == before
+    assert 'on the host' in (host_repo / 'a.txt').read_text()
+
+
+def test_hooks_make_the_push_the_whole_sync(sandbox):
+    host_repo = sandbox.host_repo('node1')
+    sandbox.git(sandbox.repo, 'remote', 'add', 'node1', 'node1:code/repo')
+    info = sandbox.run('install-hook', 'node1', '--post-sync',
+                       'echo configured; exit 3')
+    assert info.returncode == 0
+    sandbox.change(text='hook\n')
+    num_sessions = len(sandbox.sessions('node1'))
+    info = sandbox.run('node1', 'node1')
+    # The exit code of the post-sync command is reported
+    assert info.returncode == 1
+    assert 'configured' in info.stdout
+    assert sandbox.head(host_repo) == sandbox.head()
+    sandbox.change(text='cli\n')
+    info = sandbox.run('node1', 'node1', '--post-sync', 'echo fromcli')
+    assert info.returncode == 0
+    assert 'fromcli' in info.stdout
+    assert 'configured' not in info.stdout
+    assert sandbox.head(host_repo) == sandbox.head()
+    # Besides the push, only the snapshot is taken over ssh
+    assert len(sandbox.sessions('node1')) - num_sessions == 4
+
+
+def test_install_hook_from_a_subdirectory(sandbox):
+    host_repo = sandbox.host_repo('node1')
+    (sandbox.repo / 'sub').ensuredir()
+    (sandbox.repo / 'sub/c.txt').write_text('c\n')
+    sandbox.git(sandbox.repo, 'add', 'sub/c.txt')
+    sandbox.git(sandbox.repo, 'commit', '-q', '-m', 'sub')
+    assert sandbox.run('node1', 'origin').returncode == 0
+    info = sandbox.run('install-hook', 'node1', cwd=sandbox.repo / 'sub')
+    assert info.returncode == 0
+    # The remote points at the repo on the host, not at the subdirectory
+    url = sandbox.git(sandbox.repo, 'remote', 'get-url', 'node1')
+    assert url == f'node1:{host_repo}'
+    sandbox.change(text='hook\n')
+    info = sandbox.run('node1', 'node1')
+    assert info.returncode == 0
+    assert sandbox.head(host_repo) == sandbox.head()
+
+
+def test_moved_repo_is_rediscovered(sandbox):
+    # The repo on the host is reached through a symlink, the cache keeps
+    # where it really is
+    host_dpath = sandbox.hosts_dpath / 'node1'
+    host_repo = sandbox.host_repo('node1')
+    host_repo.rename((host_dpath / 'work').ensuredir() / 'repo')
+    host_repo.symlink_to(host_dpath / 'work/repo')
+    sandbox.change()
+    assert sandbox.run('node1', 'origin').returncode == 0
+
+    (host_dpath / 'work/repo').rename(host_dpath / 'work/moved')
+    host_repo.unlink()
+    host_repo.symlink_to(host_dpath / 'work/moved')
+    sandbox.change(text='again\n')
+    # The cached location is gone, which fails this sync but not the next
+    assert sandbox.run('node1', 'origin').returncode == 1
+    info = sandbox.run('node1', 'origin')
+    assert info.returncode == 0
+    assert sandbox.head(host_dpath / 'work/moved') == sandbox.head()
+
+
+def test_relay_through_hosts(sandbox):
+    sandbox.change()
+    info = sandbox.run('node1,node2,node3', 'origin', '--relay', '1')
+    assert info.returncode == 0
+    head = sandbox.head()
+    for host in sandbox.hosts:
+        assert sandbox.head(sandbox.host_repo(host)) == head
+    assert '3 / 3 hosts synced' in info.stdout
+    assert info.stdout.count('via node') == 2
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            # A zombie is not running anymore
+            return file.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except OSError:
+        return True
+
+
+def _wait_stopped(pid, timeout=10):
+    deadline = time.monotonic() + timeout
+    while _alive(pid):
+        if time.monotonic() > deadline:
+            os.kill(pid, signal.SIGKILL)
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def _read_pid(fpath, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not (fpath.exists() and fpath.read_text().strip()):
+        assert time.monotonic() < deadline, 'the command did not start'
+        time.sleep(0.1)
+    return int(fpath.read_text())
+
+
+def test_timeout_stops_the_command_on_the_host(sandbox):
+    pid_fpath = sandbox.dpath / 'sleep.pid'
+    sandbox.change()
+    start = time.monotonic()
+    info = sandbox.run('node1', 'origin', '--timeout', 'sync=2',
+                       '--post-sync', f'sleep 60 & echo $! > {pid_fpath}; wait')
+    assert info.returncode == 1
+    assert time.monotonic() - start < 30
+    assert _wait_stopped(_read_pid(pid_fpath))
+
+
+def test_interrupt_stops_the_command_on_the_host(sandbox):
+    pid_fpath = sandbox.dpath / 'sleep.pid'
+    sandbox.change()
+    proc = sandbox.popen('node1', 'origin', '--post-sync',
+                         f'sleep 60 & echo $! > {pid_fpath}; wait')
+    try:
+        pid = _read_pid(pid_fpath)
+        proc.send_signal(signal.SIGINT)
+        proc.communicate(timeout=30)
+    finally:
+        proc.kill()
+    assert proc.returncode != 0
+    assert _wait_stopped(pid)
+
+
+def test_retry_after_a_dropped_connection(sandbox):
+    sandbox.change()
+    assert sandbox.run('node1', 'origin').returncode == 0
+    sandbox.change(text='again\n')
+    sandbox.drop('node1', 2)
+    info = sandbox.run('node1', 'origin')
+    assert info.returncode == 0
+    assert info.stdout.count('retrying') == 2
+    assert sandbox.head(sandbox.host_repo('node1')) == sandbox.head()
+
+
+def test_failed_post_sync_command_is_not_retried(sandbox):
+    count_fpath = sandbox.dpath / 'count.txt'
+    sandbox.change()
+    info = sandbox.run('node1', 'origin', '--post-sync',
+                       f'echo ran >> {count_fpath}; exit 255')
+    assert info.returncode == 1
+    assert 'retrying' not in info.stdout
+    assert count_fpath.read_text() == 'ran\n'
+
+
+def test_resume_skips_what_an_earlier_sync_did(sandbox):
+    node2_repo = sandbox.host_repo('node2')
+    sandbox.git(node2_repo, 'commit', '-q', '--allow-empty', '-m', 'diverged')
+    sandbox.change()
+    info = sandbox.run('node1,node2', 'origin')
+    assert info.returncode == 1
+    head = sandbox.head()
+    assert sandbox.head(sandbox.host_repo('node1')) == head
+
+    # Every requested host was synced by the earlier run
+    num_sessions = len(sandbox.sessions())
+    info = sandbox.run('node1', 'origin')
+    assert info.returncode == 0
+    assert 'by an earlier run' in info.stdout
+    assert len(sandbox.sessions()) == num_sessions
+
+    # The host that failed is synced without a new commit or push
+    sandbox.git(node2_repo, 'reset', '-q', '--hard', 'HEAD~1')
+    info = sandbox.run('node2', 'origin')
+    assert info.returncode == 0
+    assert 'git push' not in info.stdout
+    assert sandbox.head(node2_repo) == head
+
+
+def test_pull_back_brings_the_host_changes(sandbox):
+    host_repo = sandbox.host_repo('node1')
+    sandbox.change(repo=host_repo, fname='b.txt', text='from the host\n')
+    info = sandbox.run('node1', '--pull-back')
+    assert info.returncode == 0
+    assert (sandbox.repo / 'b.txt').read_text() == 'b\nfrom the host\n'
+    assert sandbox.head() == sandbox.head(host_repo)
+    assert sandbox.git(host_repo, 'status', '--porcelain') == ''
+
+
+def test_pull_back_rebases_local_commits(sandbox):
+    host_repo = sandbox.host_repo('node1')
+    sandbox.change(repo=host_repo, fname='b.txt', text='from the host\n')
+    sandbox.change(text='local\n')
+    sandbox.git(sandbox.repo, 'commit', '-q', '-am', 'local')
+    info = sandbox.run('node1', '--pull-back')
+    assert info.returncode == 0
+    assert sandbox.git(sandbox.repo, 'log', '-1', '--format=%s') == 'local'
+    assert 'from the host' in (sandbox.repo / 'b.txt').read_text()
+    assert sandbox.git(sandbox.repo, 'merge-base', '--is-ancestor',
+                       sandbox.head(host_repo), 'HEAD') == ''
+
+
+def test_both_syncs_the_side_with_changes(sandbox):
+    host_repo = sandbox.host_repo('node1')
+    sandbox.change(text='local\n')
+    info = sandbox.run('node1', 'origin', '--both')
+    assert info.returncode == 0
+    assert sandbox.head(host_repo) == sandbox.head()
+
+    sandbox.change(repo=host_repo, fname='b.txt', text='from the host\n')
+    info = sandbox.run('node1', 'origin', '--both')
+    assert info.returncode == 0
+    assert 'from the host' in (sandbox.repo / 'b.txt').read_text()
+    assert sandbox.head(host_repo) == sandbox.head()
+
+
+def test_both_with_diverged_changes(sandbox):
+    host_repo = sandbox.host_repo('node1')
+    sandbox.change(repo=host_repo, fname='b.txt', text='from the host\n')
+    sandbox.change(text='local\n')
+    local_head = sandbox.head()
+    host_head = sandbox.head(host_repo)
+    info = sandbox.run('node1', 'origin', '--both')
+    assert info.returncode == 1
+    assert sandbox.head() == local_head
+    assert sandbox.head(host_repo) == host_head
+
+    info = sandbox.run('node1', 'origin', '--both', '--on-diverge', 'merge')
+    assert info.returncode == 0
+    for repo in [sandbox.repo, host_repo]:
+        assert (repo / 'a.txt').read_text() == 'a\nlocal\n'
+        assert (repo / 'b.txt').read_text() == 'b\nfrom the host\n'
+    assert sandbox.head(host_repo) == sandbox.head()